@@ -22,28 +22,68 @@ from sklearn.model_selection import GridSearchCV
 from sklearn.compose import make_column_transformer, ColumnTransformer
 from sklearn.linear_model import LogisticRegression
 from sklearn.metrics import make_scorer, accuracy_score, matthews_corrcoef, confusion_matrix, precision_score, recall_score
-from sklearn.calibration import calibration_curve
-import matplotlib.pyplot as plt
 
-from transforms.model import MLmodeling_hpo
+from transforms.model import MLmodeling_hpo, INPUT_COLUMNS
 from transforms.score_a import drs_metrics, score
 from transforms.score_b import calibration_curve_agg
+from transforms.calibration import plot_calibration
+from transforms.ps_modules import load_ps_module
+
+# the background writer of the PS step (2_ps/transforms/async_writer.py)
+AsyncWriter = load_ps_module('async_writer').AsyncWriter
+# the feature store reader of the PS step (2_ps/transforms/feature_store.py)
+load_features = load_ps_module('feature_store').load_features
 
 from pathlib import Path
 
 # read in data from previous step
 current = Path.cwd()
-impute_pmm = pd.read_csv('1_imputation/data/mab_patient_effect_imputed_no_treatment.csv')
+# read from the feature store built by 2_ps/main_feature_store.py instead of parsing the csv
+use_feature_store = True
+if use_feature_store:
+    impute_pmm = load_features(current / '1_imputation' / 'data' / 'feature_store' / 'mab_patient_effect_imputed_no_treatment',
+        'drs', include=INPUT_COLUMNS)
+else:
+    impute_pmm = pd.read_csv('1_imputation/data/mab_patient_effect_imputed_no_treatment.csv')
+
+# DRS search mode, see SEARCH_MODES in 2_drs/transforms/model.py; keep the reference 'grid' search until
+# python 2_drs/main_drs_equivalence.py has passed for the chosen mode
+search_mode = 'grid'
+
+# DRS outcomes to train in one pass, see TARGETS in 2_drs/transforms/model.py (None trains all_30d only)
+targets = None
+
+# fit one pooled DRS on the stacked imputations instead of one per imputation group
+pooled = False
+
+# fitted models and their scoring plans are saved here for 2_drs/main_drs_score.py
+model_path = current / '2_drs' / 'data' / 'models'
 
 # preprocess and train model
-agg_results = MLmodeling_hpo(impute_pmm)
+agg_results = MLmodeling_hpo(impute_pmm, search_mode=search_mode, targets=targets, pooled=pooled, model_path=model_path)
+
+# outputs are written on a background thread; compression (e.g. 'gzip') appends its suffix to the file names
+output_compression = None
+writer = AsyncWriter(compression=output_compression)
+
+# write results to csv
+writer.write_csv(agg_results, current / '2_drs' / 'data' / 'agg_results.csv', index = False)
 
 # evaluate model
-results = drs_metrics(agg_results)
+# extra strata from the input data to also report DRS metrics by, e.g. ['health_system', 'pandemic_phase']
+metric_strata = []
+results = drs_metrics(
+    agg_results.merge(impute_pmm[['person_id', 'impute_id'] + metric_strata], on=['person_id', 'impute_id'], how='left'),
+    strata=metric_strata
+)
 conf_matrix = score(agg_results)
 
-# plot curve comparing results between impute groups
-calibration_curve_agg(agg_results)
+# calibration table and curve comparing results between impute groups (plot_calibration_curve = False skips the plot)
+plot_calibration_curve = True
+calibration, calibration_summary = calibration_curve_agg(agg_results, plot=False)
+writer.write_csv(calibration, current / '2_drs' / 'data' / 'calibration.csv', index = False)
+if plot_calibration_curve:
+    writer.submit(lambda path: plot_calibration(calibration, path, by='impute_id'), current / '2_drs' / 'figures' / 'calibration_curve.png')
 
-# write results to csv 
-agg_results.to_csv(current / '2_drs' / 'data' / 'agg_results.csv', index = False)
\ No newline at end of file
+# wait for every output to be written
+writer.close()
\ No newline at end of file
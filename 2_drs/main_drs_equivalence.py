@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+##################################################
+## Project: Real World Evidence to Accelerate COVID-19 Therapeutics
+## Contract No.: 75FCMC18D0047
+## Purpose: This script checks that the DRS search modes reproduce the scores of the reference grid search
+## Date: May 2022
+## Developers: Jerez Te
+## Copyright 2022, The MITRE Corporation
+## Approved for Public Release; Distribution Unlimited. Public Release Case Number 22-1741.
+##################################################
+
+# usage: python 2_drs/main_drs_equivalence.py [fast_path ...]
+# without arguments every fast path of transforms/equivalence.py is checked; exits with status 1 on a failure
+
+import sys
+import pandas as pd
+
+from transforms.model import INPUT_COLUMNS
+from transforms.equivalence import FAST_PATHS, synthetic_cohort, check_fast_paths
+from transforms.ps_modules import load_ps_module
+
+# the feature store reader of the PS step (2_ps/transforms/feature_store.py)
+load_features = load_ps_module('feature_store').load_features
+
+from pathlib import Path
+
+current = Path.cwd()
+
+names = sys.argv[1:] or list(FAST_PATHS)
+unknown = [name for name in names if name not in FAST_PATHS]
+assert not unknown, f"Unknown fast paths {unknown}; choose from {list(FAST_PATHS)}."
+fast_paths = {name: FAST_PATHS[name] for name in names}
+
+# number of patients of the synthetic cohorts resampled from the toy data
+synthetic_sizes = [5000, 20000]
+
+# read in data as main_drs.py does
+use_feature_store = True
+if use_feature_store:
+    impute_pmm = load_features(current / '1_imputation' / 'data' / 'feature_store' / 'mab_patient_effect_imputed_no_treatment',
+        'drs', include=INPUT_COLUMNS)
+else:
+    impute_pmm = pd.read_csv('1_imputation/data/mab_patient_effect_imputed_no_treatment.csv')
+
+cohorts = {'toy': impute_pmm}
+for n_persons in synthetic_sizes:
+    cohorts[f'synthetic_{n_persons}'] = synthetic_cohort(impute_pmm, n_persons)
+
+reports, summaries = [], []
+for cohort, cohort_df in cohorts.items():
+    report, summary = check_fast_paths(cohort_df, fast_paths, cohort)
+    reports.append(report)
+    summaries.append(summary)
+
+report = pd.concat(reports, ignore_index=True)
+summary = pd.concat(summaries, ignore_index=True)
+report.to_csv(current / '2_drs' / 'data' / 'equivalence_report.csv', index = False)
+summary.to_csv(current / '2_drs' / 'data' / 'equivalence_summary.csv', index = False)
+
+print(summary[['cohort', 'fast_path', 'n_failed', 'max_abs_diff', 'max_rank_diff', 'speedup', 'passed']].to_string(index=False))
+if not summary['passed'].all():
+    sys.exit(1)
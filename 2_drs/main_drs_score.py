@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+##################################################
+## Project: Real World Evidence to Accelerate COVID-19 Therapeutics
+## Contract No.: 75FCMC18D0047
+## Purpose: This script scores new patients with the DRS models saved by 2_drs/main_drs.py
+## Date: May 2022
+## Developers: Jerez Te
+## Copyright 2022, The MITRE Corporation
+## Approved for Public Release; Distribution Unlimited. Public Release Case Number 22-1741.
+##################################################
+
+# USAGE:
+#   python 2_drs/main_drs_score.py <input.csv> <output.csv>     score a batch file
+#   python 2_drs/main_drs_score.py --serve 8000                 POST csv batches to http://localhost:8000/score
+
+import argparse
+import io
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+
+import pandas as pd
+
+from transforms.scoring import load_drs, score_drs
+
+current = Path.cwd()
+model_path = current / '2_drs' / 'data' / 'models'
+
+# rows read and scored at a time from a batch file
+chunk_size = 100000
+
+
+def score_file(plans, source, destination, handle_unknown):
+    header = True
+    for chunk in pd.read_csv(source, chunksize=chunk_size):
+        scores = score_drs(plans, chunk, handle_unknown)
+        scores.insert(0, 'person_id', chunk['person_id'].to_numpy())
+        scores.to_csv(destination, mode='w' if header else 'a', header=header, index=False)
+        header = False
+
+
+def serve(plans, port, handle_unknown):
+    class ScoreHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != '/score':
+                self.send_error(404)
+                return
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            try:
+                batch = pd.read_csv(io.BytesIO(body))
+                scores = score_drs(plans, batch, handle_unknown)
+            except (ValueError, KeyError) as e:
+                self.send_error(400, str(e))
+                return
+            scores.insert(0, 'person_id', batch['person_id'].to_numpy())
+            payload = scores.to_csv(index=False).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/csv')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+    print(f"Scoring DRS batches on http://localhost:{port}/score")
+    HTTPServer(('localhost', port), ScoreHandler).serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Score patient batches with the saved DRS models.')
+    parser.add_argument('files', nargs='*', help='input csv and output csv')
+    parser.add_argument('--serve', type=int, metavar='PORT', help='run a local HTTP scoring endpoint instead')
+    parser.add_argument('--target', default=None, help='only score this DRS target')
+    parser.add_argument('--ignore-unknown', action='store_true', help='score unknown categories as the baseline level')
+    args = parser.parse_args()
+
+    plans = load_drs(model_path, args.target)
+    handle_unknown = 'ignore' if args.ignore_unknown else 'error'
+    if args.serve:
+        serve(plans, args.serve, handle_unknown)
+    else:
+        assert len(args.files) == 2, "Pass an input csv and an output csv, or --serve PORT"
+        score_file(plans, args.files[0], args.files[1], handle_unknown)
@@ -0,0 +1,100 @@
+##################################################
+## Project: Real World Evidence to Accelerate COVID-19 Therapeutics
+## Contract No.: 75FCMC18D0047
+## Purpose: This function computes binned calibration statistics of DRS predictions
+## Date: May 2022
+## Developers: Jerez Te
+## Copyright 2022, The MITRE Corporation
+## Approved for Public Release; Distribution Unlimited. Public Release Case Number 22-1741.
+##################################################
+
+import numpy as np
+import pandas as pd
+
+CALIBRATION_STRATEGIES = ['uniform', 'quantile']
+
+
+def calibration_table(df, by=('impute_id',), n_bins=10, strategy='uniform'):
+    '''
+    Binned calibration of prediction against target for every group of the by columns
+    (e.g. impute_id, treatment_group, health_system), from one grouped bincount pass.
+
+    strategy='uniform' uses n_bins equal-width bins on [0, 1], as sklearn calibration_curve.
+    strategy='quantile' puts (about) the same number of rows of each group in every bin, by
+    rank of the prediction within the group.
+    returns: (table, summary) where table has one row per non-empty (group, bin) with count,
+    mean_predicted and observed_rate, and summary has one row per group with count, Brier score
+    and expected calibration error (ECE, the count-weighted mean |observed_rate - mean_predicted|).
+    '''
+    assert strategy in CALIBRATION_STRATEGIES, f"strategy must be one of {CALIBRATION_STRATEGIES}"
+    by = list(by)
+    y_prob = df['prediction'].to_numpy(dtype=np.float64)
+    y_true = df['target'].to_numpy(dtype=np.float64)
+
+    if by:
+        codes, levels = pd.MultiIndex.from_frame(df[by]).factorize(sort=True)
+    else:
+        codes, levels = np.zeros(len(df), dtype=np.int64), None
+    n_groups = int(codes.max()) + 1 if len(codes) else 0
+    totals = np.bincount(codes, minlength=n_groups)
+
+    if strategy == 'uniform':
+        bins = np.searchsorted(np.linspace(0.0, 1.0, n_bins + 1)[1:-1], y_prob, side='right')
+    else:
+        order = np.lexsort((y_prob, codes))
+        group_start = np.r_[0, np.cumsum(totals)[:-1]]
+        rank = np.empty(len(df), dtype=np.int64)
+        rank[order] = np.arange(len(df)) - group_start[codes[order]]
+        bins = rank * n_bins // totals[codes]
+
+    cell = codes * n_bins + bins
+    size = n_groups * n_bins
+    count = np.bincount(cell, minlength=size)
+    sum_prob = np.bincount(cell, weights=y_prob, minlength=size)
+    sum_true = np.bincount(cell, weights=y_true, minlength=size)
+
+    keep = np.flatnonzero(count > 0)
+    group, bin_id = np.divmod(keep, n_bins)
+    table = pd.DataFrame({
+        'bin': bin_id,
+        'count': count[keep],
+        'mean_predicted': sum_prob[keep] / count[keep],
+        'observed_rate': sum_true[keep] / count[keep],
+    })
+
+    gap = np.abs(table['observed_rate'].to_numpy() - table['mean_predicted'].to_numpy())
+    summary = pd.DataFrame({
+        'count': totals,
+        'brier': np.bincount(codes, weights=(y_prob - y_true) ** 2, minlength=n_groups) / totals,
+        'ece': np.bincount(group, weights=count[keep] * gap, minlength=n_groups) / totals,
+    })
+
+    if by:
+        table = pd.concat([_group_keys(levels, group, by), table], axis=1)
+        summary = pd.concat([_group_keys(levels, np.arange(n_groups), by), summary], axis=1)
+    return table, summary
+
+
+def plot_calibration(table, path, by='impute_id'):
+    # Plots one calibration curve per value of by from a calibration_table table.
+    # matplotlib is only imported here, with the non-interactive Agg backend.
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots()
+    for key, subset in table.groupby(by, sort=True):
+        ax.plot(subset['mean_predicted'], subset['observed_rate'], marker='o', label=str(key))
+    ax.plot([0, 1], [0, 1], linestyle='--', color='gray')
+    ax.legend()
+    ax.set_xlabel('Mean Predicted Probability')
+    ax.set_ylabel('Fraction of positives')
+    fig.savefig(path)
+    plt.close(fig)
+    return
+
+
+def _group_keys(levels, group, by):
+    keys = levels[group].to_frame(index=False)
+    keys.columns = by
+    return keys
@@ -0,0 +1,97 @@
+##################################################
+## Project: Real World Evidence to Accelerate COVID-19 Therapeutics
+## Contract No.: 75FCMC18D0047
+## Purpose: Functions to check that the DRS search modes reproduce the scores of the reference grid search
+## Date: May 2022
+## Developers: Jerez Te
+## Copyright 2022, The MITRE Corporation
+## Approved for Public Release; Distribution Unlimited. Public Release Case Number 22-1741.
+##################################################
+
+import importlib
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+from transforms.ps_modules import load_ps_module
+
+# synthetic_cohort and compare_columns of the PS equivalence check (2_ps/transforms/compare.py)
+compare = load_ps_module('compare')
+
+# Reference implementation: GridSearchCV per imputation, every performance setting of transforms/model.py off
+REFERENCE_MODE = 'grid'
+REFERENCE_SETTINGS = {'COMPRESS_ROWS': False, 'AUTOTUNE_SOLVER': False}
+
+# Fast paths checked against the reference: search mode, model.py settings on top of REFERENCE_SETTINGS and
+# tolerances on the predictions (atol: max absolute difference, mean_atol: mean absolute difference,
+# rank_tol: max rank change within an imputation as a fraction of its rows; None is not checked).
+# Halving may select another configuration, so only its mean shift is checked.
+FAST_PATHS = {
+    'parallel': {'search_mode': 'parallel', 'settings': {},
+                 'atol': 1e-8, 'mean_atol': None, 'rank_tol': 0.0},
+    'parallel_compress': {'search_mode': 'parallel', 'settings': {'COMPRESS_ROWS': True},
+                          'atol': 1e-4, 'mean_atol': None, 'rank_tol': 0.01},
+    'halving': {'search_mode': 'halving', 'settings': {},
+                'atol': None, 'mean_atol': 0.02, 'rank_tol': None},
+    'autotune_solver': {'search_mode': 'parallel', 'settings': {'AUTOTUNE_SOLVER': True},
+                        'atol': 0.05, 'mean_atol': 0.01, 'rank_tol': 0.05},
+}
+
+KEYS = ['person_id', 'impute_id']
+
+REPORT_COLUMNS = ['cohort', 'fast_path', 'column', 'n_rows', 'max_abs_diff', 'mean_abs_diff', 'max_rank_diff', 'passed']
+
+
+@contextmanager
+def override_settings(settings):
+    # temporarily set module constants of transforms/model.py
+    model = importlib.import_module('transforms.model')
+    saved = {name: getattr(model, name) for name in settings}
+    try:
+        for name, value in settings.items():
+            setattr(model, name, value)
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(model, name, value)
+
+
+def run_drs(df, search_mode, settings, targets=None):
+    # MLmodeling_hpo with the given settings; returns the scores and the run time in seconds
+    from transforms.model import MLmodeling_hpo
+    with override_settings(settings):
+        start = time.perf_counter()
+        results = MLmodeling_hpo(df, search_mode=search_mode, targets=targets)
+        return results, time.perf_counter() - start
+
+
+def synthetic_cohort(df, n_persons, seed=2022):
+    # n_persons patients resampled from df with all their imputations, see compare.synthetic_cohort
+    return compare.synthetic_cohort(df, n_persons, 'person_id', seed)
+
+
+def check_fast_paths(df, fast_paths, cohort='toy', targets=None):
+    # runs the reference once and every fast path on df; returns the column report and one summary row per fast path
+    print(f"{cohort}: running the reference search.")
+    reference, time_reference = run_drs(df, REFERENCE_MODE, REFERENCE_SETTINGS, targets)
+    columns = [c for c in reference.columns if c.startswith('prediction')]
+
+    reports, summaries = [], []
+    for name, fast_path in fast_paths.items():
+        print(f"{cohort}: running fast path {name}.")
+        candidate, time_fast = run_drs(df, fast_path['search_mode'], {**REFERENCE_SETTINGS, **fast_path['settings']}, targets)
+        report = compare.compare_columns(reference, candidate, columns, KEYS, 'impute_id',
+                                         fast_path['atol'], fast_path['rank_tol'], fast_path['mean_atol'])
+        reports.append(report.assign(cohort=cohort, fast_path=name)[REPORT_COLUMNS])
+        summaries.append({
+            'cohort': cohort, 'fast_path': name, 'n_rows': int(df.shape[0]),
+            'n_columns': int(report.shape[0]), 'n_failed': int((~report['passed']).sum()),
+            'max_abs_diff': report['max_abs_diff'].max(), 'max_rank_diff': report['max_rank_diff'].max(),
+            'time_reference': time_reference, 'time_fast': time_fast,
+            'speedup': time_reference / time_fast if time_fast > 0 else np.nan,
+            'passed': bool(report['passed'].all()),
+        })
+    return pd.concat(reports, ignore_index=True), pd.DataFrame(summaries)
+
@@ -0,0 +1,221 @@
+##################################################
+## Project: Real World Evidence to Accelerate COVID-19 Therapeutics
+## Contract No.: 75FCMC18D0047
+## Purpose: This function runs the DRS hyperparameter search over cached CV folds in parallel
+## Date: May 2022
+## Developers: Jerez Te
+## Copyright 2022, The MITRE Corporation
+## Approved for Public Release; Distribution Unlimited. Public Release Case Number 22-1741.
+##################################################
+
+import warnings
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from sklearn.base import clone
+from sklearn.linear_model import LogisticRegression
+from sklearn.metrics import matthews_corrcoef
+from sklearn.model_selection import ParameterGrid, StratifiedKFold
+
+from transforms.ps_modules import load_ps_module
+
+# Row compression (compress=True) is that of the PS step, see 2_ps/transforms/compress.py.
+compress = load_ps_module('compress')
+
+
+def make_folds(X, y, n_splits=5, splits=None, cache=None, sample_weight=None):
+    # Same splits GridSearchCV(cv=5) uses for a classifier: unshuffled StratifiedKFold.
+    # The fold matrices are materialized once and shared by every config; with a cache
+    # dict they are also shared by every batch that uses the same X and splits.
+    y = np.asarray(y)
+    if splits is None:
+        splits = list(StratifiedKFold(n_splits=n_splits).split(X, y))
+    key = (id(X), id(splits))
+    if cache is None or key not in cache:
+        x_folds = [(X[train_idx], X[test_idx]) for train_idx, test_idx in splits]
+        if cache is not None:
+            cache[key] = x_folds
+    else:
+        x_folds = cache[key]
+    return [
+        (x_train, y[train_idx], x_test, y[test_idx],
+         None if sample_weight is None else np.asarray(sample_weight)[train_idx])
+        for (x_train, x_test), (train_idx, test_idx) in zip(x_folds, splits)
+    ]
+
+
+def fold_cached_search(batches, param_grid, n_splits=5, n_jobs=-1, base_model=None, splits=None, sample_weights=None,
+                       compress_rows=False):
+    '''
+    Equivalent of GridSearchCV(base_model, param_grid, cv=n_splits, scoring=MCC, refit=True) for several
+    imputation groups at once.
+
+    CV splits are fixed once per imputation group and the fold matrices are cached, so every
+    (config, fold, imputation) fit reads the same arrays (joblib memory-maps them for the workers instead of
+    re-indexing and copying them per candidate). All fits of all imputation groups are scheduled in a single
+    parallel pool; the best configuration of each imputation group is then refit on its full training set, also
+    in parallel. Ties in mean MCC are broken by grid order, as in GridSearchCV.
+
+    batches: list of (X_train, y_train), one per imputation group
+    splits: optional list with the (train_idx, test_idx) CV splits of each batch. Batches given the same X object
+    and the same splits object (e.g. several targets of one imputation group) share their fold matrices.
+    sample_weights: optional list with the sample_weight of each batch, passed to every fit (the MCC scores
+    are unweighted, as in GridSearchCV)
+    compress_rows: collapse duplicate (row, target) patterns of every training fold once into weighted distinct
+    rows and fit on those (compress_fit_rows and fit_compressed in 2_ps/transforms/compress.py)
+    returns: list of (best_estimator, cv_results) per imputation group, where cv_results is a DataFrame with the
+    params, per-fold and mean MCC of every config
+    '''
+    if base_model is None:
+        base_model = LogisticRegression(random_state=2022)
+    candidates = list(ParameterGrid(param_grid))
+    if splits is None:
+        splits = [None] * len(batches)
+    if sample_weights is None:
+        sample_weights = [None] * len(batches)
+    cache = {}
+    folds = [
+        make_folds(X, y, n_splits, split, cache, sample_weight)
+        for (X, y), split, sample_weight in zip(batches, splits, sample_weights)
+    ]
+    folds = [
+        [fold + (compress.compress_fit_rows(fold[0], fold[1], fold[4]) if compress_rows else None,)
+         for fold in batch_folds]
+        for batch_folds in folds
+    ]
+
+    tasks = [
+        (b, c, f)
+        for b in range(len(batches))
+        for c in range(len(candidates))
+        for f in range(n_splits)
+    ]
+    print(f"Fitting {len(tasks)} (imputation, config, fold) tasks")
+    fold_scores = Parallel(n_jobs=n_jobs)(
+        delayed(_fit_and_score)(clone(base_model).set_params(**candidates[c]), *folds[b][f])
+        for b, c, f in tasks
+    )
+    fold_scores = np.array(fold_scores).reshape(len(batches), len(candidates), n_splits)
+
+    cv_results, best_params = [], []
+    for b in range(len(batches)):
+        results = pd.DataFrame({'params': candidates})
+        for f in range(n_splits):
+            results[f'split{f}_test_MCC'] = fold_scores[b, :, f]
+        results['mean_test_MCC'] = fold_scores[b].mean(axis=1)
+        cv_results.append(results)
+
+        best_index = int(np.nanargmax(results['mean_test_MCC'].to_numpy()))
+        best_params.append(candidates[best_index])
+        print(f"BEST PARAM: {candidates[best_index]}")
+
+    best_estimators = Parallel(n_jobs=n_jobs)(
+        delayed(_refit)(clone(base_model).set_params(**params), X, y, sample_weight,
+                        compress.compress_fit_rows(X, y, sample_weight) if compress_rows else None)
+        for params, (X, y), sample_weight in zip(best_params, batches, sample_weights)
+    )
+    return list(zip(best_estimators, cv_results))
+
+
+def halving_search(batches, param_grid, factor=3, min_samples=500, n_splits=5, n_jobs=-1, base_model=None, seed=2022):
+    '''
+    Successive-halving variant of fold_cached_search.
+
+    Every config is first scored by CV on a small stratified subsample of each training set; only the top 1/factor
+    configs by mean MCC are kept and the subsample is grown by factor for the next round, until a single config
+    remains. Round sizes are chosen so that the last round uses the full training set (and never fewer than
+    min_samples rows), so the surviving configs are compared exactly as in the full grid. Subsamples are nested
+    and stratified on the target, so rare outcomes keep their prevalence in every round.
+
+    All imputation groups advance through the rounds together and each round's (config, fold, imputation) fits
+    run in one parallel pool. Returns the same structure as fold_cached_search; cv_results has one row per
+    (round, config) evaluated.
+    '''
+    if base_model is None:
+        base_model = LogisticRegression(random_state=2022)
+    candidates = list(ParameterGrid(param_grid))
+
+    # Number of evaluation rounds needed to get down to one config.
+    n_rounds, n_left = 1, len(candidates)
+    while n_left > factor:
+        n_left = int(np.ceil(n_left / factor))
+        n_rounds += 1
+
+    # Stratified, nested subsample order: within each class the rows are shuffled, and
+    # classes are interleaved by relative rank so that every prefix keeps the class balance.
+    rng = np.random.default_rng(seed)
+    orders = []
+    for X, y in batches:
+        y = np.asarray(y)
+        key = np.empty(len(y))
+        for label in np.unique(y):
+            idx = np.flatnonzero(y == label)
+            key[idx] = (rng.permutation(len(idx)) + rng.random(len(idx))) / len(idx)
+        orders.append(np.argsort(key, kind='mergesort'))
+
+    survivors = [list(range(len(candidates))) for _ in batches]
+    cv_results = [[] for _ in batches]
+    for round_number in range(n_rounds):
+        # Subsample of each imputation group for this round, with its cached folds.
+        folds = []
+        for (X, y), order in zip(batches, orders):
+            n_resources = int(min(len(order), max(min_samples, np.ceil(len(order) / factor ** (n_rounds - 1 - round_number)))))
+            idx = np.sort(order[:n_resources])
+            folds.append(make_folds(X[idx], np.asarray(y)[idx], n_splits))
+
+        tasks = [(b, c, f) for b in range(len(batches)) for c in survivors[b] for f in range(n_splits)]
+        print(f"Round {round_number}: fitting {len(tasks)} (imputation, config, fold) tasks")
+        fold_scores = Parallel(n_jobs=n_jobs)(
+            delayed(_fit_and_score)(clone(base_model).set_params(**candidates[c]), *folds[b][f])
+            for b, c, f in tasks
+        )
+        fold_scores = iter(fold_scores)
+
+        for b in range(len(batches)):
+            scores = np.array([[next(fold_scores) for _ in range(n_splits)] for _ in survivors[b]])
+            results = pd.DataFrame({
+                'iter': round_number,
+                'n_resources': len(folds[b][0][1]) + len(folds[b][0][3]),
+                'params': [candidates[c] for c in survivors[b]],
+            })
+            for f in range(n_splits):
+                results[f'split{f}_test_MCC'] = scores[:, f]
+            results['mean_test_MCC'] = scores.mean(axis=1)
+            cv_results[b].append(results)
+
+            # Keep the top 1/factor configs; failed fits rank last, ties broken by grid order.
+            n_keep = 1 if round_number == n_rounds - 1 else int(np.ceil(len(survivors[b]) / factor))
+            ranking = np.argsort(-np.nan_to_num(results['mean_test_MCC'].to_numpy(), nan=-np.inf), kind='mergesort')
+            survivors[b] = [survivors[b][i] for i in sorted(ranking[:n_keep])]
+
+    best_params = [candidates[survivor[0]] for survivor in survivors]
+    for params in best_params:
+        print(f"BEST PARAM: {params}")
+
+    best_estimators = Parallel(n_jobs=n_jobs)(
+        delayed(_refit)(clone(base_model).set_params(**params), X, y)
+        for params, (X, y) in zip(best_params, batches)
+    )
+    return list(zip(best_estimators, [pd.concat(results, ignore_index=True) for results in cv_results]))
+
+
+def _fit(model, X, y, sample_weight=None, compressed=None):
+    # compressed is the compress_fit_rows output of the fold, or None to fit on the full rows
+    if compressed is None:
+        return model.fit(X, y, sample_weight=sample_weight)
+    return compress.fit_compressed(model, X, y, sample_weight, compressed=compressed)[0]
+
+
+def _fit_and_score(model, X_train, y_train, X_val, y_val, sample_weight=None, compressed=None):
+    try:
+        _fit(model, X_train, y_train, sample_weight, compressed)
+    except Exception as e:
+        # GridSearchCV default error_score=np.nan
+        warnings.warn(f"Fit failed for {model.get_params()}: {e}")
+        return np.nan
+    return matthews_corrcoef(y_val, model.predict(X_val))
+
+
+def _refit(model, X, y, sample_weight=None, compressed=None):
+    return _fit(model, X, y, sample_weight, compressed)
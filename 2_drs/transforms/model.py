@@ -15,28 +15,78 @@ from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import StandardScaler, OneHotEncoder
 from sklearn.impute import SimpleImputer, KNNImputer
 from sklearn.ensemble import GradientBoostingClassifier
-from sklearn.model_selection import GridSearchCV
+from sklearn.model_selection import GridSearchCV, StratifiedKFold, StratifiedGroupKFold
 from sklearn.compose import make_column_transformer, ColumnTransformer
 from sklearn.metrics import make_scorer, accuracy_score, matthews_corrcoef
 from sklearn.linear_model import LogisticRegression
 
-def MLmodeling_hpo(preprocess_impute_1):
+# Grid search options
+PARAM_GRID = [
+    {'penalty': ['l1','l2'], 'C': [0.001, 0.1, 1, 10.0], 'solver':['saga','liblinear'], 'class_weight':['balanced'],'max_iter': [500],
+        'random_state':[2022]},
+    {'solver': ['newton-cg'], 'penalty': ['l2'], 'C': [0.001, 0.1, 1, 10.0], 'max_iter': [500, 1000],
+        'random_state': [2022]},
+    {'penalty': ['elasticnet'], 'C': [1, 0.1, 10.0], 'solver':['saga'], 'class_weight':['balanced'],'max_iter': [500],'l1_ratio':[0.25,0.5,0.75],
+        'random_state':[2022]}
+    ]
+
+DEBUG_PARAM_GRID = [
+    {'penalty': ['elasticnet'], 'C': [0.1], 'solver':['saga'], 'class_weight':['balanced'],'max_iter': [500],'l1_ratio':[0.75],
+    'random_state':[2022]}
+    ]
+
+# DRS search modes:
+#   'grid'     -- GridSearchCV per imputation (reference implementation)
+#   'parallel' -- CV folds fixed and cached once per imputation, (config, fold, imputation) fits run in parallel
+#   'halving'  -- successive halving: all configs scored on a small stratified subsample, the top fraction kept
+#                 while the subsample grows, in parallel as in 'parallel'
+SEARCH_MODES = ['grid', 'parallel', 'halving']
+
+# 'parallel' mode: fit on the distinct (feature row, target) patterns of each training fold, weighted by their
+# counts, when that removes at least half of the rows (fit_compressed in 2_ps/transforms/compress.py).
+# Off until the parallel_compress fast path of main_drs_equivalence.py has passed: liblinear and newton-cg
+# candidates are compressed, so predictions can move within its tolerance.
+COMPRESS_ROWS = False
+
+# Replace the solver of every grid configuration by the fastest solver that reaches the same objective on a
+# stratified subsample of the first training set (see transforms/solver_autotune.py)
+AUTOTUNE_SOLVER = False
+
+# Columns MLmodeling_hpo reads besides the drs-flagged features of 2_ps/data/configs.csv,
+# for loading its input from the feature store
+INPUT_COLUMNS = ['person_id', 'impute_id', 'treatment_group', 'elixhauser_mortality_index', 'total_count_distinct_day_mabs',
+    'ed_14d', 'inpt_14d', 'death_14d', 'ed_30d', 'inpt_30d', 'death_30d']
+
+# DRS outcomes that can be requested with the targets argument
+TARGETS = ['all_30d', 'all_14d', 'ed_30d', 'inpt_30d', 'death_30d', 'ed_14d', 'inpt_14d', 'death_14d']
+
+
+def MLmodeling_hpo(preprocess_impute_1, search_mode='grid', n_jobs=-1, targets=None, pooled=False, model_path=None):
     print("STARTING RUN")
     np.random.seed(0)
     df = preprocess_impute_1.reset_index(drop=True)
     print(df.shape)
+    assert search_mode in SEARCH_MODES, f"search_mode must be one of {SEARCH_MODES}"
+    # Pooled fit: a single DRS is trained on the stacked imputations, each row weighted 1/m so that every
+    # person counts once in total, with CV folds grouped by person_id, and it scores every imputation.
+    assert not (pooled and search_mode == 'halving'), "halving search does not support pooled fits"
+
 
-    
 # define targets
+    # With a list of targets (multi-target mode) every outcome is trained against the same preprocessing
+    # and CV splits, and the output gets a target_<target> and prediction_<target> column per outcome.
+    # target/prediction always hold the first (primary) outcome.
     target_val = 'all_30d'
-    if (target_val == 'all_30d'): 
-        df['target'] = np.where(((df['inpt_30d'] == 1) | (df['death_30d'] == 1)),1,0)
-    elif (target_val == 'all_14d'):
-        df['target'] = np.where(((df['ed_14d'] == 1) | (df['inpt_14d'] == 1) | (df['death_14d'] == 1)),1,0)
-    elif (target_val in ['ed_30d','inpt_30d','death_30d','ed_14d','inpt_14d','death_14d']):
-        df['target'] = np.where((df[target_val] == 1),1,0)
-    else:
-        df['target'] = np.where(((df['ed_30d'] == 1) | (df['inpt_30d'] == 1) | (df['death_30d'] == 1)),1,0)
+    multi_target = targets is not None
+    targets = list(targets) if multi_target else [target_val]
+    # define_target maps any other name to its fallback composite, so unknown names are rejected here
+    unknown = [target for target in targets if target not in TARGETS]
+    assert not unknown, f"Unknown targets {unknown}; choose from {TARGETS}"
+    assert len(targets), "targets must not be empty"
+    target_columns = ['target_' + target for target in targets]
+    for target, column in zip(targets, target_columns):
+        df[column] = define_target(df, target)
+    df['target'] = df[target_columns[0]]
     print(df.columns.tolist())
 
     # convert nulls to nan
@@ -56,14 +106,14 @@ def MLmodeling_hpo(preprocess_impute_1):
     print(numeric_features)
 
     excluded = ['age_group']
-    
+
     categorical_features = ['ethnicity','birthsex','pandemic_phase','most_recent_sarscov2_immunization_cat',
-        'health_system','diagnosis_epoch','smoke_status','race','marital_status','insurance_category','age_group'] 
+        'health_system','diagnosis_epoch','smoke_status','race','marital_status','insurance_category','age_group']
 
     cond_features = df.columns[df.columns.str.startswith(('condition'))].values.tolist()
     print('--------')
     print(cond_features)
-    
+
     binary_features = ['pregnant','out_of_state','obese','immunosuppressant_prev90days'] + cond_features
 
     all_features =  numeric_features + categorical_features + binary_features
@@ -71,107 +121,181 @@ def MLmodeling_hpo(preprocess_impute_1):
     target_features = ['days_to_emergency','days_to_inpatient','days_to_death','death_source_enc','ed_14d','inpt_14d',
         'death_14d','ed_30d','inpt_30d','death_30d']
     index_features = ['person_id']
-    
-    appended_data = []
-    for impute_id in df['impute_id'].unique().tolist():
+
+    debug = False
+    param_grid = DEBUG_PARAM_GRID if debug else PARAM_GRID
+
+    # Preprocess every imputation group (or, for a pooled fit, the stacked imputations,
+    # in the same row order). The transformed matrices are kept so that the parallel
+    # search can share them across all of its tasks.
+    impute_ids = df['impute_id'].unique().tolist()
+    if pooled:
+        impute_order = pd.Categorical(df['impute_id'], categories=impute_ids).codes
+        groups = [('pooled', df.iloc[np.argsort(impute_order, kind='stable')])]
+    else:
+        groups = [(impute_id, df[df['impute_id'] == impute_id]) for impute_id in impute_ids]
+
+    batches = []
+    for impute_id, batch_df in groups:
         print(impute_id)
 
-        batch_df = df[df['impute_id'] == impute_id]
         nontreated_df = batch_df[batch_df['treatment_group'] == 0]
 
         ids_train = nontreated_df.pop('person_id')
+        Y_train = nontreated_df[target_columns]
         y_train = nontreated_df.pop('target')
         batch_train = nontreated_df.pop('impute_id')
         X_train = nontreated_df[all_features]
 
         ids_test = batch_df.pop('person_id')
+        Y_test = batch_df[target_columns]
         y_test = batch_df.pop('target')
         treatment = batch_df.pop('treatment_group')
         batch_test = batch_df.pop('impute_id')
-        X_test = batch_df[all_features]       
-
-        # Create preprocessing Pipeline
-        numeric_transformer = Pipeline(
-            steps=[
-            ("imputer", SimpleImputer(strategy='constant',fill_value=0)), 
-            ("scaler", StandardScaler())
-            ]
-            )
-    
-        categorical_transformer = Pipeline(
-            steps=[
-            ('imputer', SimpleImputer(strategy='constant', fill_value='missing')),
-            ('encoder', OneHotEncoder(handle_unknown='error',drop='first'))
-            ]
-            )
-
-        binary_transformer = Pipeline(
-            steps=[
-        ('imputer', SimpleImputer(strategy='constant', fill_value=0)),
-        ]
-        )
-    
-        preprocessor = ColumnTransformer(
-        transformers=[
-            ("num", numeric_transformer, numeric_features),
-            ("cat", categorical_transformer, categorical_features),
-            ("binary",binary_transformer,binary_features),
-        ])
+        X_test = batch_df[all_features]
+
+        preprocessor = build_preprocessor(numeric_features, categorical_features, binary_features)
 
         x_train_transform = preprocessor.fit_transform(X_train)
         x_test_transform = preprocessor.transform(X_test)
 
         print(preprocessor.named_transformers_['cat'].named_steps['encoder'].get_feature_names(categorical_features))
 
-        # Grid search options
-        param_grid = [
-        {'penalty': ['l1','l2'], 'C': [0.001, 0.1, 1, 10.0], 'solver':['saga','liblinear'], 'class_weight':['balanced'],'max_iter': [500],
-            'random_state':[2022]},
-        {'solver': ['newton-cg'], 'penalty': ['l2'], 'C': [0.001, 0.1, 1, 10.0], 'max_iter': [500, 1000], 
-            'random_state': [2022]},
-        {'penalty': ['elasticnet'], 'C': [1, 0.1, 10.0], 'solver':['saga'], 'class_weight':['balanced'],'max_iter': [500],'l1_ratio':[0.25,0.5,0.75],
-            'random_state':[2022]}
-        ]
+        # CV splits are fixed once per imputation group (stratified on the primary
+        # target) and shared by every target. Pooled folds keep all copies of a person together.
+        if pooled:
+            splits = list(StratifiedGroupKFold(n_splits=5).split(x_train_transform, y_train, groups=ids_train))
+            sample_weight = np.full(len(y_train), 1 / len(impute_ids))
+        else:
+            splits = list(StratifiedKFold(n_splits=5).split(x_train_transform, y_train))
+            sample_weight = None
 
-        debug = False
-        if debug:
-            param_grid = [
-            {'penalty': ['elasticnet'], 'C': [0.1], 'solver':['saga'], 'class_weight':['balanced'],'max_iter': [500],'l1_ratio':[0.75],
-            'random_state':[2022]}
-            ]
-        
-        # Train a logistic regression model
-        grid_model = LogisticRegression(random_state=2022)
-        scoring = {"MCC":make_scorer(matthews_corrcoef)}
-        grid_search = GridSearchCV(grid_model, param_grid, cv=5,
-                                scoring=scoring,
-                                refit="MCC", return_train_score=True)  #roc_auc
-        if not debug:
-            grid_search.fit(x_train_transform, y_train)
-        
-            print(f"BEST PARAM: {grid_search.best_params_}")
-        if debug:
-            clf = LogisticRegression(penalty='elasticnet', C=0.1, solver='saga', class_weight='balanced', max_iter=500,l1_ratio=0.75, random_state=2022)
+        batches.append({
+            'impute_id': impute_id, 'preprocessor': preprocessor,
+            'x_train_transform': x_train_transform, 'Y_train': Y_train, 'splits': splits,
+            'sample_weight': sample_weight,
+            'x_test_transform': x_test_transform, 'Y_test': Y_test,
+            'ids_test': ids_test, 'batch_test': batch_test, 'treatment': treatment,
+        })
+
+    # One search problem per (imputation group, target).
+    search_batches = [
+        (batch['x_train_transform'], batch['Y_train'][column])
+        for batch in batches for column in target_columns
+    ]
+    search_splits = [batch['splits'] for batch in batches for _ in target_columns]
+    search_weights = [batch['sample_weight'] for batch in batches for _ in target_columns]
+
+    if AUTOTUNE_SOLVER:
+        from sklearn.model_selection import ParameterGrid
+        from transforms.ps_modules import load_ps_module
+        solver_autotune = load_ps_module('solver_autotune')
+        (x_tune, y_tune), w_tune = search_batches[0], search_weights[0]
+        fingerprint = solver_autotune.data_fingerprint(x_tune, y_tune, w_tune)
+        # Configurations that only differed by solver can become identical; keep the first of each, in grid order.
+        tuned = []
+        for params in ParameterGrid(param_grid):
+            params = solver_autotune.autotune_solver(params, x_tune, y_tune, sample_weight=w_tune,
+                                                     fingerprint=fingerprint)
+            if params not in tuned:
+                tuned.append(params)
+        param_grid = [{key: [value] for key, value in params.items()} for params in tuned]
+
+    # Select and fit the best model for each imputation group and target.
+    if search_mode in ['parallel', 'halving']:
+        from transforms.fold_search import fold_cached_search, halving_search
+        if search_mode == 'parallel':
+            results = fold_cached_search(search_batches, param_grid, n_jobs=n_jobs, splits=search_splits,
+                                         sample_weights=search_weights, compress_rows=COMPRESS_ROWS)
         else:
-            print(grid_search.best_params_)
-            clf = LogisticRegression(**grid_search.best_params_)
+            results = halving_search(search_batches, param_grid, n_jobs=n_jobs)
+        models = [best_estimator for best_estimator, _ in results]
+    else:
+        models = []
+        for (x_train_transform, y_train), splits, sample_weight in zip(search_batches, search_splits, search_weights):
+            # Train a logistic regression model
+            grid_model = LogisticRegression(random_state=2022)
+            scoring = {"MCC":make_scorer(matthews_corrcoef)}
+            grid_search = GridSearchCV(grid_model, param_grid, cv=splits,
+                                    scoring=scoring,
+                                    refit="MCC", return_train_score=True)  #roc_auc
+            grid_search.fit(x_train_transform, y_train, sample_weight=sample_weight)
+            print(f"BEST PARAM: {grid_search.best_params_}")
+
+            # refit="MCC" already trained the best configuration on the full training set.
+            clf = grid_search.best_estimator_
             print('printing best params')
             print(clf.get_params())
-        
-        clf.fit(x_train_transform, y_train)
+            models.append(clf)
 
-        scores = clf.predict_proba(x_test_transform)
+    # Persist the fitted preprocessors and models with their scoring plans (see transforms/scoring.py).
+    if model_path is not None:
+        from transforms.scoring import save_drs
+        fitted = [
+            (batch['impute_id'], target, batch['preprocessor'], models[i * len(targets) + j])
+            for i, batch in enumerate(batches) for j, target in enumerate(targets)
+        ]
+        save_drs(model_path, fitted, numeric_features, categorical_features, binary_features)
 
+    appended_data = []
+    for i, batch in enumerate(batches):
         final_df = pd.DataFrame()
-        final_df['person_id'] = ids_test
-        final_df['impute_id'] = batch_test
-        final_df['treatment_group'] = treatment 
-        final_df['target'] = y_test
-        final_df['prediction'] = scores[:,1]
+        final_df['person_id'] = batch['ids_test']
+        final_df['impute_id'] = batch['batch_test']
+        final_df['treatment_group'] = batch['treatment']
+        for j, (target, column) in enumerate(zip(targets, target_columns)):
+            clf = models[i * len(targets) + j]
+            scores = clf.predict_proba(batch['x_test_transform'])
+            if j == 0:
+                final_df['target'] = batch['Y_test'][column]
+                final_df['prediction'] = scores[:,1]
+            if multi_target:
+                final_df['target_' + target] = batch['Y_test'][column]
+                final_df['prediction_' + target] = scores[:,1]
         appended_data.append(final_df)
     appended_data = pd.concat(appended_data)
 
     return appended_data
 
 
-    
+def define_target(df, target_val):
+    # Composite outcomes combine ED, inpatient and death flags within 14 or 30 days.
+    if (target_val == 'all_30d'):
+        return np.where(((df['inpt_30d'] == 1) | (df['death_30d'] == 1)),1,0)
+    elif (target_val == 'all_14d'):
+        return np.where(((df['ed_14d'] == 1) | (df['inpt_14d'] == 1) | (df['death_14d'] == 1)),1,0)
+    elif (target_val in ['ed_30d','inpt_30d','death_30d','ed_14d','inpt_14d','death_14d']):
+        return np.where((df[target_val] == 1),1,0)
+    else:
+        return np.where(((df['ed_30d'] == 1) | (df['inpt_30d'] == 1) | (df['death_30d'] == 1)),1,0)
+
+
+def build_preprocessor(numeric_features, categorical_features, binary_features):
+    # Create preprocessing Pipeline
+    numeric_transformer = Pipeline(
+        steps=[
+        ("imputer", SimpleImputer(strategy='constant',fill_value=0)),
+        ("scaler", StandardScaler())
+        ]
+        )
+
+    categorical_transformer = Pipeline(
+        steps=[
+        ('imputer', SimpleImputer(strategy='constant', fill_value='missing')),
+        ('encoder', OneHotEncoder(handle_unknown='error',drop='first'))
+        ]
+        )
+
+    binary_transformer = Pipeline(
+        steps=[
+    ('imputer', SimpleImputer(strategy='constant', fill_value=0)),
+    ]
+    )
+
+    preprocessor = ColumnTransformer(
+    transformers=[
+        ("num", numeric_transformer, numeric_features),
+        ("cat", categorical_transformer, categorical_features),
+        ("binary",binary_transformer,binary_features),
+    ])
+    return preprocessor
@@ -0,0 +1,31 @@
+##################################################
+## Project: Real World Evidence to Accelerate COVID-19 Therapeutics
+## Contract No.: 75FCMC18D0047
+## Purpose: This function loads the self-contained 2_ps/transforms modules shared with the DRS step
+## Date: May 2022
+## Developers: Jerez Te
+## Copyright 2022, The MITRE Corporation
+## Approved for Public Release; Distribution Unlimited. Public Release Case Number 22-1741.
+##################################################
+
+import importlib.util
+import sys
+from pathlib import Path
+
+PS_TRANSFORMS = Path(__file__).resolve().parents[2] / '2_ps' / 'transforms'
+
+
+def load_ps_module(name):
+    # 2_ps/transforms/<name>.py loaded from its file under the name ps_transforms.<name>: both steps call their
+    # package transforms, so it cannot be imported. Only modules without transforms imports can be loaded.
+    module_name = f'ps_transforms.{name}'
+    if module_name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(module_name, PS_TRANSFORMS / f'{name}.py')
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[module_name] = module
+        try:
+            spec.loader.exec_module(module)
+        except BaseException:
+            del sys.modules[module_name]
+            raise
+    return sys.modules[module_name]
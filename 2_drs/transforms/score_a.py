@@ -1,4 +1,3 @@
-
 ##################################################
 ## Project: Real World Evidence to Accelerate COVID-19 Therapeutics
 ## Contract No.: 75FCMC18D0047
@@ -9,34 +8,112 @@
 ## Approved for Public Release; Distribution Unlimited. Public Release Case Number 22-1741.
 ##################################################
 
-from sklearn.metrics import make_scorer, accuracy_score, matthews_corrcoef, confusion_matrix, precision_score, recall_score
 import numpy as np 
 import pandas as pd
-def drs_metrics(agg_results):
-    df = agg_results
-    results = []
-    for impute in df['impute_id'].unique():
+
+from transforms.ps_modules import load_ps_module
+
+ps_metrics = load_ps_module('metrics')
+
+# Confusion matrix cells, in sklearn's confusion_matrix(...).ravel() order, and the metrics
+# (precision is the PPV); threshold_sweep (2_ps/transforms/metrics.py) uses the same columns
+CONFUSION_COLUMNS = ['tn', 'fp', 'fn', 'tp']
+METRIC_COLUMNS = ['precision', 'recall', 'f1', 'mcc']
+
+
+def drs_metrics(agg_results, strata=None, threshold=0.5):
+    # Confusion counts for every (impute_id, treatment_group, *strata) cell are
+    # computed in one pass; the all/untreated/treated rows of each imputation
+    # group are sums of those cells.
+    # strata: optional list of extra columns of agg_results (e.g. health_system,
+    # pandemic_phase) to also report metrics by.
+    strata = list(strata) if strata is not None else []
+    by = ['impute_id', 'treatment_group'] + strata
+    cells = confusion_counts(agg_results, by, threshold)
+
+    by_impute = cells.groupby(['impute_id', 'treatment_group'], sort=False)[CONFUSION_COLUMNS].sum()
+    for impute in agg_results['impute_id'].unique():
         print(f'ALL POPULATION FOR IMPUTE ID: {impute}')
-        new_df = df[df['impute_id'] == impute].reset_index(drop=True)
-        conf_mat = score(new_df)
-        results.append(conf_mat)
+        print_metrics(by_impute.loc[impute].sum())
         print('##### UNTREATED ####')
-        untreated = new_df[new_df['treatment_group'] == 0].reset_index(drop=True)
-        score(untreated)
+        print_metrics(by_impute.loc[(impute, 0)] if (impute, 0) in by_impute.index else None)
         print('##### TREATED ####')
-        treated = new_df[new_df['treatment_group'] == 1].reset_index(drop=True)
-        score(treated)
-    results = pd.DataFrame(results)
-    results.columns = ['tn', 'fp', 'fn', 'tp']
+        print_metrics(by_impute.loc[(impute, 1)] if (impute, 1) in by_impute.index else None)
+
+    if strata:
+        print(confusion_metrics(cells))
+
+    results = by_impute.groupby(level='impute_id', sort=False).sum().reset_index(drop=True)
     print(results.describe())
     return results
-    
-def score(df):
-    y_pred = np.where(df['prediction'] >= 0.5, 1, 0)
-    y_test = df['target']
-    conf_mat = confusion_matrix(y_test,y_pred).ravel()
-    print(conf_mat , "tn, fp, fn, tp")
-    print(f'MCC: {matthews_corrcoef(y_test, y_pred)}')
-    print(f'PPV: {precision_score(y_test, y_pred)}')
-    print(f'Recall: {recall_score(y_test, y_pred)}')
-    return conf_mat
+
+
+def score(df, threshold=0.5):
+    conf_mat = confusion_counts(df, [], threshold)[CONFUSION_COLUMNS].iloc[0]
+    print_metrics(conf_mat)
+    return conf_mat.to_numpy()
+
+
+def confusion_counts(df, by, threshold=0.5):
+    '''
+    Confusion counts (tn, fp, fn, tp) of prediction >= threshold against target for every
+    observed combination of the by columns, from a single bincount over the encoded group keys.
+    Nulls in a by column (e.g. day0_who_variant) form their own stratum. by=[] gives one row for
+    the whole frame.
+    '''
+    y_true = df['target'].to_numpy().astype(np.int64)
+    y_pred = (df['prediction'].to_numpy() >= threshold).astype(np.int64)
+
+    # observed combinations only, as in threshold_sweep; MultiIndex.factorize keeps null levels
+    if by:
+        key, levels = pd.MultiIndex.from_frame(df[by]).factorize(sort=True)
+        n_groups = len(levels)
+    else:
+        key, n_groups = np.zeros(len(df), dtype=np.int64), 1
+
+    counts = np.bincount(4 * key + 2 * y_true + y_pred, minlength=4 * n_groups).reshape(n_groups, 4)
+    cells = pd.DataFrame(counts, columns=CONFUSION_COLUMNS)
+    if by:
+        keys = levels.to_frame(index=False)
+        keys.columns = by
+        cells = pd.concat([keys, cells], axis=1)
+    return cells
+
+
+def threshold_sweep(df, by=('impute_id',), metric='mcc'):
+    '''
+    Confusion counts and metrics of prediction >= threshold against target for every distinct prediction value
+    used as the threshold, for every group of the by columns at once (threshold_sweep of
+    2_ps/transforms/metrics.py).
+    returns: (curve, best) where curve has one row per (group, threshold), with thresholds in decreasing
+    order within each group, and best has the row of each group maximizing metric (the highest such
+    threshold on ties).
+    '''
+    by = list(by)
+    return ps_metrics.threshold_sweep(df['target'], df['prediction'], df[by] if by else None, metric)
+
+
+def confusion_metrics(counts):
+    # precision (PPV), recall, F1 and MCC for every row of a table of confusion counts. As in sklearn,
+    # a metric with a zero denominator is reported as 0.
+    counts = counts.copy()
+    tn, fp, fn, tp = (counts[col].to_numpy(dtype=np.float64) for col in CONFUSION_COLUMNS)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mcc = (tp * tn - fp * fn) / np.sqrt((tp + fp) * (tp + fn) * (tn + fp) * (tn + fn))
+        ppv = tp / (tp + fp)
+        recall = tp / (tp + fn)
+        f1 = 2 * tp / (2 * tp + fp + fn)
+    for col, values in zip(METRIC_COLUMNS, [ppv, recall, f1, mcc]):
+        counts[col] = np.nan_to_num(values, nan=0.0, posinf=0.0, neginf=0.0)
+    return counts
+
+
+def print_metrics(conf_mat):
+    if conf_mat is None:
+        print('no patients')
+        return
+    metrics = confusion_metrics(pd.DataFrame([conf_mat[CONFUSION_COLUMNS]])).iloc[0]
+    print(conf_mat[CONFUSION_COLUMNS].to_numpy().astype(int), "tn, fp, fn, tp")
+    print(f'MCC: {metrics["mcc"]}')
+    print(f'PPV: {metrics["precision"]}')
+    print(f'Recall: {metrics["recall"]}')
@@ -0,0 +1,131 @@
+##################################################
+## Project: Real World Evidence to Accelerate COVID-19 Therapeutics
+## Contract No.: 75FCMC18D0047
+## Purpose: This function persists fitted DRS models and scores new patients in batches
+## Date: May 2022
+## Developers: Jerez Te
+## Copyright 2022, The MITRE Corporation
+## Approved for Public Release; Distribution Unlimited. Public Release Case Number 22-1741.
+##################################################
+
+import json
+from pathlib import Path
+
+import joblib
+import numpy as np
+import pandas as pd
+
+
+def compile_drs(preprocessor, clf, numeric_features, categorical_features, binary_features):
+    '''
+    Fold a fitted build_preprocessor ColumnTransformer and LogisticRegression into a scoring plan:
+    - numeric features: the StandardScaler is folded into the weights and intercept (nulls are 0 before scaling)
+    - binary features: raw weights (nulls are 0)
+    - categorical features: the category-index map of every feature and a weight table indexed by it, with 0
+      for the dropped baseline and a trailing 0 used for unknown categories
+    so that the log odds of a batch are dense @ weights + intercept + the looked-up categorical weights.
+    returns: a JSON-serializable dict
+    '''
+    coef = clf.coef_.ravel()
+    intercept = float(clf.intercept_[0])
+
+    scaler = preprocessor.named_transformers_['num'].named_steps['scaler']
+    encoder = preprocessor.named_transformers_['cat'].named_steps['encoder']
+
+    n_numeric = len(numeric_features)
+    numeric_coef = coef[:n_numeric] / scaler.scale_
+    intercept -= float(np.sum(numeric_coef * scaler.mean_))
+
+    position = n_numeric
+    categories, tables = [], []
+    for j, levels in enumerate(encoder.categories_):
+        drop = encoder.drop_idx_[j] if encoder.drop_idx_ is not None else None
+        table = np.zeros(len(levels) + 1)
+        for k in range(len(levels)):
+            if drop is not None and k == drop:
+                continue
+            table[k] = coef[position]
+            position += 1
+        categories.append([level.item() if hasattr(level, 'item') else level for level in levels])
+        tables.append(table.tolist())
+
+    binary_coef = coef[position:]
+    assert len(binary_coef) == len(binary_features), "Coefficients do not match the preprocessor output."
+
+    return {
+        'numeric_features': list(numeric_features),
+        'binary_features': list(binary_features),
+        'categorical_features': list(categorical_features),
+        'dense_weights': np.r_[numeric_coef, binary_coef].tolist(),
+        'intercept': intercept,
+        'categories': categories,
+        'category_weights': tables,
+    }
+
+
+def save_drs(path, fitted, numeric_features, categorical_features, binary_features):
+    # fitted: list of (impute_id, target, preprocessor, clf). Each fitted pair is kept with joblib
+    # and all scoring plans are written together to drs_plans.json.
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    plans = []
+    for impute_id, target, preprocessor, clf in fitted:
+        joblib.dump((preprocessor, clf), path / f'drs_{target}_{impute_id}.joblib')
+        plan = compile_drs(preprocessor, clf, numeric_features, categorical_features, binary_features)
+        plan.update({'impute_id': impute_id if isinstance(impute_id, str) else int(impute_id), 'target': target})
+        plans.append(plan)
+    with open(path / 'drs_plans.json', 'w') as f:
+        json.dump(plans, f)
+    return plans
+
+
+def load_drs(path, target=None):
+    # Scoring plans saved by save_drs, optionally for a single target.
+    with open(Path(path) / 'drs_plans.json') as f:
+        plans = json.load(f)
+    if target is not None:
+        plans = [plan for plan in plans if plan['target'] == target]
+    for plan in plans:
+        plan['dense_weights'] = np.asarray(plan['dense_weights'])
+        plan['category_weights'] = [np.asarray(table) for table in plan['category_weights']]
+        plan['category_index'] = [pd.Index(levels) for levels in plan['categories']]
+    return plans
+
+
+def score_drs(plans, df, handle_unknown='error'):
+    '''
+    Score a batch of patients with every plan from load_drs.
+    Categorical values are mapped to their category index (nulls become 'missing', as in the fitted
+    SimpleImputer). Unknown categories raise, as the fitted OneHotEncoder does, unless handle_unknown='ignore',
+    which scores them like the baseline category.
+    returns: DataFrame with a drs_<target>_<impute_id> column per plan and, per target, prediction_<target>,
+    the mean over imputation groups
+    '''
+    scores = {}
+    dense_cache, value_cache = {}, {}
+    for plan in plans:
+        # Plans from the same fit share their feature lists, so the dense block is built once.
+        key = (tuple(plan['numeric_features']), tuple(plan['binary_features']))
+        if key not in dense_cache:
+            dense_cache[key] = np.nan_to_num(
+                df[plan['numeric_features'] + plan['binary_features']].to_numpy(dtype=np.float64), nan=0.0
+            )
+        log_odds = dense_cache[key] @ plan['dense_weights'] + plan['intercept']
+
+        for feature, index, table in zip(plan['categorical_features'], plan['category_index'], plan['category_weights']):
+            if feature not in value_cache:
+                value_cache[feature] = df[feature].astype(object).where(df[feature].notna(), 'missing')
+            values = value_cache[feature]
+            codes = index.get_indexer(values)
+            if handle_unknown == 'error' and (codes < 0).any():
+                unknown = pd.unique(values[codes < 0])
+                raise ValueError(f"Found unknown categories {list(unknown)} in column {feature}")
+            log_odds += table[codes]
+
+        scores[f"drs_{plan['target']}_{plan['impute_id']}"] = 1 / (1 + np.exp(-log_odds))
+
+    results = pd.DataFrame(scores, index=df.index)
+    for target in dict.fromkeys(plan['target'] for plan in plans):
+        columns = [f"drs_{target}_{plan['impute_id']}" for plan in plans if plan['target'] == target]
+        results[f'prediction_{target}'] = results[columns].mean(axis=1)
+    return results
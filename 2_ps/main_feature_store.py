@@ -0,0 +1,26 @@
+##################################################
+## Project: Real World Evidence to Accelerate COVID-19 Therapeutics
+## Contract No.: 75FCMC18D0047
+## Purpose: This script encodes the imputed tables into feature stores for 2_drs and 2_ps
+## Date: May 2022
+## Developers: Alexander Wood
+## Copyright 2022, The MITRE Corporation
+## Approved for Public Release; Distribution Unlimited. Public Release Case Number 22-1741.
+##################################################
+
+import pandas as pd
+from transforms.feature_store import build_feature_store
+from pathlib import Path
+
+current = Path.cwd()
+
+configs = pd.read_csv(current / '2_ps' / 'data' / 'configs.csv')
+
+# One store per imputed table, in 1_imputation/data/feature_store/<table>/.
+# Each is only rebuilt when its csv or configs.csv changed.
+for table in ['mab_patient_effect_imputed_no_treatment', 'mab_patient_effect_imputed']:
+    build_feature_store(
+        current / '1_imputation' / 'data' / f'{table}.csv',
+        configs,
+        current / '1_imputation' / 'data' / 'feature_store' / table
+    )
@@ -18,31 +18,83 @@ from transforms import ML_LR
 from transforms import ML_RF
 from transforms import ML_GBT
 from transforms import merge_models
+from transforms.merge_models import check_merged
+from transforms.ps_bootstrap import save_design_matrices
+from transforms.feature_store import load_features
+from transforms.async_writer import AsyncWriter
+from transforms.prediction_store import create_prediction_store, materialize_wide
+from transforms.keys import intern_keys, decode_keys, restore_key_dtypes, save_dictionary
 from pathlib import Path
 
 current = Path.cwd()
 
 # Load the raw data and configs.
-df = pd.read_csv('1_imputation/data/mab_patient_effect_imputed.csv')
+# Read the ps-flagged columns from the feature store built by 2_ps/main_feature_store.py
+# instead of parsing the full csv.
+use_feature_store = True
+if use_feature_store:
+    df = load_features(current / '1_imputation' / 'data' / 'feature_store' / 'mab_patient_effect_imputed', 'ps')
+else:
+    df = pd.read_csv('1_imputation/data/mab_patient_effect_imputed.csv')
 configs = pd.read_csv(current / '2_ps' /'data' / 'configs.csv')
 
+# Intermediate outputs are written on a background thread while the next steps run.
+# Compression (e.g. 'gzip') appends its suffix to the file names read by the later steps.
+output_compression = None
+writer = AsyncWriter(compression=output_compression)
+
 # Parse configs
 configs_df = get_configs(df, configs, INDEX_ID, INDEX_IMPUTATION_ID, INDEX_IMPUTATION_FLAG, INDEX_COLUMNS, TARGET_COLUMNS, COVID_COLUMN_PATTERN, CONDITION_COLUMN_PATTERN, RUN_DEBUG)
 
 # Parse relevant confounders from upstream output
-df = get_dataframe(df, configs_df, RUN_DEBUG)
+df = get_dataframe(df, configs_df, RUN_DEBUG, VALIDATION_SAMPLE)
 
 # Write out this intermediate output for use in covariate balance step
-df.to_csv(current / '2_ps' / 'data' / 'get_dataframe.csv', index=False)
+writer.write_csv(df, current / '2_ps' / 'data' / 'get_dataframe.csv', index=False)
+
+# Replace person_id by dense int32 codes for the rest of the stage, so that the
+# model inputs are all numeric and joins and sorts are on integers. The id
+# dictionary is written once; ids are decoded again in merge_models.csv.
+# Set use_integer_keys = False to carry the person_id strings instead.
+use_integer_keys = True
+dictionary_path = None
+if use_integer_keys:
+    person_codes, person_dictionary = intern_keys(df[INDEX_ID])
+    dictionary_path = current / '2_ps' / 'data' / 'person_ids.npy'
+    save_dictionary(person_dictionary, dictionary_path)
+    df = df.assign(**{INDEX_ID: person_codes})
 
 # Perform model training preprocessing
 df = ML_setup(df, configs_df, INDEX_IMPUTATION_ID,  RUN_CHECKS, RUN_DEBUG)
+if use_integer_keys:
+    df = restore_key_dtypes(df, INDEX_ID, INDEX_IMPUTATION_ID)
+
+# Persist the design matrix of each imputation group for 2_ps/main_ps_bootstrap.py
+save_design_matrices(df, current / '2_ps' / 'data' / 'design', INDEX_ID, INDEX_IMPUTATION_ID, INDEX_COLUMNS, TARGET_COLUMNS, dictionary_path)
+
+# Append the scores of every fit to the long-format prediction store as soon as
+# it completes, and build merge_models.csv from the store (float32 scores).
+# Set use_prediction_store = False to merge the model outputs in memory instead.
+use_prediction_store = True
+prediction_store = current / '2_ps' / 'data' / 'predictions' if use_prediction_store else None
+if use_prediction_store:
+    create_prediction_store(df, prediction_store, INDEX_ID, INDEX_IMPUTATION_ID, TARGET_COLUMNS, dictionary_path)
 
 # Fit candidate models
-df_lr = ML_LR(df, INDEX_ID, INDEX_IMPUTATION_ID, INDEX_COLUMNS, TARGET_COLUMNS, RUN_CHECKS, RUN_DEBUG)
-df_rf = ML_RF(df, INDEX_ID, INDEX_IMPUTATION_ID, INDEX_COLUMNS, TARGET_COLUMNS, RUN_CHECKS, RUN_DEBUG)
-df_gbt = ML_GBT(df, INDEX_ID, INDEX_IMPUTATION_ID, INDEX_COLUMNS, TARGET_COLUMNS, RUN_CHECKS, RUN_DEBUG)
+df_lr = ML_LR(df, INDEX_ID, INDEX_IMPUTATION_ID, INDEX_COLUMNS, TARGET_COLUMNS, RUN_CHECKS, RUN_DEBUG, prediction_store)
+df_rf = ML_RF(df, INDEX_ID, INDEX_IMPUTATION_ID, INDEX_COLUMNS, TARGET_COLUMNS, RUN_CHECKS, RUN_DEBUG, prediction_store)
+df_gbt = ML_GBT(df, INDEX_ID, INDEX_IMPUTATION_ID, INDEX_COLUMNS, TARGET_COLUMNS, RUN_CHECKS, RUN_DEBUG, prediction_store)
 
 # Combine outputs and write out results
-df = merge_models(df_lr, df_rf, df_gbt, INDEX_ID, INDEX_IMPUTATION_ID, RUN_CHECKS, RUN_DEBUG)
-df.to_csv(current / '2_ps' / 'data' / 'merge_models.csv', index=False)
+if use_prediction_store:
+    df = materialize_wide(prediction_store)
+    if RUN_CHECKS:
+        check_merged(df, [df_lr, df_rf, df_gbt], INDEX_ID, INDEX_IMPUTATION_ID)
+else:
+    df = merge_models(df_lr, df_rf, df_gbt, INDEX_ID, INDEX_IMPUTATION_ID, RUN_CHECKS, RUN_DEBUG)
+    if use_integer_keys:
+        df[INDEX_ID] = decode_keys(df[INDEX_ID], person_dictionary)
+writer.write_csv(df, current / '2_ps' / 'data' / 'merge_models.csv', index=False)
+
+# Wait for every output to be written
+writer.close()
@@ -0,0 +1,38 @@
+##################################################
+## Project: Real World Evidence to Accelerate COVID-19 Therapeutics
+## Contract No.: 75FCMC18D0047
+## Purpose: This script computes Poisson-bootstrap confidence intervals for the PS-weighted treatment effect
+## Date: May 2022
+## Developers: Alexander Wood, Lauren D'Arinzo
+## Copyright 2022, The MITRE Corporation
+## Approved for Public Release; Distribution Unlimited. Public Release Case Number 22-1741.
+##################################################
+
+import pandas as pd
+from transforms.global_utils import *
+from transforms.ps_bootstrap import ps_bootstrap, bootstrap_intervals
+from pathlib import Path
+
+# Bootstrap settings
+N_REPLICATES = 1000
+BLOCK_SIZE = 25
+N_JOBS = None  # all available cores
+OUTCOME_COLUMNS = ['ed_14d', 'inpt_14d', 'death_14d', 'death_inpt_14day',
+                   'ed_30d', 'inpt_30d', 'death_30d', 'death_inpt_30day']
+
+if __name__ == '__main__':
+    current = Path.cwd()
+
+    # Best model as selected in the covariate balance step (most frequent best model across metrics).
+    balance = pd.read_csv(current / '3_ps-covariate-balance' / 'data' / 'aggregate_covariate_balance_model_comparison.csv')
+    best_model = balance['best_model'].value_counts().index[0]
+    print("Bootstrapping selected model:", best_model)
+
+    # Outcomes from the imputed table; the design matrices are persisted by main_ps.py.
+    outcomes = pd.read_csv('1_imputation/data/mab_patient_effect_imputed.csv',
+                           usecols=[INDEX_ID, INDEX_IMPUTATION_ID] + OUTCOME_COLUMNS)
+
+    replicates = ps_bootstrap(current / '2_ps' / 'data' / 'design', outcomes, best_model,
+                              n_replicates=N_REPLICATES, block_size=BLOCK_SIZE, n_jobs=N_JOBS)
+    replicates.to_csv(current / '2_ps' / 'data' / 'bootstrap_replicates.csv', index=False)
+    bootstrap_intervals(replicates).to_csv(current / '2_ps' / 'data' / 'bootstrap_ci.csv', index=False)
@@ -0,0 +1,68 @@
+##################################################
+## Project: Real World Evidence to Accelerate COVID-19 Therapeutics
+## Contract No.: 75FCMC18D0047
+## Purpose: This script checks that the fast paths of the PS step reproduce the reference scores
+## Date: May 2022
+## Developers: Alexander Wood
+## Copyright 2022, The MITRE Corporation
+## Approved for Public Release; Distribution Unlimited. Public Release Case Number 22-1741.
+##################################################
+
+# Usage: python 2_ps/main_ps_equivalence.py [fast_path ...]
+# Without arguments every fast path of transforms/equivalence.py is checked.
+# Exits with status 1 when a fast path fails its tolerances.
+
+import sys
+import pandas as pd
+from transforms.global_utils import *
+from transforms import get_configs
+from transforms import get_dataframe
+from transforms.feature_store import load_features
+from transforms.equivalence import FAST_PATHS, synthetic_cohort, check_fast_paths
+from pathlib import Path
+
+current = Path.cwd()
+
+# Fast paths to check.
+names = sys.argv[1:] or list(FAST_PATHS)
+unknown = [name for name in names if name not in FAST_PATHS]
+assert not unknown, f"Unknown fast paths {unknown}; choose from {list(FAST_PATHS)}."
+fast_paths = {name: FAST_PATHS[name] for name in names}
+
+# Number of patients of the synthetic cohorts resampled from the toy data,
+# to see how the differences and speedups scale.
+synthetic_sizes = [5000, 20000]
+
+# Load the raw data and configs, as main_ps.py does.
+use_feature_store = True
+if use_feature_store:
+    df = load_features(current / '1_imputation' / 'data' / 'feature_store' / 'mab_patient_effect_imputed', 'ps')
+else:
+    df = pd.read_csv('1_imputation/data/mab_patient_effect_imputed.csv')
+configs = pd.read_csv(current / '2_ps' /'data' / 'configs.csv')
+
+cohorts = {'toy': df}
+for n_persons in synthetic_sizes:
+    cohorts[f'synthetic_{n_persons}'] = synthetic_cohort(df, n_persons, INDEX_ID)
+
+reports, summaries = [], []
+for cohort, cohort_df in cohorts.items():
+    configs_df = get_configs(cohort_df, configs, INDEX_ID, INDEX_IMPUTATION_ID, INDEX_IMPUTATION_FLAG, INDEX_COLUMNS, TARGET_COLUMNS, COVID_COLUMN_PATTERN, CONDITION_COLUMN_PATTERN, RUN_DEBUG)
+    cohort_df = get_dataframe(cohort_df, configs_df, RUN_DEBUG, VALIDATION_SAMPLE)
+    report, summary = check_fast_paths(cohort_df, configs_df, fast_paths, INDEX_ID, INDEX_IMPUTATION_ID, INDEX_COLUMNS, TARGET_COLUMNS, cohort)
+    reports.append(report)
+    summaries.append(summary)
+
+report = pd.concat(reports, ignore_index=True)
+summary = pd.concat(summaries, ignore_index=True)
+report.to_csv(current / '2_ps' / 'data' / 'equivalence_report.csv', index=False)
+summary.to_csv(current / '2_ps' / 'data' / 'equivalence_summary.csv', index=False)
+
+print(summary[['cohort', 'fast_path', 'n_failed', 'max_abs_diff', 'max_rank_diff', 'best_model_match', 'n_compressed_fits', 'speedup', 'passed']].to_string(index=False))
+if not summary['passed'].all():
+    # Untested fast paths did not run their fast code (e.g. no compressed fits), so they fail as well.
+    for label, rows in [("Failed", summary['tested'] & ~summary['passed']), ("Untested", ~summary['tested'])]:
+        if rows.any():
+            failed = summary.loc[rows, ['cohort', 'fast_path']].itertuples(index=False)
+            print(f"{label}: " + ", ".join(f"{cohort}/{name}" for cohort, name in failed))
+    sys.exit(1)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+##################################################
+## Project: Real World Evidence to Accelerate COVID-19 Therapeutics
+## Contract No.: 75FCMC18D0047
+## Purpose: This script runs the PS data preparation per health-system shard
+## Date: May 2022
+## Developers: Alexander Wood
+## Copyright 2022, The MITRE Corporation
+## Approved for Public Release; Distribution Unlimited. Public Release Case Number 22-1741.
+##################################################
+
+# USAGE:
+#   python 2_ps/main_ps_shard.py                  split, process the shards with local workers, merge
+#   python 2_ps/main_ps_shard.py --split          split the imputed csv and queue one task per health system
+#   python 2_ps/main_ps_shard.py --worker         process queued shards (run on any node sharing 2_ps/data/shards)
+#   python 2_ps/main_ps_shard.py --merge          merge the shard summaries
+
+import argparse
+import json
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+
+from transforms.global_utils import *
+from transforms import get_configs
+from transforms.shard import (
+    enqueue, run_worker, requeue_stale, queue_status,
+    split_by_health_system, merge_summaries, summary_statistics)
+
+current = Path.cwd()
+shard_path = current / '2_ps' / 'data' / 'shards'
+queue_path = shard_path / 'queue'
+source = current / '1_imputation' / 'data' / 'mab_patient_effect_imputed.csv'
+
+# rows read at a time while splitting the imputed csv
+chunk_size = 100000
+
+# running tasks older than this (seconds) are assumed lost and queued again
+stale_after = 3600
+
+
+def split():
+    # get_configs only needs the header of the input table.
+    header = pd.read_csv(source, nrows=0)
+    configs = pd.read_csv(current / '2_ps' / 'data' / 'configs.csv')
+    configs_df = get_configs(header, configs, INDEX_ID, INDEX_IMPUTATION_ID, INDEX_IMPUTATION_FLAG, INDEX_COLUMNS, TARGET_COLUMNS, COVID_COLUMN_PATTERN, CONDITION_COLUMN_PATTERN, RUN_DEBUG)
+    # Start from an empty shard directory, so no shard, summary or queued
+    # task of an earlier run is merged with this one.
+    shutil.rmtree(shard_path, ignore_errors=True)
+    shard_path.mkdir(parents=True, exist_ok=True)
+    configs_df.to_csv(shard_path / 'configs_df.csv', index=False)
+
+    shards, fill_values = split_by_health_system(source, shard_path, configs_df, chunk_size)
+    enqueue(queue_path, {
+        name: {'shard': name, 'path': path, 'out_dir': str(shard_path), 'fill_values': fill_values}
+        for name, path in shards.items()
+    })
+    print(f"Queued {len(shards)} health-system shards: {sorted(shards)}")
+
+
+def work():
+    requeue_stale(queue_path, stale_after)
+    configs_df = pd.read_csv(shard_path / 'configs_df.csv')
+    return run_worker(queue_path, configs_df, INDEX_ID, INDEX_IMPUTATION_ID, INDEX_COLUMNS, TARGET_COLUMNS)
+
+
+def merge():
+    status = queue_status(queue_path)
+    assert status['todo'] == status['running'] == status['failed'] == 0, \
+        f"Shards are not all processed: {status}"
+
+    # Only the shards queued by the last split.
+    summaries = {}
+    for task in sorted((queue_path / 'done').glob('*.json')):
+        with open(shard_path / f'summary_{task.stem}.json') as f:
+            summary = json.load(f)
+        summaries[summary['shard']] = summary
+
+    # Scaling statistics within each health system (as StratifiedScaler
+    # computes them) and over all health systems (as StandardScaler does).
+    merged = merge_summaries(summaries.values())
+    scaling = pd.concat(
+        [summary_statistics(summary).assign(health_system=name) for name, summary in summaries.items()] +
+        [summary_statistics(merged).assign(health_system='all')],
+        ignore_index=True
+    )
+    columns = ['health_system', 'impute_id', 'variable', 'n', 'mean', 'std', 'std_pop']
+    scaling[columns].to_csv(shard_path / 'scaling.csv', index=False)
+
+    # Unweighted covariate balance over all health systems.
+    balance = summary_statistics(merged)
+    balance[['impute_id', 'variable', 'mean_treated', 'mean_untreated', 'smd']]\
+        .to_csv(shard_path / 'balance.csv', index=False)
+
+    with open(shard_path / 'summary.json', 'w') as f:
+        json.dump(merged, f)
+    print(f"Merged {len(summaries)} shards, {merged['n_rows']} rows.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the PS data preparation per health-system shard.')
+    parser.add_argument('src', nargs='?', help='repository root (unused; run from the root)')
+    parser.add_argument('--split', action='store_true', help='split the imputed csv and queue the shards')
+    parser.add_argument('--worker', action='store_true', help='process queued shards until none is left')
+    parser.add_argument('--merge', action='store_true', help='merge the shard summaries')
+    parser.add_argument('--jobs', type=int, default=None, help='local worker processes when running all steps')
+    args = parser.parse_args()
+
+    if args.split:
+        split()
+    elif args.worker:
+        work()
+    elif args.merge:
+        merge()
+    else:
+        split()
+        n_jobs = args.jobs or min(len(list((queue_path / 'todo').glob('*.json'))), 8) or 1
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            for future in [executor.submit(work) for _ in range(n_jobs)]:
+                future.result()
+        merge()
@@ -9,6 +9,7 @@
 ##################################################
 
 from sklearn.ensemble import GradientBoostingClassifier
+from scipy.special import expit
 
 import re
 import warnings
@@ -19,6 +20,13 @@ import numpy as np
 from collections import namedtuple
 from itertools import product
 
+from transforms.validate import probability_rules, validate, assert_valid
+from transforms.ML_setup import ORDINAL_SUFFIX
+from transforms.balance import binary_columns, pooled_sd, mean_abs_smd
+from transforms.prediction_store import append_predictions
+from transforms.case_control import (
+    case_control, predict_proba_batched, apply_offset)
+
 from sklearn.base import clone
 from sklearn.model_selection import ParameterGrid
 from sklearn.metrics import (
@@ -27,7 +35,50 @@ from sklearn.metrics import (
 )
 
 
-def ML_GBT(df, INDEX_ID, INDEX_IMPUTATION_ID,  INDEX_COLUMNS, TARGET_COLUMNS, RUN_CHECKS = True, RUN_DEBUG = False):
+NAME_STR = "model_gbt_{}"
+PARAM_GRID = ParameterGrid([
+    {
+        'learning_rate': [0.01],
+        'subsample': [0.1, 0.5],      # reduce variance, increase bias
+        'max_features': [0.5],        # reduce bias, increase variance
+        'max_depth': [3],
+        'n_estimators': [250],
+        'n_iter_no_change': [25],     # Early stopping after 25 iterations w/o change.
+        'validation_fraction': [0.1], # Validation fraction for early stopping.
+        'tol': [1e-3],
+    },
+    {
+        'learning_rate': [0.1],
+        'subsample': [0.5, 1.0],         # reduce variance, increase bias
+        'max_features': [1.0],      # reduce bias, increase variance
+        'max_depth': [5],
+        'n_estimators': [250],
+        'n_iter_no_change': [25],     # Early stopping after 25 iterations w/o change.
+        'validation_fraction': [0.1], # Validation fraction for early stopping.
+        'tol': [1e-3],
+    }
+])
+
+
+# Fit on every treated patient and this fraction of untreated patients,
+# sampled within health system and diagnosis epoch strata (None fits on
+# every patient). The full cohort is still scored. CONTROL_SAMPLING_CORRECTION
+# is 'weight' or 'offset'; see transforms/case_control.py.
+CONTROL_SAMPLING_RATE = None
+CONTROL_SAMPLING_CORRECTION = 'weight'
+
+# Stop boosting on covariate balance instead of the validation log-loss
+# (n_iter_no_change). Every BALANCE_CHECK_EVERY stages the weighted mean
+# absolute SMD of the covariates is computed from the staged scores; fitting
+# stops after BALANCE_PATIENCE checks without an improvement of at least
+# BALANCE_TOL, and the scores of the best stage are kept. See BalanceMonitor.
+BALANCE_EARLY_STOPPING = False
+BALANCE_CHECK_EVERY = 10
+BALANCE_PATIENCE = 3
+BALANCE_TOL = 1e-4
+
+
+def ML_GBT(df, INDEX_ID, INDEX_IMPUTATION_ID,  INDEX_COLUMNS, TARGET_COLUMNS, RUN_CHECKS = True, RUN_DEBUG = False, PREDICTION_STORE = None):
     """Train Gradient-Boosting Tree (GBT) models.
 
     Trains the Gradient-Boosting Decision Tree models according to a
@@ -37,6 +88,9 @@ def ML_GBT(df, INDEX_ID, INDEX_IMPUTATION_ID,  INDEX_COLUMNS, TARGET_COLUMNS, RU
     -----
     preprocess_PropensityScore -- [Pandas DataFrame]
         The formatted and prepared data.
+    PREDICTION_STORE -- [str or Path or None]
+        If given, the scores of every fit are appended to this prediction
+        store (see transforms/prediction_store.py) as soon as it completes.
 
     Output
     ------
@@ -48,29 +102,7 @@ def ML_GBT(df, INDEX_ID, INDEX_IMPUTATION_ID,  INDEX_COLUMNS, TARGET_COLUMNS, RU
     # ################################################### #
     # CREATE HYPERPARAMETER GRID                          #
     # ################################################### #
-    name_str = "model_gbt_{}"
-    param_grid = ParameterGrid([
-        {
-            'learning_rate': [0.01],
-            'subsample': [0.1, 0.5],      # reduce variance, increase bias
-            'max_features': [0.5],        # reduce bias, increase variance
-            'max_depth': [3],
-            'n_estimators': [250],
-            'n_iter_no_change': [25],     # Early stopping after 25 iterations w/o change.
-            'validation_fraction': [0.1], # Validation fraction for early stopping.
-            'tol': [1e-3],
-        },
-        {
-            'learning_rate': [0.1],
-            'subsample': [0.5, 1.0],         # reduce variance, increase bias
-            'max_features': [1.0],      # reduce bias, increase variance
-            'max_depth': [5],
-            'n_estimators': [250],
-            'n_iter_no_change': [25],     # Early stopping after 25 iterations w/o change.
-            'validation_fraction': [0.1], # Validation fraction for early stopping.
-            'tol': [1e-3],
-        }
-    ])
+    name_str, param_grid = NAME_STR, PARAM_GRID
 
     # Add the columns for the gbt models.
     param_grid_columns = [
@@ -89,6 +121,8 @@ def ML_GBT(df, INDEX_ID, INDEX_IMPUTATION_ID,  INDEX_COLUMNS, TARGET_COLUMNS, RU
         col for col in df.columns
         if col not in (INDEX_COLUMNS + TARGET_COLUMNS + model_columns)
     ]
+    # Covariates whose balance is monitored; ordinal codes are not covariates of the balance step.
+    balance_columns = np.array([not col.endswith(ORDINAL_SUFFIX) for col in feature_columns])
 
     if RUN_DEBUG:
         print(f'Number of columns in training data set: {len(param_grid_columns)}')
@@ -113,6 +147,12 @@ def ML_GBT(df, INDEX_ID, INDEX_IMPUTATION_ID,  INDEX_COLUMNS, TARGET_COLUMNS, RU
               .to_numpy(dtype=np.uint8)\
               .ravel()
 
+        # Case-control subsample of the training rows.
+        X_fit, y_fit, w_fit, offsets = case_control(
+            df.loc[df[INDEX_IMPUTATION_ID]==imputation_group], X, y,
+            CONTROL_SAMPLING_RATE, CONTROL_SAMPLING_CORRECTION, seed=imputation_group
+        )
+
         # Display header row for model parameter log
         if imputation_group==1:
             print('\nlearning_rate,subsample,max_features,max_depth,n_estimators')
@@ -127,6 +167,9 @@ def ML_GBT(df, INDEX_ID, INDEX_IMPUTATION_ID,  INDEX_COLUMNS, TARGET_COLUMNS, RU
             # Create the model.
             model = GradientBoostingClassifier(random_state=2022)
             model.set_params(**param_grid[i])
+            if BALANCE_EARLY_STOPPING:
+                # Covariate balance replaces the validation log-loss as the stopping rule.
+                model.set_params(n_iter_no_change=None)
 
             # Print model description logs.
             if imputation_group == 1:
@@ -136,11 +179,22 @@ def ML_GBT(df, INDEX_ID, INDEX_IMPUTATION_ID,  INDEX_COLUMNS, TARGET_COLUMNS, RU
                 print("\tTraining model {}.".format(col_name))
 
             # Model training.
-            model = model.fit(X,y)  # Continues training since warm start is true
-            predictions = model.predict_proba(X)
+            if BALANCE_EARLY_STOPPING:
+                monitor = BalanceMonitor(X, y, balance_columns, offsets=offsets)
+                model = monitor.truncate(model.fit(X_fit, y_fit, sample_weight=w_fit, monitor=monitor))
+                scores = monitor.best_scores_
+                print(f"\t{col_name}: best balance at stage {monitor.best_stage_} of {monitor.n_stages_}, "
+                      f"mean abs SMD {monitor.best_smd_:.4f}.")
+            else:
+                model = model.fit(X_fit, y_fit, sample_weight=w_fit)  # Continues training since warm start is true
+                scores = predict_proba_batched(model, X)[:,-1]
+                if offsets is not None:
+                    scores = apply_offset(scores, offsets)
 
             # Save predictions in main dataframe.
-            df.loc[df[INDEX_IMPUTATION_ID]==imputation_group, col_name] = predictions[:,-1]
+            df.loc[df[INDEX_IMPUTATION_ID]==imputation_group, col_name] = scores
+            if PREDICTION_STORE is not None:
+                append_predictions(PREDICTION_STORE, col_name, imputation_group, scores)
 
     if RUN_CHECKS:
         run_sanity_checks(df, param_grid_columns)
@@ -152,6 +206,129 @@ def ML_GBT(df, INDEX_ID, INDEX_IMPUTATION_ID,  INDEX_COLUMNS, TARGET_COLUMNS, RU
     return df
 
 
+# ############################################################################# #
+# BALANCE EARLY STOPPING                                                        #
+# ############################################################################# #
+class BalanceMonitor:
+    """Stop GradientBoostingClassifier.fit when covariate balance stops improving.
+
+    Passed as fit(..., monitor=BalanceMonitor(...)), it is called after
+    every boosting stage. It adds the new tree to the log odds of the rows
+    of X, so the staged scores are updated incrementally rather than
+    recomputed. Every `every` stages, and at the last stage, it computes the
+    mean absolute SMD of the covariates under the stabilized ATE weights of
+    the staged scores (transforms/balance.py). Fitting stops after
+    `patience` checks without an improvement of at least `tol`. The scores
+    of the best stage are kept, and truncate(model) cuts the fitted model
+    back to that stage. While no check has given a finite SMD (e.g. a
+    treatment group with zero weight), the latest scores are kept, so a
+    fit without any finite SMD ends with its final-stage scores.
+
+    Input
+    -----
+    X -- [numpy array]
+        Rows whose scores are balanced (e.g. every patient of the
+        imputation group, also when fitting on a case-control sample),
+        with the model's feature columns.
+    treatment -- [numpy array]
+        Treatment indicator of the rows of X.
+    covariates -- [numpy array or None]
+        Boolean mask of the columns of X whose balance is monitored.
+        None monitors every column.
+    offsets -- [numpy array or None]
+        Case-control offsets subtracted from the log odds of the rows of X
+        (see transforms/case_control.py).
+    sample_weight -- [numpy array or None]
+        Frequency weights of the rows of X, e.g. bootstrap counts.
+    every, patience, tol -- [int, int, float or None]
+        None takes BALANCE_CHECK_EVERY, BALANCE_PATIENCE and BALANCE_TOL.
+
+    Attributes
+    ----------
+    best_stage_ -- [int]
+        Number of stages of the best scores.
+    best_smd_ -- [float]
+        Mean absolute SMD of the best scores (NaN when no check gave a
+        finite SMD).
+    best_scores_ -- [numpy array]
+        Treatment probability of every row of X at the best stage.
+    n_stages_ -- [int]
+        Number of stages fit.
+    history_ -- [list of (int, float)]
+        (stage, mean absolute SMD) of every check.
+    """
+
+    def __init__(self, X, treatment, covariates=None, offsets=None, sample_weight=None,
+                 every=None, patience=None, tol=None):
+        # Trees predict on float32 features.
+        self.X = np.asarray(X, dtype=np.float32)
+        self.treatment = np.asarray(treatment)
+        self.covariates = np.asarray(X, dtype=np.float64)
+        if covariates is not None:
+            self.covariates = self.covariates[:, covariates]
+        self.offsets = offsets
+        self.sample_weight = sample_weight
+        self.every = BALANCE_CHECK_EVERY if every is None else every
+        self.patience = BALANCE_PATIENCE if patience is None else patience
+        self.tol = BALANCE_TOL if tol is None else tol
+
+        # The covariates do not change between checks.
+        self.binary = binary_columns(self.covariates)
+        self.sd = pooled_sd(self.covariates, self.treatment, sample_weight)
+
+    def __call__(self, i, model, locals_=None):
+        if i == 0:
+            self._reset(model)
+        for tree in model.estimators_[i]:
+            self._raw += model.learning_rate * tree.predict(self.X)
+        stage = self.n_stages_ = i + 1
+        if stage % self.every and stage < model.n_estimators:
+            return False
+
+        scores = expit(self._raw)
+        if self.offsets is not None:
+            scores = apply_offset(scores, self.offsets)
+        smd = mean_abs_smd(self.covariates, self.treatment, scores, self.binary, self.sd, self.sample_weight)
+        self.history_.append((stage, smd))
+        if not np.isnan(smd) and (np.isnan(self.best_smd_) or smd < self.best_smd_ - self.tol):
+            self.best_stage_, self.best_smd_, self.best_scores_ = stage, smd, scores
+            self._checks_without_improvement = 0
+        else:
+            self._checks_without_improvement += 1
+            if np.isnan(self.best_smd_):
+                self.best_stage_, self.best_scores_ = stage, scores
+        return self._checks_without_improvement >= self.patience
+
+    def truncate(self, model):
+        """Cut a model fitted with this monitor back to best_stage_ stages.
+
+        Its predictions are then those of best_scores_, and warm-start
+        fits continue from the best stage.
+        """
+        stages = self.best_stage_
+        model.estimators_ = model.estimators_[:stages]
+        model.train_score_ = model.train_score_[:stages]
+        for name in ['oob_improvement_', 'oob_scores_']:
+            if hasattr(model, name):
+                setattr(model, name, getattr(model, name)[:stages])
+        if hasattr(model, 'oob_scores_') and stages:
+            model.oob_score_ = model.oob_scores_[-1]
+        model.n_estimators_ = stages
+        return model
+
+    def _reset(self, model):
+        # Log odds of the initial estimator, as GradientBoostingClassifier starts from them.
+        if model.init_ == 'zero':
+            self._raw = np.zeros(self.X.shape[0])
+        else:
+            eps = np.finfo(np.float32).eps
+            proba = np.clip(model.init_.predict_proba(self.X)[:, 1], eps, 1 - eps)
+            self._raw = np.log(proba / (1 - proba))
+        self.best_stage_, self.best_smd_, self.best_scores_ = 0, np.nan, None
+        self.n_stages_, self.history_ = 0, []
+        self._checks_without_improvement = 0
+
+
 # ############################################################################# #
 # OPTIONAL CHECKS                                                               #
 # ############################################################################# #
@@ -175,7 +352,8 @@ def run_sanity_checks(df, param_grid_columns):
 
     print(len(param_grid_columns), df[param_grid_columns].shape)
 
-    # Verify that every single value was calculated in the new columns.
-    assert( df[param_grid_columns].isna().sum().sum() == 0 )
+    # Verify that every single value was calculated in the new columns,
+    # and that all predictions are probabilities.
+    assert_valid(validate(df, probability_rules(param_grid_columns)), 'Model output')
 
     return 1
@@ -17,12 +17,51 @@ from sklearn.metrics import (
 import numpy as np
 import warnings
 
+from transforms.compress import fit_compressed, predict_proba_compressed
+from transforms.solver_autotune import autotune_solver, data_fingerprint
+from transforms.ML_setup import ORDINAL_SUFFIX
+from transforms.validate import probability_rules, validate, assert_valid
+from transforms.prediction_store import append_predictions, drop_model
+from transforms.case_control import (
+    case_control, resolve_class_weight,
+    predict_proba_batched, apply_offset)
+
+# This is the reduced hyperparameter grid.
+NAME_STR = "model_lr_{}"
+PARAM_GRID = ParameterGrid([
+    {
+        'penalty': ['l1','l2'],        # l1=lasso, l2=ridge
+        'C': [0.01, 0.1],
+        'solver':['saga'],
+        'max_iter': [500],
+        'class_weight': ['balanced']
+    }
+])
+
+# Fit on the distinct (feature row, treatment) patterns, weighted by their
+# counts, instead of on every patient. See transforms/compress.py. sag/saga
+# fits are never compressed, so with the saga-only PARAM_GRID this only
+# applies to the solvers chosen with AUTOTUNE_SOLVER.
+COMPRESS_ROWS = True
+
+# Replace the solver of each candidate by the fastest solver reaching the
+# same objective on a stratified subsample. See transforms/solver_autotune.py.
+AUTOTUNE_SOLVER = False
+
+# Fit on every treated patient and this fraction of untreated patients,
+# sampled within health system and diagnosis epoch strata (None fits on
+# every patient). The full cohort is still scored. CONTROL_SAMPLING_CORRECTION
+# is 'weight' or 'offset'; see transforms/case_control.py.
+CONTROL_SAMPLING_RATE = None
+CONTROL_SAMPLING_CORRECTION = 'weight'
+
+
 # UNCOMMENT TO SUPPRESS SCIKIT-LEARN CONVERGENCE WARNINGS
 # Do not uncomment unless you're really, really, really sure you want to.
 # The warnings are important.
 # Debug purposes only.
 #@ignore_warnings(category=ConvergenceWarning)
-def ML_LR(df, INDEX_ID, INDEX_IMPUTATION_ID,  INDEX_COLUMNS, TARGET_COLUMNS, RUN_CHECKS = True, RUN_DEBUG = False):
+def ML_LR(df, INDEX_ID, INDEX_IMPUTATION_ID,  INDEX_COLUMNS, TARGET_COLUMNS, RUN_CHECKS = True, RUN_DEBUG = False, PREDICTION_STORE = None):
     """Train logistic regression (LR) models.
 
     Trains the logistic regression models according to a hyperparameter grid search.
@@ -31,6 +70,9 @@ def ML_LR(df, INDEX_ID, INDEX_IMPUTATION_ID,  INDEX_COLUMNS, TARGET_COLUMNS, RUN
     -----
     df -- [Pandas DataFrame]
         The formatted and prepared data.
+    PREDICTION_STORE -- [str or Path or None]
+        If given, the scores of every fit are appended to this prediction
+        store (see transforms/prediction_store.py) as soon as it completes.
 
     Output
     ------
@@ -41,17 +83,7 @@ def ML_LR(df, INDEX_ID, INDEX_IMPUTATION_ID,  INDEX_COLUMNS, TARGET_COLUMNS, RUN
     # ################################################### #
     # CREATE HYPERPARAMETER GRID                          #
     # ################################################### #
-    # This is the reduced hyperparameter grid.
-    name_str = "model_lr_{}"
-    param_grid = ParameterGrid([
-        {
-            'penalty': ['l1','l2'],        # l1=lasso, l2=ridge
-            'C': [0.01, 0.1],
-            'solver':['saga'],
-            'max_iter': [500],
-            'class_weight': ['balanced']
-        }
-    ])
+    name_str, param_grid = NAME_STR, PARAM_GRID
 
     # Add the columns for the LR models' outputs.
     param_grid_columns = [name_str.format(i) for i in range(len(param_grid))]
@@ -63,9 +95,11 @@ def ML_LR(df, INDEX_ID, INDEX_IMPUTATION_ID,  INDEX_COLUMNS, TARGET_COLUMNS, RUN
     # Get names of features for model training.
     cols = df.columns
     model_columns = cols[cols.str.contains('model_')].tolist()
+    # Ordinal-coded categoricals are only used by the tree models.
     feature_columns = [
         col for col in df.columns
         if col not in (INDEX_COLUMNS + TARGET_COLUMNS + model_columns)
+        and not col.endswith(ORDINAL_SUFFIX)
     ]
 
     if RUN_DEBUG:
@@ -99,6 +133,16 @@ def ML_LR(df, INDEX_ID, INDEX_IMPUTATION_ID,  INDEX_COLUMNS, TARGET_COLUMNS, RUN
               .to_numpy(dtype=np.uint8)\
               .ravel()
 
+        # Case-control subsample of the training rows.
+        X_fit, y_fit, w_fit, offsets = case_control(
+            df.loc[df[INDEX_IMPUTATION_ID]==imputation_group], X, y,
+            CONTROL_SAMPLING_RATE, CONTROL_SAMPLING_CORRECTION, seed=imputation_group
+        )
+
+        # Hash the training rows once for the solver cache of every candidate.
+        if AUTOTUNE_SOLVER:
+            fingerprint = data_fingerprint(X_fit, y_fit, w_fit)
+
         # Display header row for model parameter log
         if imputation_group==1:
             print('model,penalty,c,solver,class_weight')
@@ -115,8 +159,13 @@ def ML_LR(df, INDEX_ID, INDEX_IMPUTATION_ID,  INDEX_COLUMNS, TARGET_COLUMNS, RUN
                 continue
 
             # Create the model.
+            params = param_grid[i]
+            if AUTOTUNE_SOLVER:
+                params = autotune_solver(params, X_fit, y_fit, sample_weight=w_fit, fingerprint=fingerprint)
             model = clone(model_gbl)
-            model.set_params(**param_grid[i])
+            model.set_params(**params)
+            if CONTROL_SAMPLING_RATE is not None:
+                resolve_class_weight(model, y)
 
             # Print model description logs.
             if imputation_group == 1:
@@ -130,7 +179,11 @@ def ML_LR(df, INDEX_ID, INDEX_IMPUTATION_ID,  INDEX_COLUMNS, TARGET_COLUMNS, RUN
             # has failed.
             with warnings.catch_warnings(record=True) as w:
                 warnings.simplefilter("always")
-                model = model.fit(X, y)
+                compressed = False
+                if COMPRESS_ROWS:
+                    model, compressed = fit_compressed(model, X_fit, y_fit, sample_weight=w_fit)
+                else:
+                    model = model.fit(X_fit, y_fit, sample_weight=w_fit)
 
                 # Predict & save if the model converged.
                 if len(w) and issubclass(w[-1].category, ConvergenceWarning):
@@ -142,15 +195,24 @@ def ML_LR(df, INDEX_ID, INDEX_IMPUTATION_ID,  INDEX_COLUMNS, TARGET_COLUMNS, RUN
 
                     # Delete any saved copies of this model.
                     del trained_models[col_name]
+                    if PREDICTION_STORE is not None:
+                        drop_model(PREDICTION_STORE, col_name)
                 else:
                     # Predict.
-                    y_pred = model.predict_proba(X)
+                    if compressed:
+                        y_pred = predict_proba_compressed(model, X)
+                    else:
+                        y_pred = predict_proba_batched(model, X)
+                    if offsets is not None:
+                        y_pred[:,-1] = apply_offset(y_pred[:,-1], offsets)
 
                     # Store the trained model.
                     trained_models[col_name].append(model)
 
                     # Save the predicted values on the corresponding dataframe slice.
                     df.loc[df[INDEX_IMPUTATION_ID]==imputation_group, col_name] = y_pred[:,-1]
+                    if PREDICTION_STORE is not None:
+                        append_predictions(PREDICTION_STORE, col_name, imputation_group, y_pred[:,-1])
 
     # ################################################### #
     # REMOVE CONVERGENCE FAILURES                         #
@@ -207,7 +269,7 @@ def run_sanity_checks(df, param_grid_columns):
         "\n\nStdev of all predicted values per model:\n{}".format(df[param_grid_columns].std()),
     )
 
-    # Verify that every single value was calculated in the new columns.
-    # Assertion fails when all models have null output.
-    assert( df[param_grid_columns].isna().sum().sum() == 0 )
+    # Verify that every single value was calculated in the new columns,
+    # and that all predictions are probabilities.
+    assert_valid(validate(df, probability_rules(param_grid_columns)), 'Model output')
     return 1
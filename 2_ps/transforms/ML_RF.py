@@ -18,7 +18,41 @@ import warnings
 from collections import namedtuple
 from itertools import product
 
-def ML_RF(df, INDEX_ID, INDEX_IMPUTATION_ID,  INDEX_COLUMNS, TARGET_COLUMNS, RUN_CHECKS = True, RUN_DEBUG = False):
+from transforms.validate import probability_rules, validate, assert_valid
+from transforms.prediction_store import append_predictions
+from transforms.case_control import (
+    case_control, predict_proba_batched, apply_offset)
+
+# Create parameter grid of options
+#     class_weight=balanced_subsample gives an
+#     annoying error right now (warns that we
+#     shouldn't use  balanced option with warm
+#     start unless the dataset is the same -
+#     which it is!). sklearn doesn't let us disable warnings.
+#     So I turned it off.
+NAME_STR = "model_rf_{}_{}"
+PARAM_GRID = ParameterGrid([
+    {
+        'warm_start': [True],
+        'max_depth': [10],
+        'min_samples_leaf': [1, 10],
+        'oob_score': [True],
+        'class_weight':[None],
+        'max_samples': [0.5, 0.9]
+    }
+])
+NUM_ESTIMATORS = [50]
+
+
+# Fit on every treated patient and this fraction of untreated patients,
+# sampled within health system and diagnosis epoch strata (None fits on
+# every patient). The full cohort is still scored. CONTROL_SAMPLING_CORRECTION
+# is 'weight' or 'offset'; see transforms/case_control.py.
+CONTROL_SAMPLING_RATE = None
+CONTROL_SAMPLING_CORRECTION = 'weight'
+
+
+def ML_RF(df, INDEX_ID, INDEX_IMPUTATION_ID,  INDEX_COLUMNS, TARGET_COLUMNS, RUN_CHECKS = True, RUN_DEBUG = False, PREDICTION_STORE = None):
     """Train Random Forest (RF) models.
 
     Trains the Random Forest models according to a hyperparameter
@@ -28,6 +62,9 @@ def ML_RF(df, INDEX_ID, INDEX_IMPUTATION_ID,  INDEX_COLUMNS, TARGET_COLUMNS, RUN
     -----
     preprocess_PropensityScore -- [Pandas DataFrame]
         The formatted and prepared data.
+    PREDICTION_STORE -- [str or Path or None]
+        If given, the scores of every fit are appended to this prediction
+        store (see transforms/prediction_store.py) as soon as it completes.
 
     Output
     ------
@@ -40,25 +77,7 @@ def ML_RF(df, INDEX_ID, INDEX_IMPUTATION_ID,  INDEX_COLUMNS, TARGET_COLUMNS, RUN
     # ################################################### #
     # CREATE HYPERPARAMETER GRID                          #
     # ################################################### #
-    # Create parameter grid of options
-    #     class_weight=balanced_subsample gives an
-    #     annoying error right now (warns that we
-    #     shouldn't use  balanced option with warm
-    #     start unless the dataset is the same -
-    #     which it is!). sklearn doesn't let us disable warnings.
-    #     So I turned it off.
-    name_str = "model_rf_{}_{}"
-    param_grid = ParameterGrid([
-        {
-            'warm_start': [True],
-            'max_depth': [10],
-            'min_samples_leaf': [1, 10],
-            'oob_score': [True],
-            'class_weight':[None],
-            'max_samples': [0.5, 0.9]
-        }
-    ])
-    num_estimators = [50]
+    name_str, param_grid, num_estimators = NAME_STR, PARAM_GRID, NUM_ESTIMATORS
 
     # Add columns for the rf models.
     param_grid_columns = [
@@ -101,6 +120,12 @@ def ML_RF(df, INDEX_ID, INDEX_IMPUTATION_ID,  INDEX_COLUMNS, TARGET_COLUMNS, RUN
             .to_numpy(dtype=np.uint8)\
             .ravel()
 
+        # Case-control subsample of the training rows.
+        X_fit, y_fit, w_fit, offsets = case_control(
+            df.loc[df[INDEX_IMPUTATION_ID]==imputation_group], X, y,
+            CONTROL_SAMPLING_RATE, CONTROL_SAMPLING_CORRECTION, seed=imputation_group
+        )
+
         # Display header row for model parameter log
         if imputation_group==1:
             print('max_depth,min_samples_leaf,class_weight,max_samples,n_estimators') #TODO
@@ -129,11 +154,15 @@ def ML_RF(df, INDEX_ID, INDEX_IMPUTATION_ID,  INDEX_COLUMNS, TARGET_COLUMNS, RUN
                     print("\tTraining model {}.".format(col_name))
 
                 # Train, evaluate, and store results.
-                model = model.fit(X,y)
-                predictions = model.predict_proba(X)
+                model = model.fit(X_fit, y_fit, sample_weight=w_fit)
+                predictions = predict_proba_batched(model, X)
+                if offsets is not None:
+                    predictions[:,-1] = apply_offset(predictions[:,-1], offsets)
 
                 # Save predictions in main dataframe.
                 df.loc[df[INDEX_IMPUTATION_ID]==imputation_group, col_name] = predictions[:,-1]
+                if PREDICTION_STORE is not None:
+                    append_predictions(PREDICTION_STORE, col_name, imputation_group, predictions[:,-1])
 
     if RUN_CHECKS:
         run_sanity_checks(df, param_grid_columns)
@@ -167,7 +196,8 @@ def run_sanity_checks(df, param_grid_columns):
     print('Any null in predictions:', df[param_grid_columns].isna().sum())
     print("Num columns, dataframe shape:", len(param_grid_columns), df[param_grid_columns].shape)
 
-    # Verify that every single value was calculated in the new columns.
-    assert( df[param_grid_columns].isna().sum().sum() == 0 )
+    # Verify that every single value was calculated in the new columns,
+    # and that all predictions are probabilities.
+    assert_valid(validate(df, probability_rules(param_grid_columns)), 'Model output')
 
     return 1
@@ -11,6 +11,29 @@
 import numpy as np
 import pandas as pd
 
+
+# Encoders of categorical columns, selected by the transformer column of
+# configs.csv:
+#     onehot        -- one column per level (onehot_baseline drops a level)
+#     onehot_capped -- one column per level with a frequency of at least
+#                      MIN_FREQUENCY, at most MAX_CATEGORIES columns; the
+#                      remaining levels are pooled into <variable>__other
+#     hashing       -- levels hashed into HASH_WIDTH columns <variable>__hash<k>
+#     ordinal       -- one column <variable>__code with the index of the sorted
+#                      level. Codes are only meaningful to tree models, so
+#                      ML_LR leaves these columns out.
+CATEGORICAL_TRANSFORMERS = ['onehot', 'onehot_capped', 'hashing', 'ordinal']
+MIN_FREQUENCY = 0.01
+MAX_CATEGORIES = 20
+HASH_WIDTH = 16
+ORDINAL_SUFFIX = '__code'
+
+# Encode the onehot columns from their Categorical codes with
+# CategoricalOneHotEncoder. False uses sklearn's OneHotEncoder, the
+# reference implementation (see transforms/equivalence.py).
+ENCODE_FROM_CODES = True
+
+
 def ML_setup(df, configs, INDEX_IMPUTATION_ID, RUN_CHECKS = True, RUN_DEBUG = False):
     """Set up data for model training.
 
@@ -52,7 +75,8 @@ def ML_setup(df, configs, INDEX_IMPUTATION_ID, RUN_CHECKS = True, RUN_DEBUG = Fa
                .values\
                .tolist()
     )
-    onehot_transformer = OneHotEncoder(sparse=False)
+    onehot_encoder = CategoricalOneHotEncoder if ENCODE_FROM_CODES else OneHotEncoder
+    onehot_transformer = onehot_encoder(sparse=False)
 
     # ONE-HOT DUMMIES
     # These are the onehot columns where we use dummies, or remove
@@ -69,7 +93,7 @@ def ML_setup(df, configs, INDEX_IMPUTATION_ID, RUN_CHECKS = True, RUN_DEBUG = Fa
                .values\
                .tolist()
     )
-    dummy_transformer = OneHotEncoder(
+    dummy_transformer = onehot_encoder(
         sparse=False,
         drop=dummy_drop_values
     )
@@ -97,6 +121,17 @@ def ML_setup(df, configs, INDEX_IMPUTATION_ID, RUN_CHECKS = True, RUN_DEBUG = Fa
     stratified_columns.append('health_system')
     stratified_transformer = StratifiedScaler(stratifier='health_system')
 
+    # HIGH-CARDINALITY CATEGORICALS
+    # Frequency-capped one-hot, hashed and ordinal encodings.
+    capped_columns = configs.loc[configs['transformer']=='onehot_capped', 'variable'].values.tolist()
+    capped_transformer = CappedOneHotEncoder(min_frequency=MIN_FREQUENCY, max_categories=MAX_CATEGORIES)
+
+    hashed_columns = configs.loc[configs['transformer']=='hashing', 'variable'].values.tolist()
+    hashed_transformer = HashingEncoder(n_features=HASH_WIDTH)
+
+    ordinal_columns = configs.loc[configs['transformer']=='ordinal', 'variable'].values.tolist()
+    ordinal_transformer = CategoryOrdinalEncoder()
+
     # INDEX PASSTHROUGH
     # Index features; passed through.
     passthrough_columns = (
@@ -113,8 +148,17 @@ def ML_setup(df, configs, INDEX_IMPUTATION_ID, RUN_CHECKS = True, RUN_DEBUG = Fa
         print("Stratified numeric columns:", stratified_columns)
         print("Onehot columns:", onehot_columns)
         print("Dummy columns:", dummy_columns)
-
-    # The combined transformer pipeline.
+        print("Capped onehot columns:", capped_columns)
+        print("Hashed columns:", hashed_columns)
+        print("Ordinal columns:", ordinal_columns)
+
+    # The combined transformer pipeline. The high-cardinality encoders are
+    # only added when configs selects them.
+    optional_steps = [
+        ("capped", capped_transformer, capped_columns),
+        ("hashed", hashed_transformer, hashed_columns),
+        ("ordinal", ordinal_transformer, ordinal_columns)
+    ]
     column_transformer = ColumnTransformer(
         [
             ("passthrough", passthrough_transformer, passthrough_columns),
@@ -122,7 +166,7 @@ def ML_setup(df, configs, INDEX_IMPUTATION_ID, RUN_CHECKS = True, RUN_DEBUG = Fa
             ("stratified", stratified_transformer, stratified_columns),
             ("onehot", onehot_transformer, onehot_columns),
             ("dummy", dummy_transformer, dummy_columns)
-        ]
+        ] + [step for step in optional_steps if len(step[2])]
     )
 
     # ################################################### #
@@ -314,6 +358,230 @@ class StratifiedScaler(BaseEstimator, TransformerMixin):
         return np.array(self.feature_names_out)
 
 
+# ################################################################################# #
+#                 Custom one-hot encoder for Categorical columns                    #
+# ################################################################################# #
+from sklearn.preprocessing import OneHotEncoder
+
+class CategoricalOneHotEncoder(OneHotEncoder):
+    """OneHotEncoder that encodes pandas Categorical columns from their codes.
+
+    get_dataframe.format_onehot returns the one-hot columns as pandas
+    Categoricals. For a DataFrame of Categorical columns, fit() only looks
+    at the categories each column uses, and transform() maps every
+    column's codes to the encoder's category positions, so no per-row
+    string comparison is done. The fitted attributes (categories_,
+    drop_idx_, get_feature_names) are those OneHotEncoder gives for the
+    same data. Any other input is passed to OneHotEncoder unchanged.
+    """
+    def fit(self, X, y=None):
+        if not _all_categorical(X):
+            return super().fit(X, y)
+
+        # One row per used category of every column (padded by repeating
+        # the first category), so that the encoder sees the same categories.
+        used = [
+            X[column].cat.categories[np.unique(X[column].cat.codes)].to_numpy(dtype=object)
+            for column in X.columns
+        ]
+        length = max(len(levels) for levels in used)
+        X_levels = pd.DataFrame({
+            column: np.r_[levels, np.repeat(levels[:1], length - len(levels))]
+            for column, levels in zip(X.columns, used)
+        })
+        return super().fit(X_levels, y)
+
+    def transform(self, X):
+        if not _all_categorical(X):
+            return super().transform(X)
+        check_is_fitted(self)
+
+        blocks = []
+        for j, column in enumerate(X.columns):
+            categories = self.categories_[j]
+            positions = pd.Index(categories).get_indexer(X[column].cat.categories)
+            codes = np.where(X[column].cat.codes < 0, -1, positions[X[column].cat.codes])
+
+            if self.handle_unknown == 'error' and (codes < 0).any():
+                unknown = pd.unique(X[column][codes < 0].astype(object))
+                raise ValueError(f"Found unknown categories {list(unknown)} in column {j} during transform")
+
+            block = np.zeros((X.shape[0], len(categories)), dtype=self.dtype)
+            rows = np.flatnonzero(codes >= 0)
+            block[rows, codes[rows]] = 1
+
+            if self.drop_idx_ is not None and self.drop_idx_[j] is not None:
+                block = np.delete(block, self.drop_idx_[j], axis=1)
+            blocks.append(block)
+
+        return np.hstack(blocks)
+
+
+def _all_categorical(X):
+    return isinstance(X, pd.DataFrame) and X.shape[1] > 0 and \
+        all(isinstance(X[column].dtype, pd.CategoricalDtype) for column in X.columns)
+
+
+# ################################################################################# #
+#                 Custom encoders for high-cardinality categoricals                 #
+# ################################################################################# #
+def _category_codes(series):
+    """Integer codes (-1 for null) and labels of a Categorical or object column."""
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return series.cat.codes.to_numpy(), series.cat.categories
+    codes, categories = pd.factorize(series)
+    return codes, categories
+
+
+class CappedOneHotEncoder(BaseEstimator, TransformerMixin):
+    """One-hot encoder with rare-level pooling.
+
+    Levels with a frequency below min_frequency, and all but the
+    max_categories - 1 most frequent levels when max_categories is set,
+    are pooled into a single "other" column. Levels unseen in fit() are
+    also encoded as "other" (or as all zeros when nothing was pooled).
+
+    :attributes:
+        categories_ -- [list of arrays]
+            The levels kept as their own column, per input column.
+        pooled_ -- [list of arrays]
+            The levels pooled into "other", per input column.
+    """
+    def __init__(self, min_frequency=0.01, max_categories=None, other_label='other'):
+        self.min_frequency = min_frequency
+        self.max_categories = max_categories
+        self.other_label = other_label
+
+    def fit(self, X, y=None):
+        self.feature_names_in = [str(column) for column in X.columns]
+        self.categories_, self.pooled_ = [], []
+        for column in X.columns:
+            codes, categories = _category_codes(X[column])
+            counts = np.bincount(codes[codes >= 0], minlength=len(categories))
+            keep = (counts > 0) & (counts >= self.min_frequency * X.shape[0])
+            if self.max_categories is not None and keep.sum() >= self.max_categories:
+                # Most frequent levels first; ties keep label order.
+                order = np.argsort(-counts, kind='stable')
+                keep = np.zeros(len(categories), dtype=bool)
+                keep[order[:self.max_categories - 1]] = True
+            levels = np.asarray(categories, dtype=object)
+            self.categories_.append(np.sort(levels[keep]))
+            self.pooled_.append(np.sort(levels[~keep & (counts > 0)]))
+        return self
+
+    def transform(self, X):
+        blocks = []
+        for j, column in enumerate(X.columns):
+            codes, categories = _category_codes(X[column])
+            kept = self.categories_[j]
+            has_other = len(self.pooled_[j]) > 0
+            positions = pd.Index(kept).get_indexer(categories)
+            if has_other:
+                positions = np.where(positions < 0, len(kept), positions)
+            positions = np.where(codes < 0, -1, positions[codes])
+
+            block = np.zeros((X.shape[0], len(kept) + has_other))
+            rows = np.flatnonzero(positions >= 0)
+            block[rows, positions[rows]] = 1
+            blocks.append(block)
+        return np.hstack(blocks)
+
+    def get_feature_names(self, input_features=None):
+        input_features = self.feature_names_in if input_features is None else input_features
+        names = []
+        for feature, kept, pooled in zip(input_features, self.categories_, self.pooled_):
+            names += [f"{feature}__{level}" for level in kept]
+            if len(pooled):
+                names.append(f"{feature}__{self.other_label}")
+        return np.array(names, dtype=object)
+
+
+class HashingEncoder(BaseEstimator, TransformerMixin):
+    """Hash the levels of each column into n_features indicator columns.
+
+    Each distinct level is hashed once (murmurhash3, so the buckets are
+    the same across runs and processes) and rows are mapped to their
+    level's bucket through the integer codes. The width stays n_features
+    per column however many levels appear.
+
+    :attributes:
+        bucket_levels_ -- [list of dict]
+            Per input column, the levels seen in fit() that fall in each
+            bucket, to interpret the <feature>__hash<k> columns.
+    """
+    def __init__(self, n_features=16):
+        self.n_features = n_features
+
+    def _buckets(self, categories):
+        from sklearn.utils import murmurhash3_32
+        return np.array([
+            murmurhash3_32(str(level), seed=0, positive=True) % self.n_features for level in categories
+        ], dtype=np.int64)
+
+    def fit(self, X, y=None):
+        self.feature_names_in = [str(column) for column in X.columns]
+        self.bucket_levels_ = []
+        for column in X.columns:
+            codes, categories = _category_codes(X[column])
+            used = np.unique(codes[codes >= 0])
+            levels = np.asarray(categories, dtype=object)[used]
+            buckets = {}
+            for level, bucket in zip(levels, self._buckets(levels)):
+                buckets.setdefault(int(bucket), []).append(level)
+            self.bucket_levels_.append(buckets)
+        return self
+
+    def transform(self, X):
+        blocks = []
+        for column in X.columns:
+            codes, categories = _category_codes(X[column])
+            buckets = np.where(codes < 0, -1, self._buckets(categories)[codes] if len(categories) else -1)
+
+            block = np.zeros((X.shape[0], self.n_features))
+            rows = np.flatnonzero(buckets >= 0)
+            block[rows, buckets[rows]] = 1
+            blocks.append(block)
+        return np.hstack(blocks)
+
+    def get_feature_names(self, input_features=None):
+        input_features = self.feature_names_in if input_features is None else input_features
+        return np.array([
+            f"{feature}__hash{k}" for feature in input_features for k in range(self.n_features)
+        ], dtype=object)
+
+
+class CategoryOrdinalEncoder(BaseEstimator, TransformerMixin):
+    """Encode each column as the index of its level among the sorted levels.
+
+    One output column per input column, for tree models. Levels unseen in
+    fit() are encoded as -1.
+
+    :attributes:
+        categories_ -- [list of arrays]
+            The sorted levels of each input column.
+    """
+    def fit(self, X, y=None):
+        self.feature_names_in = [str(column) for column in X.columns]
+        self.categories_ = []
+        for column in X.columns:
+            codes, categories = _category_codes(X[column])
+            used = np.unique(codes[codes >= 0])
+            self.categories_.append(np.sort(np.asarray(categories, dtype=object)[used]))
+        return self
+
+    def transform(self, X):
+        columns = []
+        for j, column in enumerate(X.columns):
+            codes, categories = _category_codes(X[column])
+            positions = pd.Index(self.categories_[j]).get_indexer(categories)
+            columns.append(np.where(codes < 0, -1, positions[codes]).astype(np.float64))
+        return np.column_stack(columns)
+
+    def get_feature_names(self, input_features=None):
+        input_features = self.feature_names_in if input_features is None else input_features
+        return np.array([f"{feature}{ORDINAL_SUFFIX}" for feature in input_features], dtype=object)
+
+
 # ################################################################################# #
 #                       Custom passthrough transformer                              #
 # ################################################################################# #
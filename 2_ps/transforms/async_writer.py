@@ -0,0 +1,152 @@
+##################################################
+## Project: Real World Evidence to Accelerate COVID-19 Therapeutics
+## Contract No.: 75FCMC18D0047
+## Purpose: Background writer that takes intermediate outputs off the critical path
+## Date: May 2022
+## Developers: Alexander Wood
+## Copyright 2022, The MITRE Corporation
+## Approved for Public Release; Distribution Unlimited. Public Release Case Number 22-1741.
+##################################################
+
+# No transforms imports here: 2_drs/main_drs.py loads this file directly,
+# outside of the 2_ps transforms package.
+import atexit
+import os
+import queue
+import threading
+from pathlib import Path
+
+import numpy as np
+
+
+# Supported compressions and the suffix appended to the output path.
+COMPRESSIONS = {None: '', 'gzip': '.gz', 'bz2': '.bz2', 'xz': '.xz'}
+
+# Outputs waiting to be written before write_* blocks the caller.
+MAX_PENDING = 4
+
+
+class AsyncWriter:
+    """Write dataframes, arrays and figures on a background thread.
+
+    write_csv, write_array and submit put the output on a bounded queue
+    and return at once; one writer thread writes the queued outputs in
+    order. Each output is written to a hidden temporary file next to its
+    target and renamed onto the target only once complete, so readers
+    never see a partial file. flush() waits until the queue is empty and
+    raises the first error of the writer thread. Writers still open at
+    interpreter exit are flushed.
+
+    Outputs are not copied: the caller must not modify a dataframe or
+    array after handing it to the writer. Rebinding the name (e.g.
+    df = ML_setup(df, ...)) is fine.
+
+    Input
+    -----
+    max_pending -- [int]
+        Queue size; the caller blocks while this many outputs are waiting.
+    compression -- [str or None]
+        Default compression of write_csv, one of COMPRESSIONS.
+    """
+
+    def __init__(self, max_pending=MAX_PENDING, compression=None):
+        assert compression in COMPRESSIONS, f"compression must be one of {list(COMPRESSIONS)}."
+        self.compression = compression
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._errors = []
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='AsyncWriter', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    # ############################################### #
+    # HAND-OFF                                        #
+    # ############################################### #
+    def submit(self, write, path):
+        """Queue write(tmp_path), renamed to path once it returns.
+
+        Output
+        ------
+        [Path]
+            The target path.
+        """
+        assert not self._closed, "AsyncWriter is closed."
+        path = Path(path)
+        self._queue.put((write, path))
+        return path
+
+    def write_csv(self, df, path, compression='default', **kwargs):
+        """Queue df.to_csv(path, **kwargs).
+
+        With a compression, its suffix (e.g. '.gz') is appended to path
+        unless path already ends with it.
+
+        Output
+        ------
+        [Path]
+            The target path.
+        """
+        compression = self.compression if compression == 'default' else compression
+        assert compression in COMPRESSIONS, f"compression must be one of {list(COMPRESSIONS)}."
+        path = Path(path)
+        suffix = COMPRESSIONS[compression]
+        if suffix and not path.name.endswith(suffix):
+            path = path.with_name(path.name + suffix)
+        return self.submit(lambda tmp: df.to_csv(tmp, compression=compression, **kwargs), path)
+
+    def write_array(self, array, path):
+        """Queue np.save(path, array)."""
+        def write(tmp):
+            with open(tmp, 'wb') as f:
+                np.save(f, array)
+        return self.submit(write, path)
+
+    # ############################################### #
+    # BARRIERS                                        #
+    # ############################################### #
+    def flush(self):
+        """Wait until every queued output is written; raise the first writer error."""
+        self._queue.join()
+        if len(self._errors):
+            path, error = self._errors[0]
+            self._errors = []
+            raise RuntimeError(f"Background write of {path} failed.") from error
+
+    def close(self):
+        """Flush and stop the writer thread."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        atexit.unregister(self.close)
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    # ############################################### #
+    # WRITER THREAD                                   #
+    # ############################################### #
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                self._queue.task_done()
+                return
+            write, path = task
+            # The temporary file keeps the suffix, from which e.g. savefig infers the format.
+            tmp = path.with_name(f'.{path.stem}.tmp{path.suffix}')
+            try:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                write(tmp)
+                os.replace(tmp, path)
+            except Exception as error:
+                self._errors.append((path, error))
+                if tmp.exists():
+                    tmp.unlink()
+            finally:
+                self._queue.task_done()
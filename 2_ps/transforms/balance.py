@@ -0,0 +1,171 @@
+##################################################
+## Project: Real World Evidence to Accelerate COVID-19 Therapeutics
+## Contract No.: 75FCMC18D0047
+## Purpose: Functions to compute weighted covariate balance of propensity scores
+## Date: May 2022
+## Developers: Alexander Wood
+## Copyright 2022, The MITRE Corporation
+## Approved for Public Release; Distribution Unlimited. Public Release Case Number 22-1741.
+##################################################
+
+import numpy as np
+import pandas as pd
+
+
+# Propensity scores are clipped to [PS_CLIP, 1 - PS_CLIP] before weighting.
+PS_CLIP = 1e-6
+
+
+def stabilized_weights(treatment, scores, sample_weight=None):
+    """Stabilized ATE weights, as computed in the covariate balance step.
+
+    Treated rows get P(treated) / ps and untreated rows
+    (1 - P(treated)) / (1 - ps). With frequency weights (e.g. bootstrap
+    counts), P(treated) is weighted and the weights are multiplied by them.
+
+    Input
+    -----
+    treatment -- [numpy array]
+        Treatment indicator, shape (n,).
+    scores -- [numpy array]
+        Propensity scores, shape (n,) or (n, n_models).
+    sample_weight -- [numpy array or None]
+        Frequency weights, shape (n,).
+
+    Output
+    ------
+    [numpy array]
+        Weights with the shape of scores.
+    """
+    treatment = np.asarray(treatment, dtype=np.float64)
+    scores = np.clip(np.asarray(scores, dtype=np.float64), PS_CLIP, 1 - PS_CLIP)
+    prob_treat = np.average(treatment, weights=sample_weight)
+    weights = np.where(
+        treatment[:, np.newaxis] == 1 if scores.ndim == 2 else treatment == 1,
+        prob_treat / scores, (1 - prob_treat) / (1 - scores)
+    )
+    if sample_weight is not None:
+        sample_weight = np.asarray(sample_weight, dtype=np.float64)
+        weights *= sample_weight[:, np.newaxis] if scores.ndim == 2 else sample_weight
+    return weights
+
+
+def binary_columns(X):
+    """Columns of X whose values are all 0 or 1."""
+    X = np.asarray(X)
+    return ((X == 0) | (X == 1)).all(axis=0)
+
+
+def pooled_sd(X, treatment, sample_weight=None):
+    """Pooled standard deviation sqrt((var_treated + var_untreated) / 2) of every covariate.
+
+    Variances are unweighted (ddof=1), or frequency-weighted with sample_weight.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    treated = np.asarray(treatment) == 1
+    if sample_weight is None:
+        return np.sqrt((X[treated].var(axis=0, ddof=1) + X[~treated].var(axis=0, ddof=1)) / 2)
+    sample_weight = np.asarray(sample_weight, dtype=np.float64)
+    variances = []
+    for rows in [treated, ~treated]:
+        w = sample_weight[rows]
+        mean = (w @ X[rows]) / w.sum()
+        variances.append((w @ (X[rows] - mean) ** 2) / (w.sum() - 1))
+    return np.sqrt((variances[0] + variances[1]) / 2)
+
+
+def balance_differences(X, treatment, weights, binary=None, sd=None):
+    """Weighted treated-minus-untreated differences of every covariate.
+
+    As cobalt's bal.tab (used by the covariate balance step) reports them:
+    binary covariates as the raw difference of weighted proportions, other
+    covariates as the difference of weighted means over the unweighted
+    pooled standard deviation sqrt((var_treated + var_untreated) / 2).
+    Covariates that are constant within both groups are left out (nan).
+
+    Input
+    -----
+    X -- [numpy array]
+        Covariates, shape (n, n_covariates).
+    treatment -- [numpy array]
+        Treatment indicator, shape (n,).
+    weights -- [numpy array]
+        Weights, shape (n,) or (n, n_models).
+    binary -- [numpy array or None]
+        Boolean mask of the binary covariates. None detects them.
+    sd -- [numpy array or None]
+        Pooled standard deviations (pooled_sd), for repeated calls on the
+        same covariates. None computes them unweighted.
+
+    Output
+    ------
+    [numpy array]
+        Differences, shape (n_covariates, n_models).
+    """
+    X = np.asarray(X, dtype=np.float64)
+    treated = np.asarray(treatment) == 1
+    weights = np.asarray(weights, dtype=np.float64)
+    if weights.ndim == 1:
+        weights = weights[:, np.newaxis]
+    if binary is None:
+        binary = binary_columns(X)
+
+    # Weighted means of every covariate for every model in two matrix products.
+    w_treated, w_untreated = weights[treated], weights[~treated]
+    mean_treated = (X[treated].T @ w_treated) / w_treated.sum(axis=0)
+    mean_untreated = (X[~treated].T @ w_untreated) / w_untreated.sum(axis=0)
+    diff = mean_treated - mean_untreated
+
+    if sd is None:
+        sd = pooled_sd(X, treated)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        diff = np.where(binary[:, np.newaxis], diff, diff / sd[:, np.newaxis])
+    diff[sd == 0] = np.nan
+    return diff
+
+
+def mean_abs_smd(X, treatment, scores, binary=None, sd=None, sample_weight=None):
+    """Mean absolute standardized difference over covariates, per score column.
+
+    The differences of balance_differences under the stabilized weights
+    of the scores (and frequency weights sample_weight, if given).
+
+    Output
+    ------
+    [numpy array]
+        Shape (n_models,), or a float for a single score column.
+    """
+    scores = np.asarray(scores)
+    if sd is None:
+        sd = pooled_sd(X, treatment, sample_weight)
+    weights = stabilized_weights(treatment, scores, sample_weight)
+    diff = balance_differences(X, treatment, weights, binary, sd)
+    result = np.nanmean(np.abs(diff), axis=0)
+    return result if scores.ndim == 2 else float(result[0])
+
+
+def select_best_model(df, model_columns, covariate_columns, TARGET_COLUMN):
+    """Rank candidate models by covariate balance.
+
+    Computes, on all rows of df as the covariate balance step does, the
+    mean and maximum absolute standardized difference of every model's
+    stabilized ATE weights.
+
+    Output
+    ------
+    summary -- [Pandas DataFrame]
+        One row per model: model, mean_abs_smd and max_abs_smd, sorted
+        from best to worst mean_abs_smd.
+    best_model -- [str]
+        The model with the smallest mean_abs_smd.
+    """
+    X = df[covariate_columns].to_numpy(dtype=np.float64)
+    treatment = df[TARGET_COLUMN].to_numpy()
+    scores = df[model_columns].to_numpy(dtype=np.float64)
+    diff = np.abs(balance_differences(X, treatment, stabilized_weights(treatment, scores)))
+    summary = pd.DataFrame({
+        'model': model_columns,
+        'mean_abs_smd': np.nanmean(diff, axis=0),
+        'max_abs_smd': np.nanmax(diff, axis=0),
+    }).sort_values('mean_abs_smd', kind='stable', ignore_index=True)
+    return summary, summary['model'].iloc[0]
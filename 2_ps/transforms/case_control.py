@@ -0,0 +1,168 @@
+##################################################
+## Project: Real World Evidence to Accelerate COVID-19 Therapeutics
+## Contract No.: 75FCMC18D0047
+## Purpose: Functions to fit PS models on a case-control subsample of untreated patients
+## Date: May 2022
+## Developers: Alexander Wood
+## Copyright 2022, The MITRE Corporation
+## Approved for Public Release; Distribution Unlimited. Public Release Case Number 22-1741.
+##################################################
+
+import numpy as np
+from sklearn.utils.class_weight import compute_class_weight
+
+
+# Untreated patients are sampled within the strata formed by these
+# (one-hot encoded) variables.
+STRATA_COLUMNS = ['health_system', 'diagnosis_epoch']
+
+# Corrections for the sampling of untreated patients:
+#     weight -- fit with inverse-sampling weights on the untreated rows.
+#     offset -- fit unweighted and subtract the log inverse-sampling
+#               fraction of the patient's stratum from the predicted log odds.
+CORRECTIONS = ['weight', 'offset']
+
+# Number of rows scored per predict_proba call on the full cohort.
+BATCH_SIZE = 100000
+
+
+def strata_codes(df, strata_columns=STRATA_COLUMNS):
+    """Integer stratum of every row of an ML_setup dataframe.
+
+    Strata are the distinct combinations of the one-hot columns
+    <variable>__<value> of each variable in strata_columns.
+
+    Input
+    -----
+    df -- [Pandas DataFrame]
+        Output of ML_setup, restricted to one imputation group.
+    strata_columns -- [list of str]
+        Variables to stratify by.
+
+    Output
+    ------
+    [numpy array]
+        Stratum code (0 .. n_strata - 1) of every row.
+    """
+    columns = [col for col in df.columns if col.split('__')[0] in strata_columns]
+    assert len(columns), f"No one-hot columns found for strata {strata_columns}."
+    _, codes = np.unique(df[columns].to_numpy(dtype=np.float64), axis=0, return_inverse=True)
+    return codes.ravel()
+
+
+def case_control_sample(y, strata, rate, seed=2022):
+    """Keep every treated row and a stratified sample of untreated rows.
+
+    In every stratum, round(rate * n) of its n untreated rows (at least
+    one) are drawn without replacement.
+
+    Input
+    -----
+    y -- [numpy array]
+        Treatment indicator.
+    strata -- [numpy array]
+        Stratum code of every row, from strata_codes.
+    rate -- [float]
+        Sampling rate of untreated rows, in (0, 1].
+
+    Output
+    ------
+    idx -- [numpy array]
+        Sorted row indices of the subsample.
+    weights -- [numpy array]
+        Inverse-sampling weight of every subsample row: 1 for treated
+        rows and n / round(rate * n) for untreated rows of the stratum.
+    offsets -- [numpy array]
+        Log inverse-sampling weight of the untreated rows of each row's
+        stratum, for every row of y.
+    """
+    y, strata = np.asarray(y), np.asarray(strata)
+    rng = np.random.default_rng(seed)
+
+    controls = np.flatnonzero(y == 0)
+    control_strata = strata[controls]
+    n_strata = strata.max() + 1
+    n_controls = np.bincount(control_strata, minlength=n_strata)
+    n_sampled = np.where(n_controls > 0, np.maximum(1, np.round(rate * n_controls)), 1).astype(np.int64)
+
+    # Shuffle the untreated rows within strata and keep the first n_sampled of each.
+    order = np.lexsort((rng.random(controls.shape[0]), control_strata))
+    rank = np.arange(controls.shape[0]) - np.repeat(np.cumsum(n_controls) - n_controls, n_controls)
+    kept = order[rank < n_sampled[control_strata[order]]]
+
+    inverse_fraction = n_controls / n_sampled
+    idx = np.concatenate([np.flatnonzero(y != 0), controls[kept]])
+    order = np.argsort(idx)
+    weights = np.where(y[idx] == 0, inverse_fraction[strata[idx]], 1.0)
+
+    offsets = np.log(np.maximum(inverse_fraction, 1.0))[strata]
+    return idx[order], weights[order], offsets
+
+
+def case_control(df, X, y, rate, correction='weight', seed=2022):
+    """Training rows of one imputation group, case-control sampled.
+
+    With rate None every row is kept. Otherwise the untreated rows are
+    sampled within the strata of df (case_control_sample) and corrected
+    as given by correction (see CORRECTIONS).
+
+    Input
+    -----
+    df -- [Pandas DataFrame]
+        Output of ML_setup, restricted to the imputation group of X, y.
+    X, y -- [numpy arrays]
+        Design matrix and treatment indicator of the imputation group.
+    rate -- [float or None]
+        Sampling rate of untreated rows (CONTROL_SAMPLING_RATE).
+    correction -- [str]
+        'weight' or 'offset' (CONTROL_SAMPLING_CORRECTION).
+    seed -- [int]
+        Seed of the sample, e.g. the imputation group.
+
+    Output
+    ------
+    X_fit, y_fit -- [numpy arrays]
+        Rows to fit on.
+    w_fit -- [numpy array or None]
+        Their sample weights, for the 'weight' correction.
+    offsets -- [numpy array or None]
+        Offsets to subtract from the predicted log odds of every row of
+        X (apply_offset), for the 'offset' correction.
+    """
+    if rate is None:
+        return X, y, None, None
+    assert correction in CORRECTIONS, f"correction must be one of {CORRECTIONS}."
+
+    idx, weights, offsets = case_control_sample(y, strata_codes(df), rate, seed=seed)
+    print(f"\tFitting on {len(idx)} of {len(y)} patients.")
+    if correction == 'weight':
+        return X[idx], y[idx], weights, None
+    return X[idx], y[idx], None, offsets
+
+
+def resolve_class_weight(model, y):
+    """Replace class_weight='balanced' by the class weights of the full y.
+
+    Fits on a subsample would otherwise balance the subsample's classes.
+    """
+    if model.get_params().get('class_weight') == 'balanced':
+        classes = np.unique(y)
+        model.set_params(class_weight=dict(zip(
+            classes.tolist(), compute_class_weight('balanced', classes=classes, y=y)
+        )))
+    return model
+
+
+def predict_proba_batched(model, X, batch_size=BATCH_SIZE):
+    """predict_proba over all rows of X, in blocks of batch_size rows."""
+    return np.concatenate([
+        model.predict_proba(X[start:start + batch_size])
+        for start in range(0, X.shape[0], batch_size)
+    ])
+
+
+def apply_offset(proba, offsets):
+    """Treatment probabilities with offsets subtracted from their log odds."""
+    with np.errstate(divide='ignore'):
+        log_odds = np.log(proba) - np.log1p(-proba)
+    return 1 / (1 + np.exp(offsets - log_odds))
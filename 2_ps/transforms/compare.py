@@ -0,0 +1,125 @@
+##################################################
+## Project: Real World Evidence to Accelerate COVID-19 Therapeutics
+## Contract No.: 75FCMC18D0047
+## Purpose: Functions to resample cohorts and compare score tables, shared by the PS and DRS equivalence checks
+## Date: May 2022
+## Developers: Alexander Wood
+## Copyright 2022, The MITRE Corporation
+## Approved for Public Release; Distribution Unlimited. Public Release Case Number 22-1741.
+##################################################
+
+# Only numpy and pandas are imported here: 2_drs/transforms/equivalence.py
+# loads this file directly, outside of the 2_ps transforms package.
+
+import numpy as np
+import pandas as pd
+
+
+# ############################################################################# #
+# COHORTS                                                                       #
+# ############################################################################# #
+def synthetic_cohort(df, n_persons, INDEX_ID, seed=2022):
+    """A cohort of n_persons patients resampled from df.
+
+    Patients are drawn with replacement and keep the rows of all their
+    imputation groups. Every draw gets a new person id. Repeated draws
+    give duplicate covariate rows, which favours row compression, so
+    speedups on these cohorts are upper bounds for that fast path.
+
+    Input
+    -----
+    df -- [Pandas DataFrame]
+        An imputed table, e.g. the input of get_dataframe or of the
+        DRS MLmodeling_hpo.
+    n_persons -- [int]
+        Number of patients of the synthetic cohort.
+    INDEX_ID -- [str]
+        Person id column.
+
+    Output
+    ------
+    [Pandas DataFrame]
+        The synthetic imputed table.
+    """
+    rng = np.random.default_rng(seed)
+    codes, ids = pd.factorize(df[INDEX_ID])
+    draws = rng.integers(0, len(ids), n_persons)
+
+    # Rows of every patient, then the rows of every draw.
+    order = np.argsort(codes, kind='stable')
+    counts = np.bincount(codes, minlength=len(ids))
+    starts = np.cumsum(counts) - counts
+    rows = np.concatenate([order[starts[d]:starts[d] + counts[d]] for d in draws])
+    draw_of_row = np.repeat(np.arange(n_persons), counts[draws])
+
+    cohort = df.iloc[rows].reset_index(drop=True)
+    cohort[INDEX_ID] = pd.Series([f'synthetic{k}' for k in draw_of_row], dtype=object)
+    return cohort
+
+
+# ############################################################################# #
+# COMPARISON                                                                    #
+# ############################################################################# #
+def compare_columns(reference, candidate, columns, keys, group, atol=0.0, rank_tol=0.0, mean_atol=None):
+    """Compare columns of two tables row by row, matched on keys.
+
+    Input
+    -----
+    reference, candidate -- [Pandas DataFrame]
+        Tables with the keys and columns.
+    columns -- [list of str]
+        Columns to compare. Columns missing from candidate fail.
+    keys -- [list of str]
+        Columns that identify a row, e.g. [person_id, impute_id].
+    group -- [str]
+        Column within which ranks are compared, e.g. impute_id.
+    atol -- [float or None]
+        Largest absolute difference accepted.
+    rank_tol -- [float or None]
+        Largest rank change accepted, as a fraction of the group's rows.
+    mean_atol -- [float or None]
+        Largest mean absolute difference accepted.
+        Tolerances of None are not checked.
+
+    Output
+    ------
+    [Pandas DataFrame]
+        One row per column: n_rows, max_abs_diff, mean_abs_diff,
+        max_rank_diff (fraction of the group's rows) and passed.
+    """
+    present = [column for column in columns if column in candidate.columns]
+    joined = normalize_keys(reference[keys + columns], keys).merge(
+        normalize_keys(candidate[keys + present], keys), on=keys, how='left', suffixes=('', '__candidate'), indicator=True
+    )
+    matched = (joined['_merge'] == 'both').to_numpy()
+    sizes = joined.groupby(group)[keys[0]].transform('size').to_numpy()
+
+    rows = []
+    for column in columns:
+        row = {'column': column, 'n_rows': int(reference.shape[0])}
+        if column not in present or not matched.all():
+            row.update({'max_abs_diff': np.nan, 'mean_abs_diff': np.nan, 'max_rank_diff': np.nan, 'passed': False})
+            rows.append(row)
+            continue
+        a = joined[column].to_numpy(dtype=np.float64)
+        b = joined[f'{column}__candidate'].to_numpy(dtype=np.float64)
+        diff = np.abs(a - b)
+        rank_a = joined.assign(_value=a).groupby(group)['_value'].rank().to_numpy()
+        rank_b = joined.assign(_value=b).groupby(group)['_value'].rank().to_numpy()
+        rank_diff = np.abs(rank_a - rank_b) / sizes
+        same_nan = np.isnan(a) == np.isnan(b)
+        row.update({
+            'max_abs_diff': float(np.nanmax(diff)) if diff.size else 0.0,
+            'mean_abs_diff': float(np.nanmean(diff)) if diff.size else 0.0,
+            'max_rank_diff': float(np.nanmax(rank_diff)) if diff.size else 0.0,
+        })
+        checks = [(row['max_abs_diff'], atol), (row['mean_abs_diff'], mean_atol), (row['max_rank_diff'], rank_tol)]
+        row['passed'] = bool(same_nan.all() and all(value <= tol for value, tol in checks if tol is not None))
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def normalize_keys(df, keys):
+    """Person ids (keys[0]) as strings and imputation groups (keys[1])
+    as integers, whatever dtype ML_setup or the integer keys left them in."""
+    return df.astype({keys[0]: str, keys[1]: np.int64})
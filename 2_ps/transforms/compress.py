@@ -0,0 +1,160 @@
+##################################################
+## Project: Real World Evidence to Accelerate COVID-19 Therapeutics
+## Contract No.: 75FCMC18D0047
+## Purpose: Functions to fit models on duplicate-compressed design matrices
+## Date: May 2022
+## Developers: Alexander Wood
+## Copyright 2022, The MITRE Corporation
+## Approved for Public Release; Distribution Unlimited. Public Release Case Number 22-1741.
+##################################################
+
+# No transforms imports here: 2_drs/transforms/fold_search.py loads this file
+# directly, outside of the 2_ps transforms package.
+import numpy as np
+from scipy import sparse
+from sklearn.utils.class_weight import compute_class_weight
+
+
+# Only fit on the compressed matrix when it has at most this fraction
+# of the original rows; otherwise the bookkeeping is not worth it.
+MAX_COMPRESSION_RATIO = 0.5
+
+# Solvers always fitted on the full rows: their step size does not account
+# for sample weights, and with large duplicate counts they stop converging.
+UNCOMPRESSED_SOLVERS = ['sag', 'saga']
+
+# Number of fit_compressed calls that fitted on compressed and on full rows.
+_FIT_COUNTS = {'compressed': 0, 'full': 0}
+
+
+def compress_rows(X, y=None, sample_weight=None):
+    """Collapse identical rows.
+
+    Rows of X (together with y, when given) are hashed by their raw
+    bytes and grouped, so that every distinct (features, target)
+    pattern appears once.
+
+    Input
+    -----
+    X -- [numpy array]
+        Design matrix, shape (n, p).
+    y -- [numpy array or None]
+        Target, shape (n,).
+    sample_weight -- [numpy array or None]
+        Weights of the rows of X, shape (n,).
+
+    Output
+    ------
+    X_unique -- [numpy array]
+        The distinct rows, shape (k, p).
+    y_unique -- [numpy array or None]
+        Their targets.
+    weights -- [numpy array]
+        Summed sample_weight (the number of rows without it) of the
+        original rows collapsed into each distinct row.
+    inverse -- [numpy array]
+        Index of the distinct row of every original row, so that
+        X_unique[inverse] == X.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    # +0.0 turns -0.0 into 0.0 so that equal values have equal bytes.
+    keys = X + 0.0 if y is None else np.column_stack([X + 0.0, np.asarray(y, dtype=np.float64)])
+    keys = np.ascontiguousarray(keys)
+    row_view = keys.view(np.dtype((np.void, keys.dtype.itemsize * keys.shape[1]))).ravel()
+
+    _, first, inverse = np.unique(row_view, return_index=True, return_inverse=True)
+    inverse = inverse.ravel()
+    weights = np.bincount(
+        inverse, weights=None if sample_weight is None else np.asarray(sample_weight, dtype=np.float64),
+        minlength=len(first)
+    ).astype(np.float64)
+    y_unique = None if y is None else np.asarray(y)[first]
+    return X[first], y_unique, weights, inverse
+
+
+def compress_fit_rows(X, y, sample_weight=None, max_ratio=MAX_COMPRESSION_RATIO):
+    """compress_rows of a training set, when it is worth fitting on.
+
+    Output
+    ------
+    compressed -- [tuple or None]
+        (X_unique, y_unique, weights) of compress_rows, or None when X is
+        sparse or does not compress below max_ratio.
+    """
+    if sparse.issparse(X):
+        return None
+    X_unique, y_unique, weights, _ = compress_rows(X, y, sample_weight)
+    if X_unique.shape[0] > max_ratio * X.shape[0]:
+        return None
+    return X_unique, y_unique, weights
+
+
+def fit_compressed(model, X, y, sample_weight=None, max_ratio=MAX_COMPRESSION_RATIO, compressed=None):
+    """Fit a model on the distinct (row, target) patterns of X, y.
+
+    Duplicates become sample weights (times sample_weight, summed over
+    the collapsed rows), so the fitted model minimizes the same objective
+    as a fit on the full data. class_weight='balanced' is resolved from
+    the full y and folded into the sample weights, because sklearn would
+    otherwise compute it from the distinct rows; the model's class_weight
+    parameter is left as it is.
+
+    The model is fitted on X directly when the data does not compress
+    below max_ratio, and for the UNCOMPRESSED_SOLVERS.
+
+    compressed -- [tuple or None]
+        compress_fit_rows(X, y, sample_weight) computed beforehand, so
+        that several models fitted on the same X compress it only once.
+        Without it, X is compressed here.
+
+    Output
+    ------
+    model -- The fitted model.
+    compressed -- [bool]
+        Whether it was fitted on the compressed rows.
+    """
+    if model.get_params().get('solver') in UNCOMPRESSED_SOLVERS:
+        _FIT_COUNTS['full'] += 1
+        return model.fit(X, y, sample_weight=sample_weight), False
+
+    if compressed is None:
+        compressed = compress_fit_rows(X, y, sample_weight, max_ratio)
+        if compressed is not None:
+            print(f"\tFitting on {compressed[0].shape[0]} distinct rows of {X.shape[0]}.")
+    if compressed is None:
+        _FIT_COUNTS['full'] += 1
+        return model.fit(X, y, sample_weight=sample_weight), False
+
+    X_unique, y_unique, weights = compressed
+    _FIT_COUNTS['compressed'] += 1
+    if model.get_params().get('class_weight') != 'balanced':
+        return model.fit(X_unique, y_unique, sample_weight=weights), True
+
+    classes = np.unique(y)
+    balanced = compute_class_weight('balanced', classes=classes, y=y)
+    weights = weights * balanced[np.searchsorted(classes, y_unique)]
+    model.set_params(class_weight=None)
+    try:
+        model.fit(X_unique, y_unique, sample_weight=weights)
+    finally:
+        model.set_params(class_weight='balanced')
+    return model, True
+
+
+def fit_counts(reset=False):
+    """Number of fit_compressed fits on compressed and on full rows so far.
+
+    With reset, the counts are set back to 0 after reading them.
+    """
+    counts = dict(_FIT_COUNTS)
+    if reset:
+        _FIT_COUNTS.update({'compressed': 0, 'full': 0})
+    return counts
+
+
+def predict_proba_compressed(model, X, max_ratio=MAX_COMPRESSION_RATIO):
+    """predict_proba over all rows of X, scoring each distinct row once."""
+    X_unique, _, _, inverse = compress_rows(X)
+    if X_unique.shape[0] > max_ratio * X.shape[0]:
+        return model.predict_proba(X)
+    return model.predict_proba(X_unique)[inverse]
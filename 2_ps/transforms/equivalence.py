@@ -0,0 +1,376 @@
+##################################################
+## Project: Real World Evidence to Accelerate COVID-19 Therapeutics
+## Contract No.: 75FCMC18D0047
+## Purpose: Functions to check that the fast paths of the PS pipeline reproduce the reference scores
+## Date: May 2022
+## Developers: Alexander Wood
+## Copyright 2022, The MITRE Corporation
+## Approved for Public Release; Distribution Unlimited. Public Release Case Number 22-1741.
+##################################################
+
+import importlib
+import tempfile
+import time
+from contextlib import contextmanager
+from functools import reduce
+
+import numpy as np
+import pandas as pd
+from sklearn.model_selection import ParameterGrid
+
+from transforms.balance import select_best_model
+from transforms.compare import synthetic_cohort, compare_columns, normalize_keys
+from transforms.compress import fit_counts
+from transforms.keys import intern_keys, decode_keys, restore_key_dtypes, save_dictionary
+
+
+# Module constants of the reference pipeline: every performance mode off.
+REFERENCE_SETTINGS = {
+    'ML_setup': {'ENCODE_FROM_CODES': False},
+    'ML_LR': {'COMPRESS_ROWS': False, 'AUTOTUNE_SOLVER': False, 'CONTROL_SAMPLING_RATE': None},
+    'ML_RF': {'CONTROL_SAMPLING_RATE': None},
+    'ML_GBT': {'CONTROL_SAMPLING_RATE': None, 'BALANCE_EARLY_STOPPING': False},
+}
+
+# Model stages, in the order main_ps.py runs them.
+MODEL_STAGES = ['ML_LR', 'ML_RF', 'ML_GBT']
+
+# ML_LR.PARAM_GRID with a solver whose fits compress_rows applies to.
+LIBLINEAR_GRID = ParameterGrid([
+    {
+        'penalty': ['l1', 'l2'],
+        'C': [0.01, 0.1],
+        'solver': ['liblinear'],
+        'max_iter': [500],
+        'class_weight': ['balanced']
+    }
+])
+
+# Fast paths checked against the reference pipeline:
+#     stages    -- stages the fast path changes; their run times give the speedup.
+#                  Fast paths that change ML_setup also compare the design matrix.
+#     reference -- module constants set on top of REFERENCE_SETTINGS in both
+#                  runs; when given, the stages are rerun with them as the
+#                  fast path's own reference.
+#     settings  -- module constants set on top of the reference settings.
+#     options   -- run_pipeline options (prediction_store, integer_keys).
+#     atol      -- largest absolute score difference accepted.
+#     mean_atol -- largest mean absolute score difference accepted.
+#     rank_tol  -- largest change of a row's rank within its imputation group
+#                  accepted, as a fraction of the group's rows.
+#     min_compressed_fits -- fewest fits on compressed rows (compress.fit_counts)
+#                  for the fast path to count as tested; with fewer it ran the
+#                  reference code.
+# A tolerance (or min_compressed_fits) of None is not checked. sag/saga fits
+# are never compressed, so lr_compress_rows compares fits of LIBLINEAR_GRID
+# with and without compression. The prediction store keeps float32
+# scores, which can reorder near-ties. The autotuned solver may pick
+# liblinear, which also penalizes the intercept. Case-control sampling is an
+# approximation whose single-row scores move with the sample, and balance
+# early stopping keeps fewer boosting stages, so only their mean shift and
+# the balance-selected model are checked.
+FAST_PATHS = {
+    'encode_from_codes': {
+        'stages': ['ML_setup'],
+        'reference': {},
+        'settings': {'ML_setup': {'ENCODE_FROM_CODES': True}},
+        'options': {},
+        'atol': 1e-12, 'mean_atol': None, 'rank_tol': 0.0,
+        'min_compressed_fits': None,
+    },
+    'lr_compress_rows': {
+        'stages': ['ML_LR'],
+        'reference': {'ML_LR': {'PARAM_GRID': LIBLINEAR_GRID}},
+        'settings': {'ML_LR': {'COMPRESS_ROWS': True}},
+        'options': {},
+        'atol': 1e-4, 'mean_atol': None, 'rank_tol': 0.01,
+        'min_compressed_fits': 1,
+    },
+    'lr_autotune_solver': {
+        'stages': ['ML_LR'],
+        'reference': {},
+        'settings': {'ML_LR': {'AUTOTUNE_SOLVER': True}},
+        'options': {},
+        'atol': 0.05, 'mean_atol': 0.01, 'rank_tol': 0.05,
+        'min_compressed_fits': None,
+    },
+    'case_control': {
+        'stages': MODEL_STAGES,
+        'reference': {},
+        'settings': {stage: {'CONTROL_SAMPLING_RATE': 0.5} for stage in MODEL_STAGES},
+        'options': {},
+        'atol': None, 'mean_atol': 0.05, 'rank_tol': None,
+        'min_compressed_fits': None,
+    },
+    'gbt_balance_stopping': {
+        'stages': ['ML_GBT'],
+        'reference': {},
+        'settings': {'ML_GBT': {'BALANCE_EARLY_STOPPING': True}},
+        'options': {},
+        'atol': None, 'mean_atol': 0.05, 'rank_tol': None,
+        'min_compressed_fits': None,
+    },
+    'prediction_store': {
+        'stages': MODEL_STAGES + ['merge_models'],
+        'reference': {},
+        'settings': {},
+        'options': {'prediction_store': True},
+        'atol': 1e-6, 'mean_atol': None, 'rank_tol': 0.01,
+        'min_compressed_fits': None,
+    },
+    'integer_keys': {
+        'stages': ['ML_setup'] + MODEL_STAGES + ['merge_models'],
+        'reference': {},
+        'settings': {},
+        'options': {'integer_keys': True},
+        'atol': 0.0, 'mean_atol': None, 'rank_tol': 0.0,
+        'min_compressed_fits': None,
+    },
+}
+
+# Columns of the comparison report.
+REPORT_COLUMNS = [
+    'cohort', 'fast_path', 'table', 'column', 'n_rows',
+    'max_abs_diff', 'mean_abs_diff', 'max_rank_diff', 'passed'
+]
+
+
+# ############################################################################# #
+# SETTINGS                                                                      #
+# ############################################################################# #
+@contextmanager
+def override_settings(settings):
+    """Temporarily set module constants, e.g. {'ML_LR': {'COMPRESS_ROWS': False}}.
+
+    transforms/__init__.py re-exports the functions under the module names,
+    so the modules are looked up with importlib.
+    """
+    saved = []
+    try:
+        for module_name, values in settings.items():
+            module = importlib.import_module(f'transforms.{module_name}')
+            for name, value in values.items():
+                assert hasattr(module, name), f"transforms.{module_name} has no setting {name}."
+                saved.append((module, name, getattr(module, name)))
+                setattr(module, name, value)
+        yield
+    finally:
+        for module, name, value in reversed(saved):
+            setattr(module, name, value)
+
+
+def merge_settings(*settings):
+    """Combine settings dicts; later values win."""
+    merged = {}
+    for setting in settings:
+        for module_name, values in setting.items():
+            merged.setdefault(module_name, {}).update(values)
+    return merged
+
+
+# ############################################################################# #
+# PIPELINE                                                                      #
+# ############################################################################# #
+def run_pipeline(df, configs, settings, stages, INDEX_ID, INDEX_IMPUTATION_ID, INDEX_COLUMNS, TARGET_COLUMNS,
+                 design=None, prediction_store=False, integer_keys=False):
+    """Run ML_setup, the model stages and the merge as main_ps.py does.
+
+    Input
+    -----
+    df -- [Pandas DataFrame]
+        Output of get_dataframe.
+    configs -- [Pandas DataFrame]
+        Output of get_configs.
+    settings -- [dict]
+        Module constants, see override_settings.
+    stages -- [list of str]
+        Model stages to run (of MODEL_STAGES).
+    design -- [Pandas DataFrame or None]
+        An ML_setup output to reuse. None runs ML_setup.
+    prediction_store, integer_keys -- [bool]
+        Run with the prediction store and the integer person keys, as
+        main_ps.py does with use_prediction_store and use_integer_keys.
+
+    Output
+    ------
+    design -- [Pandas DataFrame]
+        The ML_setup output, with decoded person ids.
+    scores -- [Pandas DataFrame]
+        The merged model scores (merge_models.csv), with decoded person ids.
+    timings -- [dict]
+        Run time in seconds of every stage run.
+    fits -- [dict]
+        Number of model fits on compressed and on full rows
+        (compress.fit_counts) during the run.
+    """
+    from transforms import ML_setup, ML_LR, ML_RF, ML_GBT
+    from transforms.merge_models import merge
+    from transforms.prediction_store import create_prediction_store, materialize_wide
+
+    functions = {'ML_LR': ML_LR, 'ML_RF': ML_RF, 'ML_GBT': ML_GBT}
+    timings = {}
+    fit_counts(reset=True)
+    with override_settings(settings), tempfile.TemporaryDirectory() as tmp:
+        dictionary, dictionary_path = None, None
+        if design is None:
+            start = time.perf_counter()
+            if integer_keys:
+                codes, dictionary = intern_keys(df[INDEX_ID])
+                df = df.assign(**{INDEX_ID: codes})
+            design = ML_setup(df, configs, INDEX_IMPUTATION_ID, False, False)
+            if integer_keys:
+                design = restore_key_dtypes(design, INDEX_ID, INDEX_IMPUTATION_ID)
+            timings['ML_setup'] = time.perf_counter() - start
+        elif integer_keys:
+            codes, dictionary = intern_keys(design[INDEX_ID])
+            design = design.assign(**{INDEX_ID: codes})
+
+        store = None
+        if prediction_store:
+            store = f'{tmp}/predictions'
+            if integer_keys:
+                dictionary_path = f'{tmp}/person_ids.npy'
+                save_dictionary(dictionary, dictionary_path)
+            create_prediction_store(design, store, INDEX_ID, INDEX_IMPUTATION_ID, TARGET_COLUMNS, dictionary_path)
+
+        frame, outputs = design.copy(), []
+        for stage in [stage for stage in MODEL_STAGES if stage in stages]:
+            start = time.perf_counter()
+            outputs.append(functions[stage](
+                frame, INDEX_ID, INDEX_IMPUTATION_ID, INDEX_COLUMNS, TARGET_COLUMNS, False, False, store
+            ))
+            timings[stage] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        if prediction_store:
+            scores = materialize_wide(store)
+        else:
+            scores = reduce(lambda left, right: merge(left, right, INDEX_ID, INDEX_IMPUTATION_ID, False, False), outputs)
+            if integer_keys:
+                scores[INDEX_ID] = decode_keys(scores[INDEX_ID], dictionary)
+        timings['merge_models'] = time.perf_counter() - start
+
+    if integer_keys:
+        design = design.assign(**{INDEX_ID: decode_keys(design[INDEX_ID], dictionary)})
+    return design, scores, timings, fit_counts(reset=True)
+
+
+# ############################################################################# #
+# COMPARISON                                                                    #
+# ############################################################################# #
+def check_fast_paths(df, configs, fast_paths, INDEX_ID, INDEX_IMPUTATION_ID, INDEX_COLUMNS, TARGET_COLUMNS, cohort='toy'):
+    """Compare fast paths with the reference pipeline on one cohort.
+
+    The reference pipeline (REFERENCE_SETTINGS) runs once. Every fast path
+    then reruns the stages it changes: from ML_setup when it changes
+    ML_setup, otherwise from the reference design matrix. Scores (and,
+    from ML_setup, the design matrix) are compared column by column. Each
+    run's candidate models are also ranked by covariate balance
+    (transforms/balance.py), to check that the same model is selected.
+
+    Input
+    -----
+    df -- [Pandas DataFrame]
+        Output of get_dataframe.
+    configs -- [Pandas DataFrame]
+        Output of get_configs.
+    fast_paths -- [dict]
+        Fast path name -> entry as in FAST_PATHS.
+    cohort -- [str]
+        Cohort name for the reports.
+
+    Output
+    ------
+    report -- [Pandas DataFrame]
+        One row per (fast path, compared column), see REPORT_COLUMNS.
+    summary -- [Pandas DataFrame]
+        One row per fast path: columns failed, largest differences,
+        balance-selected best model of each run and its mean absolute SMD,
+        run times, speedup, fits on compressed and on full rows, and
+        whether the fast path was tested (see min_compressed_fits).
+        passed is only True for tested fast paths.
+    """
+    keys = [INDEX_ID, INDEX_IMPUTATION_ID]
+    index = (INDEX_ID, INDEX_IMPUTATION_ID, INDEX_COLUMNS, TARGET_COLUMNS)
+
+    print(f"{cohort}: running the reference pipeline.")
+    ref_design, ref_scores, ref_timings, _ = run_pipeline(df, configs, REFERENCE_SETTINGS, MODEL_STAGES, *index)
+    covariates = [
+        column for column in ref_design.columns
+        if column not in INDEX_COLUMNS + TARGET_COLUMNS and not column.startswith('model_')
+    ]
+
+    reports, summaries = [], []
+    for name, fast_path in fast_paths.items():
+        stages = [stage for stage in MODEL_STAGES if stage in fast_path['stages']] or MODEL_STAGES
+        rerun_setup = 'ML_setup' in fast_path['stages']
+        base_settings = merge_settings(REFERENCE_SETTINGS, fast_path['reference'])
+        base_design, base_scores, base_timings = ref_design, ref_scores, ref_timings
+        if fast_path['reference']:
+            print(f"{cohort}: running the reference of fast path {name}.")
+            base_design, base_scores, base_timings, _ = run_pipeline(
+                df, configs, base_settings, stages, *index, design=None if rerun_setup else ref_design
+            )
+
+        print(f"{cohort}: running fast path {name}.")
+        settings = merge_settings(base_settings, fast_path['settings'])
+        design, scores, timings, fits = run_pipeline(
+            df, configs, settings, stages, *index,
+            design=None if rerun_setup else ref_design, **fast_path['options']
+        )
+
+        families = [stage.split('_')[1].lower() for stage in stages]
+        score_columns = [
+            column for column in base_scores.columns
+            if column.startswith('model_') and column.split('_')[1] in families
+        ]
+        tables = [('scores', base_scores, scores, score_columns)]
+        if rerun_setup:
+            tables.append(('design', base_design, design, [c for c in base_design.columns if c not in keys]))
+        for table, reference, candidate, columns in tables:
+            report = compare_columns(reference, candidate, columns, keys, INDEX_IMPUTATION_ID,
+                                     fast_path['atol'], fast_path['rank_tol'], fast_path['mean_atol'])
+            reports.append(report.assign(cohort=cohort, fast_path=name, table=table))
+
+        # Balance-selected best model among the compared candidates.
+        ref_best, ref_smd = _best_model(base_design, base_scores, covariates, keys, TARGET_COLUMNS[0], score_columns)
+        fast_best, fast_smd = _best_model(design, scores, covariates, keys, TARGET_COLUMNS[0], score_columns)
+
+        timed = [stage for stage in fast_path['stages'] if stage in timings]
+        time_reference = sum(base_timings[stage] for stage in timed)
+        time_fast = sum(timings[stage] for stage in timed)
+        report = pd.concat(reports[-len(tables):], ignore_index=True)
+        summaries.append({
+            'cohort': cohort,
+            'fast_path': name,
+            'n_rows': int(df.shape[0]),
+            'n_columns': int(report.shape[0]),
+            'n_failed': int((~report['passed']).sum()),
+            'max_abs_diff': report['max_abs_diff'].max(),
+            'max_rank_diff': report['max_rank_diff'].max(),
+            'best_model_reference': ref_best,
+            'best_model_fast': fast_best,
+            'best_model_match': ref_best == fast_best,
+            'best_smd_reference': ref_smd,
+            'best_smd_fast': fast_smd,
+            'time_reference': time_reference,
+            'time_fast': time_fast,
+            'speedup': time_reference / time_fast if time_fast > 0 else np.nan,
+            'n_compressed_fits': fits['compressed'],
+            'n_full_fits': fits['full'],
+            'tested': fast_path['min_compressed_fits'] is None or fits['compressed'] >= fast_path['min_compressed_fits'],
+        })
+        summary = summaries[-1]
+        summary['passed'] = summary['tested'] and summary['n_failed'] == 0 and summary['best_model_match']
+        if not summary['tested']:
+            print(f"{cohort}: fast path {name} made {fits['compressed']} compressed fits, so it is untested.")
+
+    report = pd.concat(reports, ignore_index=True)[REPORT_COLUMNS] if reports else pd.DataFrame(columns=REPORT_COLUMNS)
+    return report, pd.DataFrame(summaries)
+
+
+def _best_model(design, scores, covariates, keys, TARGET_COLUMN, model_columns):
+    joined = normalize_keys(design[keys + [TARGET_COLUMN] + covariates], keys)\
+        .merge(normalize_keys(scores[keys + model_columns], keys), on=keys)
+    summary, best_model = select_best_model(joined, model_columns, covariates, TARGET_COLUMN)
+    return best_model, summary['mean_abs_smd'].iloc[0]
@@ -0,0 +1,225 @@
+##################################################
+## Project: Real World Evidence to Accelerate COVID-19 Therapeutics
+## Contract No.: 75FCMC18D0047
+## Purpose: Functions to encode an imputed table once into a typed, memory-mappable feature store
+## Date: May 2022
+## Developers: Alexander Wood
+## Copyright 2022, The MITRE Corporation
+## Approved for Public Release; Distribution Unlimited. Public Release Case Number 22-1741.
+##################################################
+
+# No transforms imports here: the 2_drs main scripts load this file
+# directly, outside of the 2_ps transforms package.
+import json
+import os
+import re
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+# Storage matrix of each column kind. Strings are dictionary encoded: the
+# codes matrix holds the index into the column's categories (-1 for null).
+STORE_MATRICES = {
+    'float': np.float64,
+    'int': np.int64,
+    'category': np.int32,
+}
+
+# Python type of the categories of a category column (read_csv gives an
+# object column for e.g. booleans with nulls), restored on load. Columns
+# whose categories mix types are stored as str.
+CATEGORY_TYPES = {
+    'bool': bool,
+    'int': int,
+    'float': float,
+    'str': str,
+}
+
+# Bumped when the store layout changes, so that older stores are rebuilt.
+STORE_VERSION = 2
+
+
+# ############################################################################# #
+# BUILD                                                                         #
+# ############################################################################# #
+def build_feature_store(source, configs, path):
+    """Encode an imputed table once into a feature store.
+
+    Every column of the source csv is parsed once and stored in one of
+    three memory-mappable matrices (float.npy, int.npy, category.npy),
+    in Fortran order so that each column is contiguous on disk.
+    catalog.json lists, for every column in the original column order,
+    its matrix, position, dtype, categories with their type (bool, int,
+    float or str, see CATEGORY_TYPES) and the ps/drs flags of the
+    matching configs row (exact variable name, or a regex pattern row
+    such as condition_[\\w\\d]+_vs). Columns absent from configs
+    (outcomes, identifiers not used as covariates) are stored with both
+    flags False so that they can still be requested explicitly.
+
+    The store is rebuilt only when the source file or configs change.
+
+    Input
+    -----
+    source -- [str or Path]
+        Imputed csv, e.g. 1_imputation/data/mab_patient_effect_imputed.csv
+    configs -- [Pandas DataFrame]
+        configs.csv, loaded direct from file.
+    path -- [str or Path]
+        Directory of the store. Created if it does not exist.
+
+    Output
+    ------
+    [dict]
+        The catalog.
+    """
+    source, path = Path(source), Path(path)
+    signature = _signature(source, configs)
+
+    catalog_path = path / 'catalog.json'
+    if catalog_path.exists():
+        with open(catalog_path) as f:
+            catalog = json.load(f)
+        if catalog['signature'] == signature:
+            print(f"Feature store {path} is up to date.")
+            return catalog
+
+    df = pd.read_csv(source)
+    path.mkdir(parents=True, exist_ok=True)
+
+    columns, blocks = [], {kind: [] for kind in STORE_MATRICES}
+    for column in df.columns:
+        series = df[column]
+        entry = {'name': column, 'dtype': str(series.dtype)}
+        if pd.api.types.is_float_dtype(series):
+            entry['kind'] = 'float'
+            values = series.to_numpy(dtype=np.float64)
+        elif pd.api.types.is_integer_dtype(series) or pd.api.types.is_bool_dtype(series):
+            entry['kind'] = 'int'
+            values = series.to_numpy(dtype=np.int64)
+        else:
+            entry['kind'] = 'category'
+            values, categories = pd.factorize(series, sort=True)
+            entry['category_type'] = _category_type(categories)
+            cast = CATEGORY_TYPES[entry['category_type']]
+            entry['categories'] = [cast(category) for category in categories]
+        entry['index'] = len(blocks[entry['kind']])
+        entry['ps'], entry['drs'] = _flags(column, configs)
+        blocks[entry['kind']].append(values)
+        columns.append(entry)
+
+    for kind, dtype in STORE_MATRICES.items():
+        matrix = np.empty((df.shape[0], len(blocks[kind])), dtype=dtype, order='F')
+        for i, values in enumerate(blocks[kind]):
+            matrix[:, i] = values
+        np.save(path / f'{kind}.npy', matrix)
+
+    catalog = {
+        'source': str(source),
+        'signature': signature,
+        'n_rows': int(df.shape[0]),
+        'columns': columns,
+    }
+    # Write the catalog last so that a partial build is never picked up.
+    with open(path / 'catalog.json.tmp', 'w') as f:
+        json.dump(catalog, f, indent=2)
+    os.replace(path / 'catalog.json.tmp', catalog_path)
+
+    print(f"Feature store {path}: {df.shape[0]} rows, {len(columns)} columns.")
+    return catalog
+
+
+def _signature(source, configs):
+    # Store version, source size and modification time plus the config flags the catalog depends on.
+    stat = source.stat()
+    flags = configs[['variable', 'ps', 'drs']].astype(str).to_numpy().tolist()
+    return [STORE_VERSION, stat.st_size, stat.st_mtime_ns, flags]
+
+
+def _category_type(categories):
+    """Name of the CATEGORY_TYPES entry shared by all categories."""
+    values = list(categories)
+    is_bool = [isinstance(value, (bool, np.bool_)) for value in values]
+    if len(values) == 0 or any(is_bool) and not all(is_bool):
+        return 'str'
+    if all(is_bool):
+        return 'bool'
+    if all(isinstance(value, (int, np.integer)) for value in values):
+        return 'int'
+    if all(isinstance(value, (int, float, np.integer, np.floating)) for value in values):
+        return 'float'
+    return 'str'
+
+
+def _flags(column, configs):
+    """ps/drs flags of the configs row matching a column name."""
+    rows = configs[configs['variable'] == column]
+    if rows.shape[0] == 0:
+        patterns = [
+            variable for variable in configs['variable']
+            if not re.fullmatch(r'\w+', variable) and re.fullmatch(variable, column)
+        ]
+        rows = configs[configs['variable'].isin(patterns[:1])]
+    if rows.shape[0] == 0:
+        return False, False
+    row = rows.iloc[0]
+    return bool(row['ps'] == True), bool(row['drs'] == True)
+
+
+# ############################################################################# #
+# LOAD                                                                          #
+# ############################################################################# #
+def load_features(path, flag=None, include=None):
+    """Select columns from a feature store as a DataFrame.
+
+    Input
+    -----
+    path -- [str or Path]
+        Directory written by build_feature_store.
+    flag -- [str or None]
+        'ps' or 'drs' to select the columns flagged in configs.csv;
+        None selects every column.
+    include -- [list of str or None]
+        Additional columns to select regardless of flag (e.g. outcomes).
+
+    Output
+    ------
+    [Pandas DataFrame]
+        The selected columns, in source order, with the dtypes and
+        values read_csv gives for the source file.
+    """
+    path = Path(path)
+    assert (path / 'catalog.json').exists(), \
+           f"No feature store at {path}, run python 2_ps/main_feature_store.py first"
+    with open(path / 'catalog.json') as f:
+        catalog = json.load(f)
+
+    include = set(include or [])
+    selected = [
+        entry for entry in catalog['columns']
+        if flag is None or entry[flag] or entry['name'] in include
+    ]
+    missing = include - {entry['name'] for entry in catalog['columns']}
+    assert len(missing) == 0, f"Columns {sorted(missing)} are not in the feature store."
+
+    matrices = {
+        kind: np.load(path / f'{kind}.npy', mmap_mode='r') for kind in STORE_MATRICES
+    }
+    data = {}
+    for entry in selected:
+        values = matrices[entry['kind']][:, entry['index']]
+        if entry['kind'] == 'category':
+            data[entry['name']] = pd.Categorical.from_codes(
+                values, categories=_categories(entry)
+            ).astype(object)
+        else:
+            data[entry['name']] = np.array(values, dtype=entry['dtype'])
+
+    return pd.DataFrame(data)
+
+
+def _categories(entry):
+    # Categories in their original type; stores without category_type hold strings.
+    cast = CATEGORY_TYPES[entry.get('category_type', 'str')]
+    return pd.Index([cast(category) for category in entry['categories']], dtype=object)
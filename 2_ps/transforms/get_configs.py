@@ -8,12 +8,18 @@
 ## Approved for Public Release; Distribution Unlimited. Public Release Case Number 22-1741.
 ##################################################
 
+import hashlib
 import re
 import warnings
 
 import pandas as pd
 
 
+# Compiled config plans, keyed by a hash of the configs table, the input
+# header and the column patterns.
+_PLAN_CACHE = {}
+
+
 def get_configs(df, configs, INDEX_ID, INDEX_IMPUTATION_ID, INDEX_IMPUTATION_FLAG, INDEX_COLUMNS, TARGET_COLUMNS, COVID_COLUMN_PATTERN, CONDITION_COLUMN_PATTERN, RUN_DEBUG = False):
     """Load configurations from file.
 
@@ -43,85 +49,23 @@ def get_configs(df, configs, INDEX_ID, INDEX_IMPUTATION_ID, INDEX_IMPUTATION_FLA
     from transforms.global_utils import print_setup, print_list, get_report, display_dict
 
     # ########################################################################
-    # QUALITY CONTROL                                                        #
+    # QUALITY CONTROL AND SETUP CONFIGS FOR PS                               #
     # ########################################################################
-    # Verify that the data config file is up-to-date with the dataset.
-    df_only_cols, configs_only_cols = [], configs['variable'].values.tolist()
+    plan = compile_config_plan(df.columns, configs, COVID_COLUMN_PATTERN, CONDITION_COLUMN_PATTERN)
 
-    # Regex patterns
-    # Initialize to False; may change below.
-    use_condition, use_covid = False, False
-    ssri_column_pattern = "ssri_[\w\d]+_prev90days"
-    if ssri_column_pattern in configs_only_cols:
-        configs_only_cols.remove(ssri_column_pattern)
-    if CONDITION_COLUMN_PATTERN in configs_only_cols:
-        use_condition = configs[configs['variable']==CONDITION_COLUMN_PATTERN]['ps'].values[0]
-        configs_only_cols.remove(CONDITION_COLUMN_PATTERN)
-    if COVID_COLUMN_PATTERN in configs_only_cols:
-        use_covid = configs[configs['variable']==COVID_COLUMN_PATTERN]['ps'].values[0]
-        configs_only_cols.remove(COVID_COLUMN_PATTERN)
-
-    # Find columns only present in dataframe or only present in configs.
-    for col in df.columns:
-        if col in configs_only_cols:
-            configs_only_cols.remove(col)
-        elif re.fullmatch(CONDITION_COLUMN_PATTERN, col):
-            # Regex pattern match
-            continue
-        elif re.fullmatch(COVID_COLUMN_PATTERN, col):
-            # Regex pattern match
-            continue
-        elif re.fullmatch(ssri_column_pattern, col):
-            continue
-        else:
-            df_only_cols.append(col)
-
-
-    for col in df_only_cols:
+    # Verify that the data config file is up-to-date with the dataset.
+    for col in plan['df_only_cols']:
         warnings.warn(f"Column {col} is present in dataframe but absent in configs.")
 
-    for col in configs_only_cols:
+    for col in plan['configs_only_cols']:
         warnings.warn(f"Column {col} is present in configs but not present in dataframe.")
 
-
-    # Limit to propensity score variables.
-    configs = configs[configs.ps==1]
-
-    # ########################################################################
-    # SETUP CONFIGS FOR PS                                                   #
-    # ########################################################################
-
     if RUN_DEBUG:
-        print('Nubmer of rows in configs:', configs.shape)
-
-    # Drop the drs and ps marker columns.
-    configs = configs.drop(columns=['ps', 'drs'])
+        print('Nubmer of rows in configs:', plan['n_ps_rows'])
 
     # For output display in debug mode.
-    unused_columns = []
-
-    for column in df.columns:
-        # There are two patterns of column names we are matching:
-        #      condition_*_ps
-        #      covid19_*_ps
-        if use_condition and re.fullmatch(CONDITION_COLUMN_PATTERN, column):
-            # Columns: "condition_[\w\d]+_vs"
-            reference_row = configs[configs["variable"]==CONDITION_COLUMN_PATTERN]
-        elif use_covid and re.fullmatch(COVID_COLUMN_PATTERN, column):
-            # Columns: covid19_*_ps
-            reference_row = configs[configs["variable"]==COVID_COLUMN_PATTERN]
-        elif configs.loc[configs['variable']==column].shape[0]:
-            # All other covariate columns.
-            continue
-        else:
-            # Skip ahead to next column to skip this column
-            # because it is not included in the PS model.
-            unused_columns.append(column)
-            continue
-
-        new_row = {idx: val for idx, val in reference_row.squeeze().iteritems()}
-        new_row['variable'] = column
-        configs = configs.append(new_row, ignore_index=True)
+    unused_columns = plan['unused_columns']
+    configs = plan['configs'].copy()
 
     # Ensure that all index columns and target columns are present in the configs.
     missing_columns = [
@@ -149,7 +93,7 @@ def get_configs(df, configs, INDEX_ID, INDEX_IMPUTATION_ID, INDEX_IMPUTATION_FLA
     # ########################################################################
     # Display variable, dtype, transformer for each column.
     display_fields = ['variable', 'dtype', 'transformer']
-    matrix = [[*config[display_fields]] for _, config in configs.iterrows()]
+    matrix = configs[display_fields].values.tolist()
     fmt = print_setup(matrix)
     print(fmt)
     print(matrix)
@@ -166,3 +110,103 @@ def get_configs(df, configs, INDEX_ID, INDEX_IMPUTATION_ID, INDEX_IMPUTATION_FLA
     print_list(unused_columns, width=90)
 
     return configs
+
+
+# ############################################################################# #
+# CONFIG PLAN                                                                   #
+# ############################################################################# #
+def compile_config_plan(columns, configs, COVID_COLUMN_PATTERN, CONDITION_COLUMN_PATTERN):
+    """Match input columns to configs rows.
+
+    The regex pattern rows (condition_*_vs, covid19_*_vs and the ssri
+    pattern) are compiled into one alternation, so each column is
+    matched once, and exact variable names are looked up in a set. The
+    rows of the expanded pattern columns are built in one batch. Plans
+    are memoized by a hash of (configs, columns, patterns).
+
+    Input
+    -----
+    columns -- [list of str]
+        Header of the input data table.
+    configs -- [Pandas DataFrame]
+        The configurations, loaded direct from file.
+
+    Output
+    ------
+    [dict]
+        configs -- the PS configurations, one row per covariate column;
+        unused_columns -- input columns not used in the PS model;
+        df_only_cols, configs_only_cols -- columns missing from configs
+        or from the input; n_ps_rows -- the shape of the ps rows of configs.
+    """
+    columns = [str(column) for column in columns]
+    ssri_column_pattern = r"ssri_[\w\d]+_prev90days"
+    patterns = [CONDITION_COLUMN_PATTERN, COVID_COLUMN_PATTERN, ssri_column_pattern]
+
+    key = hashlib.sha1(
+        '\n'.join([configs.to_csv(index=False), ','.join(columns)] + patterns).encode()
+    ).hexdigest()
+    if key in _PLAN_CACHE:
+        return _PLAN_CACHE[key]
+
+    # One alternation; the named group of a match tells which pattern matched,
+    # in the order the patterns are listed (as the chained fullmatch calls did).
+    alternation = re.compile('|'.join(f'(?P<p{i}>{pattern})' for i, pattern in enumerate(patterns)))
+    matched = {}
+    for column in columns:
+        match = alternation.fullmatch(column)
+        if match:
+            matched[column] = patterns[int(match.lastgroup[1:])]
+
+    # QUALITY CONTROL
+    variables = configs['variable'].values.tolist()
+    use_condition, use_covid = False, False
+    if CONDITION_COLUMN_PATTERN in variables:
+        use_condition = configs[configs['variable']==CONDITION_COLUMN_PATTERN]['ps'].values[0]
+    if COVID_COLUMN_PATTERN in variables:
+        use_covid = configs[configs['variable']==COVID_COLUMN_PATTERN]['ps'].values[0]
+
+    column_set = set(columns)
+    configs_only_cols = [
+        variable for variable in variables
+        if variable not in column_set and variable not in patterns
+    ]
+    variable_set = set(variables) - set(patterns)
+    df_only_cols = [
+        column for column in columns
+        if column not in variable_set and column not in matched
+    ]
+
+    # SETUP CONFIGS FOR PS
+    # Limit to propensity score variables and drop the drs and ps marker columns.
+    configs = configs[configs.ps==1]
+    n_ps_rows = configs.shape
+    configs = configs.drop(columns=['ps', 'drs'])
+
+    # There are two patterns of column names we are expanding:
+    #      condition_*_vs
+    #      covid19_*_vs
+    expand = {CONDITION_COLUMN_PATTERN: use_condition, COVID_COLUMN_PATTERN: use_covid}
+    ps_variables = set(configs['variable'].values.tolist())
+    expanded, unused_columns = [], []
+    for column in columns:
+        pattern = matched.get(column)
+        if expand.get(pattern, False):
+            expanded.append((column, pattern))
+        elif column not in ps_variables:
+            unused_columns.append(column)
+
+    if len(expanded):
+        reference_rows = configs.drop_duplicates('variable').set_index('variable', drop=False)
+        new_rows = reference_rows.loc[[pattern for _, pattern in expanded]].copy()
+        new_rows['variable'] = [column for column, _ in expanded]
+        configs = pd.concat([configs, new_rows], ignore_index=True)
+
+    _PLAN_CACHE[key] = {
+        'configs': configs,
+        'unused_columns': unused_columns,
+        'df_only_cols': df_only_cols,
+        'configs_only_cols': configs_only_cols,
+        'n_ps_rows': n_ps_rows,
+    }
+    return _PLAN_CACHE[key]
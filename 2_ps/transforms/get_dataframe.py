@@ -10,11 +10,25 @@
 
 import re
 import warnings
+import numpy as np
 import pandas as pd
 from string import punctuation
 
-def get_dataframe(df, configs, RUN_DEBUG = False):
+from transforms.validate import compile_rules, validate, assert_valid
+from transforms.ML_setup import CATEGORICAL_TRANSFORMERS
+
+def get_dataframe(df, configs, RUN_DEBUG = False, VALIDATION_SAMPLE = None, NUMERIC_FILL_VALUES = None):
     """DataFrame formattting
+
+    After formatting, every column is validated against the rules compiled
+    from configs (see transforms/validate.py): no nulls, numeric bool and
+    numeric columns, bool values in {0, 1}. With VALIDATION_SAMPLE, only a
+    random sample of that many rows is validated.
+
+    NUMERIC_FILL_VALUES (column -> value) replaces the column means used to
+    impute missing numeric values, e.g. with the means over all health
+    systems when a single health-system shard is formatted (transforms/shard.py).
+
     Input
     -----
     df -- [PySpark DataFrame]
@@ -43,10 +57,14 @@ def get_dataframe(df, configs, RUN_DEBUG = False):
     print(str_out)
 
     # Make sure column formats satisfy necessary conditions.
-    df = format_numeric(df, configs)
+    df = format_numeric(df, configs, NUMERIC_FILL_VALUES)
     df = format_onehot(df, configs)
     df = format_bool(df, configs)
 
+    # Validate all columns in one pass.
+    report = validate(df, compile_rules(configs), sample=VALIDATION_SAMPLE)
+    assert_valid(report)
+
     # Should be a redundant check.
     if RUN_DEBUG:
         print('\nNull count by column:')
@@ -81,19 +99,6 @@ def format_bool(df, configs, RUN_DEBUG = False):
     for _, row in configs[configs['dtype']=='bool'].iterrows():
         variable = row.variable
 
-        ############### Make sure we have no null values. ###################
-        # Null values would make Boolean encoding not possible.
-        assert df[variable].isna().sum() == 0 , \
-            f'Failed Check: Null values in Boolean column {variable}.'
-
-        ############# Verify column has 1 or 2 unique values ################
-        # First, make sure there are only two unique values
-        # present in this column. (Or just one, if everyone
-        # has the same value in the column.)
-        assert df[variable].nunique() in [1, 2] , \
-            f"Failed Check: The Boolean variable {variable} takes on " + \
-            "than two possible values."
-
         ################## Map column values to -1 and 1 #####################
         # Now, the values should be 0 and 1.
         # For columns where the are not, map
@@ -120,23 +125,7 @@ def format_bool(df, configs, RUN_DEBUG = False):
                       f'after mapping:{df[variable].unique()}'
             print(str_out)
 
-        ################ Make sure column dtype is numeric #################
-        # Note that is_numeric_dtype(bool) evaluates to True
-        assert pd.api.types.is_numeric_dtype(df[variable]) , \
-            f"Failed Check: The Boolean variable {variable} must be " + \
-            "numeric."
-
-        ############## Make sure every value is either 0 or 1 ###############
-        # Redundant check.
-        assert df[variable].isin([0, 1]).all() , \
-            f"Failed Check: The Boolean variable {variable} " +\
-            "contains non-Boolean values."
-
-        ############## Make sure there are no missing values ################
-        null_count = df[variable].isna().sum()
-        assert df[variable].isna().sum() == 0 , \
-            f"Failed check: The Boolean variable {variable} " +\
-            f"contains {null_count} missing values."
+        # Null, dtype and {0, 1} checks are done by validate() in get_dataframe.
 
     return df
 
@@ -147,8 +136,10 @@ def format_bool(df, configs, RUN_DEBUG = False):
 def format_onehot(df, configs):
     """Format categorical columns.
 
-    Make sure that all categorical columns are cast as object types.
-    Replace all null values with the "unknown" category.
+    Make sure that all categorical columns are cast as pandas Categorical
+    (one-hot columns) or object types (other columns), with labels
+    formatted for one-hot encoding. Replace all null values with the
+    "unknown" category.
 
     Input
     ----
@@ -176,46 +167,79 @@ def format_onehot(df, configs):
 
         ############## Format strings for one-hot encoding. #############
         # Remove white space or invalid characters e.g. []{}&%!@
-        # so that the one-hot encoder creates valid column names
+        # so that the one-hot encoder creates valid column names.
+        # The column is converted to a Categorical and only its distinct
+        # labels are formatted; rows keep their integer codes.
+        df[variable] = normalize_categories(df[variable])
 
-        # Make sure dtype is string.
-        df[variable] = df[variable].astype(str)
+    ################# Cast columns as "object" dtype #####################
+    # Columns encoded in the next pipeline stage (onehot, onehot_capped,
+    # hashing, ordinal) stay Categorical; ML_setup encodes them from their
+    # integer codes. Any other categorical column (e.g. the person_id
+    # passthrough) is cast to type 'object'.
+    cond = (configs['dtype']=='object') & ~configs['transformer'].isin(CATEGORICAL_TRANSFORMERS)
+    columns = configs[cond]['variable'].values.tolist()
+    map_dict = {column: 'object' for column in columns}
+    df = df.astype(map_dict)
 
-        # Special characters in our case are the regular set of
-        # special characters, minus the underscore.
-        special_chars = punctuation.replace('_', '')
-        df[variable] = df[variable].replace('[^\w\s_-]', '', regex=True)
+    return df
 
-        # Replace whitespace with dash.
-        df[variable] = df[variable].replace(' ', '-')
 
-        # Replace underscore with dash
-        df[variable] = df[variable].replace('_', '')
+def normalize_categories(series):
+    """Format the labels of a categorical column.
 
-        # Enforce lower case.
-        df[variable] = df[variable].str.lower()
+    Applies the string formatting of format_onehot (cast as string,
+    remove special characters, lower case) to the distinct labels of
+    the column only, then remaps the integer codes. Labels that become
+    equal after formatting are merged. Nulls become the label 'nan', as
+    a cast to string would give.
 
-        ############## Make sure no missing values remain ###############
-        null_count = df[variable].isna().sum()
-        assert df[variable].isna().sum() == 0 , \
-            f"Failed check: The categorical variable {variable} " +\
-            f"contains {null_count} missing values."
+    Input
+    ----
+    series -- [Pandas Series]
+        A categorical column.
 
-    ################# Cast columns as "object" dtype #####################
-    # Now, cast this column to have type 'object'.
-    # The column *must* have type 'object' in order
-    # to be one-hot encoded in the next pipeline stage.
-    columns = configs[configs['dtype']=='object']['variable'].values.tolist()
-    map_dict = {column: 'object' for column in columns}
-    df = df.astype(map_dict)
+    Output
+    ------
+    [Pandas Series]
+        Categorical column with formatted, sorted labels.
+    """
+    categorical = pd.Categorical(series)
+    codes = categorical.codes
+    labels = pd.Series(categorical.categories.astype(str).tolist() + ['nan'], dtype=object)
 
-    return df
+    # Special characters in our case are the regular set of
+    # special characters, minus the underscore.
+    labels = labels.replace('[^\w\s_-]', '', regex=True)
+
+    # Replace a whitespace label with dash.
+    labels = labels.replace(' ', '-')
+
+    # Replace an underscore label with dash
+    labels = labels.replace('_', '')
+
+    # Enforce lower case.
+    labels = labels.str.lower()
+
+    # Sorted distinct formatted labels; null codes (-1) take the 'nan' label.
+    # Labels no row uses (e.g. 'nan' without nulls) are dropped.
+    categories, label_codes = np.unique(labels.to_numpy(dtype=object).astype(str), return_inverse=True)
+    new_codes = label_codes.ravel()[codes]
+    used = np.unique(new_codes)
+    remap = np.full(len(categories), -1)
+    remap[used] = np.arange(len(used))
+    categories, new_codes = categories[used], remap[new_codes]
+
+    return pd.Series(
+        pd.Categorical.from_codes(new_codes, categories=categories.astype(object)),
+        index=series.index, name=series.name
+    )
 
 
 # ########################################################################## #
 #                           FORMAT NUMERIC COLUMNS                           #
 # ########################################################################## #
-def format_numeric(df, configs):
+def format_numeric(df, configs, fill_values=None):
     """Format NUMERIC columns.
 
     Make sure that all numeric columns are cast as numeric types. Missing values
@@ -229,6 +253,8 @@ def format_numeric(df, configs):
         Full input dataframe
     configs -- [Pandas DataFrame]
         Configurations
+    fill_values -- [dict or None]
+        Values to impute instead of the column means, by column.
 
     Output
     ------
@@ -252,17 +278,10 @@ def format_numeric(df, configs):
         # being replaced.
         if (null_count > 0):# and map_null:
             warnings.warn(f"Total of {null_count} nulls in {variable} column mean imputed.")
-            temp_mean_impute = df[variable].mean()
+            if fill_values is not None and variable in fill_values:
+                temp_mean_impute = fill_values[variable]
+            else:
+                temp_mean_impute = df[variable].mean()
             df[variable] = df[variable].fillna(value=temp_mean_impute)
 
-        ############## Make sure there are no missing values ################
-        null_count = df[variable].isna().sum()
-        assert df[variable].isna().sum() == 0 , \
-            f"Failed check: The Numeric variable {variable} " +\
-            f"contains {null_count} missing values."
-
-        ################ Make sure column dtype is numeric #################
-        # Note that is_numeric_dtype(bool) evaluates to True
-        assert pd.api.types.is_numeric_dtype(df[variable])
-
     return df
@@ -11,6 +11,10 @@
 RUN_DEBUG  = 0
 RUN_CHECKS = 1
 
+# Validate a random sample of this many rows of the formatted data
+# (get_dataframe) instead of every row. None validates every row.
+VALIDATION_SAMPLE = None
+
 #########################################
 #  GLOBAL IMPORTS
 #########################################
@@ -34,6 +38,8 @@ from sklearn.metrics import (
     confusion_matrix
 )
 
+from transforms.metrics import threshold_sweep
+
 
 #########################################
 #  Dataset Columns
@@ -140,6 +146,25 @@ def get_report(y_true, y_pred):
     return report, f1[-1]
 
 
+def model_threshold_sweep(df, INDEX_IMPUTATION_ID, TARGET_COLUMNS, metric='mcc'):
+    """Run threshold_sweep for every candidate model column
+    (model_*) of merge_models output, per imputation group,
+    in a single call.
+    """
+    cols = df.columns
+    model_columns = cols[cols.str.contains('model_')].tolist()
+
+    n = df.shape[0]
+    groups = pd.DataFrame({
+        'model': np.repeat(model_columns, n),
+        INDEX_IMPUTATION_ID: np.tile(df[INDEX_IMPUTATION_ID].to_numpy(), len(model_columns)),
+    })
+    y_true = np.tile(df[TARGET_COLUMNS[0]].to_numpy(), len(model_columns))
+    y_score = df[model_columns].to_numpy(dtype=np.float64).ravel(order='F')
+
+    return threshold_sweep(y_true, y_score, groups, metric)
+
+
 
 #########################################
 #  Debug report formatters
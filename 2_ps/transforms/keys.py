@@ -0,0 +1,92 @@
+##################################################
+## Project: Real World Evidence to Accelerate COVID-19 Therapeutics
+## Contract No.: 75FCMC18D0047
+## Purpose: Functions to intern person ids as dense integer codes and pack them with the imputation group
+## Date: May 2022
+## Developers: Alexander Wood
+## Copyright 2022, The MITRE Corporation
+## Approved for Public Release; Distribution Unlimited. Public Release Case Number 22-1741.
+##################################################
+
+import numpy as np
+import pandas as pd
+
+
+# Dtype of the person codes, and of the packed (imputation group, person code) keys.
+CODE_DTYPE = np.int32
+PACKED_DTYPE = np.int64
+
+# The imputation group takes the high 32 bits of a packed key.
+IMPUTATION_SHIFT = 32
+
+
+def intern_keys(ids, dictionary=None):
+    """Map person ids to dense integer codes.
+
+    Input
+    -----
+    ids -- [Pandas Series or numpy array]
+        Person ids.
+    dictionary -- [numpy array or None]
+        Sorted distinct ids from an earlier call. None builds it from ids.
+        Ids not in the dictionary get the code -1.
+
+    Output
+    ------
+    codes -- [numpy array]
+        int32 code of every id: its position in the dictionary.
+    dictionary -- [numpy array]
+        The sorted distinct ids, as strings.
+    """
+    ids = pd.Series(np.asarray(ids).astype(str))
+    if dictionary is None:
+        codes, dictionary = pd.factorize(ids, sort=True)
+        dictionary = dictionary.to_numpy().astype(str)
+    else:
+        codes = pd.Index(dictionary).get_indexer(ids)
+    assert len(dictionary) < np.iinfo(CODE_DTYPE).max, "Too many distinct ids for int32 codes."
+    return codes.astype(CODE_DTYPE), dictionary
+
+
+def decode_keys(codes, dictionary):
+    """Person ids of integer codes, for export."""
+    codes = np.asarray(codes).astype(np.int64)
+    assert (codes >= 0).all(), "Unknown person codes cannot be decoded."
+    return dictionary[codes].astype(object)
+
+
+def pack_keys(imputation_ids, codes):
+    """One int64 key per (imputation group, person code) pair."""
+    imputation_ids = np.asarray(imputation_ids).astype(PACKED_DTYPE)
+    codes = np.asarray(codes).astype(PACKED_DTYPE)
+    return (imputation_ids << IMPUTATION_SHIFT) | codes
+
+
+def unpack_keys(keys):
+    """(imputation groups, person codes) of packed keys."""
+    keys = np.asarray(keys, dtype=PACKED_DTYPE)
+    return keys >> IMPUTATION_SHIFT, (keys & 0xFFFFFFFF).astype(CODE_DTYPE)
+
+
+def has_integer_keys(df, INDEX_ID, INDEX_IMPUTATION_ID):
+    """Whether the index columns of df hold integer codes."""
+    return all(pd.api.types.is_integer_dtype(df[column]) for column in [INDEX_ID, INDEX_IMPUTATION_ID])
+
+
+def restore_key_dtypes(df, INDEX_ID, INDEX_IMPUTATION_ID):
+    """Cast integer-coded index columns back to integers.
+
+    ML_setup stacks every column into one float matrix, so the codes come
+    out as floats (exactly, since int32 codes fit in a float64).
+    """
+    return df.astype({INDEX_ID: CODE_DTYPE, INDEX_IMPUTATION_ID: np.int64})
+
+
+def save_dictionary(dictionary, path):
+    """Write the id dictionary once, as a .npy file."""
+    np.save(path, np.asarray(dictionary).astype(str))
+
+
+def load_dictionary(path):
+    """Read a dictionary written by save_dictionary."""
+    return np.load(path)
@@ -10,6 +10,8 @@
 
 import pandas as pd
 
+from transforms.keys import has_integer_keys, pack_keys
+
 def merge_models(df_lr, df_gbt, df_rf, INDEX_ID, INDEX_IMPUTATION_ID, RUN_CHECKS = True, RUN_DEBUG = False):
     """Merge all trained model results in a single DataFrame.
 
@@ -30,11 +32,39 @@ def merge_models(df_lr, df_gbt, df_rf, INDEX_ID, INDEX_IMPUTATION_ID, RUN_CHECKS
         print_duplicate_columns(df.columns)
 
     if RUN_CHECKS:
-        assert len(df.columns) == len(set(df.columns)) , "Duplicate columns not allowed."
+        check_merged(df, [df_lr, df_gbt, df_rf], INDEX_ID, INDEX_IMPUTATION_ID)
 
     return df
 
 
+def check_merged(df, inputs, INDEX_ID, INDEX_IMPUTATION_ID):
+    """Checks of a merged model table, run with RUN_CHECKS.
+
+    Also used on the table materialized from the prediction store.
+
+    Input
+    -----
+    df -- [Pandas DataFrame]
+        The merged table.
+    inputs -- [list of Pandas DataFrame]
+        The outputs of the model stages that were merged.
+
+    Output
+    ------
+    None. Fails when df has duplicate columns or duplicate (person,
+    imputation group) rows, lacks a column of an input, or has another
+    row count than an input.
+    """
+    assert len(df.columns) == len(set(df.columns)) , "Duplicate columns not allowed."
+    assert not df.duplicated([INDEX_ID, INDEX_IMPUTATION_ID]).any(), \
+        "Duplicate (person, imputation group) rows not allowed."
+    for df_in in inputs:
+        missing = [col for col in df_in.columns if col not in df.columns]
+        assert not missing, f"Merged dataframe is missing columns {missing}."
+        assert df.shape[0] == df_in.shape[0], \
+            f"Output dataframe row count {df.shape[0]} does not match input row count {df_in.shape[0]}."
+
+
 def run_sanity_checks(df, df_lr, df_gbt, df_rf):
     # Make sure row count remains exactly the same.
     print(
@@ -83,7 +113,8 @@ def recover_person_id(df):
 def merge(df1, df2, INDEX_ID, INDEX_IMPUTATION_ID, RUN_CHECKS=True, RUN_DEBUG=False):
     """
     Merge two dataframes via an inner join on person_id and imputation group.
-    Remove all non-model columns.
+    Remove all non-model columns. When both hold integer-coded person ids
+    (transforms/keys.py), join on the packed int64 key instead.
     """
     # Get all columns from df2 that are not included in df1.
     # These are the columns we want to add.
@@ -101,7 +132,15 @@ def merge(df1, df2, INDEX_ID, INDEX_IMPUTATION_ID, RUN_CHECKS=True, RUN_DEBUG=Fa
         n_common = sum([1 for val in df1['person_id'].tolist() if val in df2['person_id'].tolist()])
         print(f'*\t{n_common} person_ids appear in both')
 
-    if isinstance(df1, pd.DataFrame):
+    if isinstance(df1, pd.DataFrame) and has_integer_keys(df1, INDEX_ID, INDEX_IMPUTATION_ID) \
+            and has_integer_keys(df2, INDEX_ID, INDEX_IMPUTATION_ID):
+        # Single integer join column.
+        key1 = pack_keys(df1[INDEX_IMPUTATION_ID], df1[INDEX_ID])
+        key2 = pack_keys(df2[INDEX_IMPUTATION_ID], df2[INDEX_ID])
+        df = df1.assign(_key=key1).merge(
+            df2[result_columns[len(join_columns):]].assign(_key=key2), on='_key'
+        ).drop(columns='_key')
+    elif isinstance(df1, pd.DataFrame):
         # In Pandas, use "merge" to join if you are not joining on the index.
         df = df1.merge(df2[result_columns], on=join_columns)
     else:
@@ -0,0 +1,106 @@
+##################################################
+## Project: Real World Evidence to Accelerate COVID-19 Therapeutics
+## Contract No.: 75FCMC18D0047
+## Purpose: Threshold metrics shared by the PS and DRS steps
+## Date: May 2022
+## Developers: Alexander Wood
+## Copyright 2022, The MITRE Corporation
+## Approved for Public Release; Distribution Unlimited. Public Release Case Number 22-1741.
+##################################################
+
+# No transforms imports here: 2_drs/transforms/score_a.py loads this file
+# directly, outside of the 2_ps transforms package.
+import numpy as np
+import pandas as pd
+
+
+def threshold_sweep(y_true, y_score, groups=None, metric='mcc'):
+    """Evaluate every threshold of a score at once.
+
+    Computes the confusion counts and metrics of y_score >= threshold
+    for every distinct score value as the threshold, within every group
+    of groups. Scores are sorted once by (group, score descending) and
+    the counts at each threshold are cumulative sums of y_true within
+    the group.
+
+    Input
+    -----
+    y_true -- [array-like]
+        Binary targets.
+    y_score -- [array-like]
+        Scores, e.g. the propensity scores of a candidate model.
+    groups -- [Pandas DataFrame or None]
+        Grouping columns aligned with y_true, e.g. the imputation id.
+    metric -- [str]
+        Column of the curve to maximize for the optimal thresholds.
+
+    Output
+    ------
+    curve -- [Pandas DataFrame]
+        One row per (group, threshold), thresholds decreasing within
+        each group: threshold, tn, fp, fn, tp, precision, recall, f1
+        and mcc (the CONFUSION_COLUMNS and METRIC_COLUMNS of
+        2_drs/transforms/score_a.py).
+    best -- [Pandas DataFrame]
+        The curve row of each group maximizing metric (the highest
+        such threshold on ties).
+    """
+    y_true = np.asarray(y_true, dtype=np.float64).ravel()
+    y_score = np.asarray(y_score, dtype=np.float64).ravel()
+    assert y_true.shape == y_score.shape
+    assert np.array_equal(y_true, y_true.astype('bool')), \
+           'y_true must be binary'
+
+    if groups is not None:
+        groups = pd.DataFrame(groups).reset_index(drop=True)
+        codes, levels = pd.MultiIndex.from_frame(groups).factorize(sort=True)
+    else:
+        codes = np.zeros(y_true.shape[0], dtype=np.int64)
+    n_groups = int(codes.max()) + 1 if codes.shape[0] else 0
+
+    order = np.lexsort((-y_score, codes))
+    group, score_sorted, y_sorted = codes[order], y_score[order], y_true[order]
+
+    # Thresholds are the last row of each run of tied scores in a group.
+    change = group[1:] != group[:-1]
+    last = np.flatnonzero(np.r_[change | (score_sorted[1:] != score_sorted[:-1]), True])
+    starts = np.flatnonzero(np.r_[True, change])
+
+    cum_tp = np.cumsum(y_sorted)
+    tp_before = cum_tp[starts] - y_sorted[starts]
+    positives = np.bincount(codes, weights=y_true, minlength=n_groups)
+    totals = np.bincount(codes, minlength=n_groups)
+
+    g = group[last]
+    tp = cum_tp[last] - tp_before[g]
+    fp = (last + 1 - starts[g]) - tp
+    fn = positives[g] - tp
+    tn = totals[g] - positives[g] - fp
+
+    # Zero denominators give 0, as with zero_division=0.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.nan_to_num(tp / (tp + fp))
+        recall = np.nan_to_num(tp / (tp + fn))
+        f1 = np.nan_to_num(2 * tp / (2 * tp + fp + fn))
+        mcc = np.nan_to_num(
+            (tp * tn - fp * fn) / np.sqrt((tp + fp) * (tp + fn) * (tn + fp) * (tn + fn)),
+            nan=0.0, posinf=0.0, neginf=0.0
+        )
+
+    curve = pd.DataFrame({
+        'threshold': score_sorted[last],
+        'tn': tn.astype(np.int64), 'fp': fp.astype(np.int64),
+        'fn': fn.astype(np.int64), 'tp': tp.astype(np.int64),
+        'precision': precision, 'recall': recall, 'f1': f1, 'mcc': mcc,
+    })
+    if groups is not None:
+        keys = levels[g].to_frame(index=False)
+        keys.columns = groups.columns
+        curve = pd.concat([keys, curve], axis=1)
+
+    # First (highest-threshold) row of each group with the largest metric.
+    ranked = np.lexsort((-curve[metric].to_numpy(), g))
+    first = ranked[np.r_[True, g[ranked][1:] != g[ranked][:-1]]]
+    best = curve.iloc[first].reset_index(drop=True)
+
+    return curve, best
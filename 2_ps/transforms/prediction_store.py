@@ -0,0 +1,242 @@
+##################################################
+## Project: Real World Evidence to Accelerate COVID-19 Therapeutics
+## Contract No.: 75FCMC18D0047
+## Purpose: Functions to store candidate model predictions in long form, one partition per model and imputation group
+## Date: May 2022
+## Developers: Alexander Wood
+## Copyright 2022, The MITRE Corporation
+## Approved for Public Release; Distribution Unlimited. Public Release Case Number 22-1741.
+##################################################
+
+import json
+import os
+import re
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from transforms.keys import CODE_DTYPE, decode_keys, load_dictionary
+
+
+# Storage type of the predicted scores.
+SCORE_DTYPE = np.float32
+
+
+# ############################################################################# #
+# WRITE                                                                         #
+# ############################################################################# #
+def create_prediction_store(df, path, INDEX_ID, INDEX_IMPUTATION_ID, TARGET_COLUMNS, dictionary_path=None):
+    """Start an empty prediction store for the rows of an ML_setup dataframe.
+
+    The store is keyed by (model_id, impute_id, person_id). The keys are
+    written once per imputation group: keys/<INDEX_ID>_<g>.npy and the
+    treatment targets keys/target_<g>.npy, in the row order of df. A
+    model's predictions for imputation group g are then a single float32
+    column, models/<model_id>/impute_<g>.npy, aligned with those keys.
+    Predictions of an earlier run are removed. The catalog lists the
+    models in the order their first partition was appended, so that
+    merge_models.csv keeps the LR, RF, GBT column order of main_ps.py.
+
+    When person ids are integer codes (transforms/keys.py), the codes are
+    stored as int32 and the readers decode them with the dictionary at
+    dictionary_path.
+
+    Input
+    -----
+    df -- [Pandas DataFrame]
+        Output of ML_setup; the candidate models are fit on its rows.
+    path -- [str or Path]
+        Directory of the store. Created if it does not exist.
+    dictionary_path -- [str or Path or None]
+        The id dictionary (keys.save_dictionary) of integer-coded person ids.
+
+    Output
+    ------
+    [dict]
+        The catalog written to <path>/catalog.json.
+    """
+    path = Path(path)
+    shutil.rmtree(path / 'models', ignore_errors=True)
+    (path / 'keys').mkdir(parents=True, exist_ok=True)
+    (path / 'models').mkdir(parents=True, exist_ok=True)
+
+    imputation_groups = sorted(df[INDEX_IMPUTATION_ID].unique().tolist())
+    for imputation_group in imputation_groups:
+        mask = (df[INDEX_IMPUTATION_ID] == imputation_group).to_numpy()
+        ids = df.loc[mask, INDEX_ID].to_numpy()
+        np.save(path / 'keys' / f'{INDEX_ID}_{imputation_group}.npy',
+                ids.astype(CODE_DTYPE) if dictionary_path is not None else ids.astype(str))
+        np.save(path / 'keys' / f'target_{imputation_group}.npy',
+                df.loc[mask, TARGET_COLUMNS].to_numpy(dtype=np.uint8))
+
+    catalog = {
+        'index_id': INDEX_ID,
+        'imputation_id': INDEX_IMPUTATION_ID,
+        'target_columns': TARGET_COLUMNS,
+        'imputation_groups': [int(g) for g in imputation_groups],
+        'n_rows': {str(g): int((df[INDEX_IMPUTATION_ID] == g).sum()) for g in imputation_groups},
+        'dictionary': None if dictionary_path is None else str(dictionary_path),
+        'models': [],
+    }
+    _write_catalog(path, catalog)
+    return catalog
+
+
+def append_predictions(path, model_id, imputation_group, scores):
+    """Add one model's scores for one imputation group to the store.
+
+    Called as soon as the fit completes. The partition is written to a
+    temporary file and renamed, so readers see it whole or not at all.
+
+    Input
+    -----
+    path -- [str or Path]
+        Directory of the store.
+    model_id -- [str]
+        Candidate model column name, e.g. "model_lr_3".
+    imputation_group -- [int]
+    scores -- [numpy array]
+        Predicted treatment probability of every row of the imputation
+        group, in the row order of the ML_setup dataframe.
+    """
+    path = Path(path)
+    catalog = _catalog(path)
+    n_rows = catalog['n_rows'][str(imputation_group)]
+    scores = np.asarray(scores, dtype=SCORE_DTYPE).ravel()
+    assert scores.shape[0] == n_rows, \
+        f"{model_id}: {scores.shape[0]} scores for the {n_rows} rows of imputation group {imputation_group}."
+
+    partition = path / 'models' / model_id
+    partition.mkdir(parents=True, exist_ok=True)
+    tmp = partition / f'.impute_{imputation_group}.npy.tmp'
+    with open(tmp, 'wb') as f:
+        np.save(f, scores)
+    os.replace(tmp, partition / f'impute_{imputation_group}.npy')
+
+    models = catalog.setdefault('models', [])
+    if model_id not in models:
+        models.append(model_id)
+        _write_catalog(path, catalog)
+
+
+def drop_model(path, model_id):
+    """Remove every partition of a model, e.g. after it failed to converge."""
+    shutil.rmtree(Path(path) / 'models' / model_id, ignore_errors=True)
+    catalog = _catalog(path)
+    if model_id in catalog.get('models', []):
+        catalog['models'].remove(model_id)
+        _write_catalog(path, catalog)
+
+
+# ############################################################################# #
+# READ                                                                          #
+# ############################################################################# #
+def list_models(path, complete=True):
+    """Model ids in the store, in the order they were appended.
+
+    Partitions missing from the catalog (stores written before it listed
+    the models) follow in natural order (model_lr_2 before model_lr_10).
+    With complete, only models with a partition for every imputation group.
+    """
+    path = Path(path)
+    catalog = _catalog(path)
+    models = []
+    for partition in (path / 'models').iterdir():
+        if not partition.is_dir():
+            continue
+        groups = {int(p.stem.split('_')[-1]) for p in partition.glob('impute_*.npy')}
+        if not complete or groups.issuperset(catalog['imputation_groups']):
+            models.append(partition.name)
+    appended = [model_id for model_id in catalog.get('models', []) if model_id in models]
+    unlisted = sorted(
+        set(models) - set(appended),
+        key=lambda m: [int(t) if t.isdigit() else t for t in re.split(r'(\d+)', m)]
+    )
+    return appended + unlisted
+
+
+def read_model(path, model_id, imputation_groups=None, decode=True):
+    """Project the scores of one model, without reading the other models.
+
+    With decode False, integer-coded person ids are returned as codes.
+
+    Output
+    ------
+    [Pandas DataFrame]
+        Long form: <index_id>, <imputation_id> and the float32 scores in
+        a column named model_id, one row per key.
+    """
+    path = Path(path)
+    catalog = _catalog(path)
+    if imputation_groups is None:
+        imputation_groups = catalog['imputation_groups']
+
+    dictionary = _dictionary(catalog) if decode else None
+    frames = []
+    for imputation_group in imputation_groups:
+        frame = _keys(path, catalog, imputation_group, dictionary)
+        frame[model_id] = np.load(path / 'models' / model_id / f'impute_{imputation_group}.npy')
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True)
+
+
+def materialize_wide(path, models=None):
+    """The wide table of merge_models, built from the store.
+
+    Output
+    ------
+    [Pandas DataFrame]
+        <index_id>, <imputation_id>, the target columns and one float32
+        column per model (by default every complete model, in the order
+        of list_models), in the row order of the ML_setup dataframe.
+        Person ids are decoded.
+    """
+    path = Path(path)
+    catalog = _catalog(path)
+    if models is None:
+        models = list_models(path)
+
+    dictionary = _dictionary(catalog)
+    frames = []
+    for imputation_group in catalog['imputation_groups']:
+        frame = _keys(path, catalog, imputation_group, dictionary)
+        targets = np.load(path / 'keys' / f'target_{imputation_group}.npy')
+        for j, column in enumerate(catalog['target_columns']):
+            frame[column] = targets[:, j]
+        scores = {
+            model_id: np.load(path / 'models' / model_id / f'impute_{imputation_group}.npy')
+            for model_id in models
+        }
+        frames.append(pd.concat([frame, pd.DataFrame(scores)], axis=1))
+    return pd.concat(frames, ignore_index=True)
+
+
+def _catalog(path):
+    with open(Path(path) / 'catalog.json') as f:
+        return json.load(f)
+
+
+def _write_catalog(path, catalog):
+    # Written to a temporary file and renamed, as the partitions are.
+    tmp = Path(path) / '.catalog.json.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(catalog, f, indent=2)
+    os.replace(tmp, Path(path) / 'catalog.json')
+
+
+def _dictionary(catalog):
+    return None if catalog.get('dictionary') is None else load_dictionary(catalog['dictionary'])
+
+
+def _keys(path, catalog, imputation_group, dictionary=None):
+    ids = np.load(Path(path) / 'keys' / f"{catalog['index_id']}_{imputation_group}.npy")
+    if dictionary is not None:
+        ids = decode_keys(ids, dictionary)
+    elif ids.dtype.kind == 'U':
+        ids = ids.astype(object)
+    return pd.DataFrame({
+        catalog['index_id']: ids,
+        catalog['imputation_id']: imputation_group,
+    })
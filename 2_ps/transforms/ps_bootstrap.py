@@ -0,0 +1,311 @@
+##################################################
+## Project: Real World Evidence to Accelerate COVID-19 Therapeutics
+## Contract No.: 75FCMC18D0047
+## Purpose: Functions to compute Poisson-bootstrap confidence intervals for PS-weighted effect estimates
+## Date: May 2022
+## Developers: Alexander Wood
+## Copyright 2022, The MITRE Corporation
+## Approved for Public Release; Distribution Unlimited. Public Release Case Number 22-1741.
+##################################################
+
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from sklearn.base import clone
+from sklearn.linear_model import LogisticRegression
+from sklearn.ensemble import RandomForestClassifier, GradientBoostingClassifier
+
+from transforms.keys import CODE_DTYPE, intern_keys, load_dictionary
+
+
+# Contrasts reported for each outcome, in output order.
+CONTRASTS = ['prob_untreated', 'prob_treated', 'risk_difference', 'log_odds_ratio']
+
+
+# ############################################################################# #
+# PERSIST THE DESIGN MATRICES                                                   #
+# ############################################################################# #
+def save_design_matrices(df, path, INDEX_ID, INDEX_IMPUTATION_ID, INDEX_COLUMNS, TARGET_COLUMNS, dictionary_path=None):
+    """Persist the ML_setup design matrix of every imputation group.
+
+    The bootstrap refits the selected propensity model many times on the
+    same features. Writing each imputation group once as .npy files lets
+    every worker process memory-map the same matrix instead of receiving
+    a pickled copy per task.
+
+    Input
+    -----
+    df -- [Pandas DataFrame]
+        Output of ML_setup (before any model columns are added).
+    path -- [str or Path]
+        Directory to write to. Created if it does not exist.
+    dictionary_path -- [str or Path or None]
+        The id dictionary (keys.save_dictionary) when person ids are
+        integer codes; the codes are then saved as int32.
+
+    Output
+    ------
+    [dict]
+        The catalog written to <path>/catalog.json.
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+
+    cols = df.columns
+    model_columns = cols[cols.str.contains('model_')].tolist()
+    feature_columns = [
+        col for col in df.columns
+        if col not in (INDEX_COLUMNS + TARGET_COLUMNS + model_columns)
+    ]
+
+    imputation_groups = sorted(df[INDEX_IMPUTATION_ID].unique().tolist())
+    for imputation_group in imputation_groups:
+        mask = df[INDEX_IMPUTATION_ID] == imputation_group
+        np.save(path / f'X_{imputation_group}.npy',
+                np.ascontiguousarray(df.loc[mask, feature_columns].to_numpy(dtype=np.float64)))
+        np.save(path / f'y_{imputation_group}.npy',
+                df.loc[mask, TARGET_COLUMNS].to_numpy(dtype=np.uint8).ravel())
+        ids = df.loc[mask, INDEX_ID].to_numpy()
+        np.save(path / f'ids_{imputation_group}.npy',
+                ids.astype(CODE_DTYPE) if dictionary_path is not None else ids.astype(str))
+
+    catalog = {
+        'imputation_groups': [int(g) for g in imputation_groups],
+        'feature_columns': feature_columns,
+        'target_columns': TARGET_COLUMNS,
+        'dictionary': None if dictionary_path is None else str(dictionary_path),
+    }
+    with open(path / 'catalog.json', 'w') as f:
+        json.dump(catalog, f, indent=2)
+
+    return catalog
+
+
+# ############################################################################# #
+# CANDIDATE MODELS                                                              #
+# ############################################################################# #
+def get_candidate_model(model_name):
+    """Return an unfitted estimator for a candidate model column name.
+
+    Model names follow the conventions of ML_LR, ML_RF and ML_GBT
+    ("model_lr_{i}", "model_rf_{i}_{n_estimators}", "model_gbt_{i}"),
+    e.g. the best_model selected in the covariate balance step.
+    """
+    from transforms.ML_LR import PARAM_GRID as LR_GRID
+    from transforms.ML_RF import PARAM_GRID as RF_GRID
+    from transforms.ML_GBT import PARAM_GRID as GBT_GRID, BALANCE_EARLY_STOPPING
+
+    parts = model_name.split('_')
+    if model_name.startswith('model_lr_'):
+        model = LogisticRegression(random_state=2022).set_params(**LR_GRID[int(parts[2])])
+    elif model_name.startswith('model_rf_'):
+        model = RandomForestClassifier(random_state=42).set_params(**RF_GRID[int(parts[2])])
+        model.set_params(n_estimators=int(parts[3]), warm_start=False)
+    elif model_name.startswith('model_gbt_'):
+        model = GradientBoostingClassifier(random_state=2022).set_params(**GBT_GRID[int(parts[2])])
+        if BALANCE_EARLY_STOPPING:
+            # As in ML_GBT, stopped on covariate balance (see _run_block).
+            model.set_params(n_iter_no_change=None)
+    else:
+        raise ValueError(f"Unrecognized candidate model name {model_name}.")
+
+    return model
+
+
+# ############################################################################# #
+# BOOTSTRAP                                                                     #
+# ############################################################################# #
+def ps_bootstrap(path, outcomes, model_name, n_replicates=1000, block_size=25, n_jobs=None, seed=2022):
+    """Poisson-bootstrap the PS-weighted treatment effect.
+
+    For every imputation group and replicate, each patient receives an
+    independent Poisson(1) count that is used both as the sample weight
+    when refitting the selected propensity model and as a frequency weight
+    on the stabilized inverse propensity weights of the outcome contrasts.
+    This carries the PS-model estimation uncertainty into the intervals.
+
+    Replicates are processed in blocks; within a block the outcome
+    contrasts for all replicates and outcomes are computed with a single
+    matrix product. Blocks run in a process pool. Every replicate draws
+    from its own seed, derived from (seed, imputation group, replicate),
+    so results do not depend on block_size or n_jobs.
+
+    Replicate 0 is the point estimate (unit weights, i.e. the original fit).
+
+    Input
+    -----
+    path -- [str or Path]
+        Directory written by save_design_matrices.
+    outcomes -- [Pandas DataFrame]
+        person_id, impute_id and binary outcome columns, e.g. the imputed
+        table restricted to the outcome_vars of 4_msm/transforms/config.R.
+    model_name -- [str]
+        Selected candidate model, e.g. "model_lr_3".
+
+    Output
+    ------
+    [Pandas DataFrame]
+        One row per (impute_id, replicate, outcome) with a column per
+        contrast in CONTRASTS.
+    """
+    path = Path(path)
+    with open(path / 'catalog.json') as f:
+        catalog = json.load(f)
+
+    outcome_columns = [c for c in outcomes.columns if c not in ['person_id', 'impute_id']]
+
+    # With integer-coded design ids, code the outcome ids with the same
+    # dictionary so the alignment below is an integer reindex.
+    if catalog.get('dictionary') is not None:
+        codes, _ = intern_keys(outcomes['person_id'], load_dictionary(catalog['dictionary']))
+        outcomes = outcomes.assign(person_id=codes)
+        outcomes = outcomes[outcomes['person_id'] >= 0]
+
+    # Align outcomes to the design matrix row order once per imputation group.
+    tasks = []
+    for imputation_group in catalog['imputation_groups']:
+        ids = np.load(path / f'ids_{imputation_group}.npy')
+        y_out = (
+            outcomes[outcomes['impute_id'] == imputation_group]
+            .set_index('person_id')
+            .reindex(ids)[outcome_columns]
+        )
+        assert y_out.notna().all().all(), \
+            f"Outcomes missing for some patients in imputation group {imputation_group}."
+        y_path = path / f'outcomes_{imputation_group}.npy'
+        np.save(y_path, y_out.to_numpy(dtype=np.float64))
+
+        replicates = np.arange(0, n_replicates + 1)
+        for block in np.array_split(replicates, max(1, int(np.ceil(len(replicates) / block_size)))):
+            tasks.append((str(path), imputation_group, model_name, block.tolist(), seed))
+
+    n_jobs = n_jobs or os.cpu_count()
+    if n_jobs == 1:
+        results = [_run_block(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(_run_block, tasks))
+
+    frames = []
+    for (_, imputation_group, _, block, _), estimates in zip(tasks, results):
+        # estimates has shape (len(block), n_outcomes, len(CONTRASTS)).
+        n_block, n_outcomes = estimates.shape[0], estimates.shape[1]
+        frame = pd.DataFrame(estimates.reshape(-1, len(CONTRASTS)), columns=CONTRASTS)
+        frame.insert(0, 'outcome', np.tile(outcome_columns, n_block))
+        frame.insert(0, 'replicate', np.repeat(block, n_outcomes))
+        frame.insert(0, 'impute_id', imputation_group)
+        frames.append(frame)
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def _run_block(task):
+    """Refit the PS model and compute outcome contrasts for a block of replicates."""
+    path, imputation_group, model_name, block, seed = task
+    path = Path(path)
+
+    from transforms.ML_setup import ORDINAL_SUFFIX
+    from transforms.ML_GBT import BALANCE_EARLY_STOPPING, BalanceMonitor
+    with open(path / 'catalog.json') as f:
+        feature_columns = json.load(f)['feature_columns']
+    not_ordinal = np.array([not col.endswith(ORDINAL_SUFFIX) for col in feature_columns])
+
+    X = np.load(path / f'X_{imputation_group}.npy', mmap_mode='r')
+    if model_name.startswith('model_lr_'):
+        # As in ML_LR, ordinal-coded categoricals are left out of LR fits.
+        X = X[:, not_ordinal]
+    balance_stopping = BALANCE_EARLY_STOPPING and model_name.startswith('model_gbt_')
+    treatment = np.load(path / f'y_{imputation_group}.npy')
+    y_out = np.load(path / f'outcomes_{imputation_group}.npy')
+    n = treatment.shape[0]
+
+    # Poisson counts for the whole block, one independent stream per replicate.
+    counts = np.empty((len(block), n), dtype=np.float64)
+    for b, replicate in enumerate(block):
+        if replicate == 0:
+            counts[b] = 1.0
+        else:
+            rng = np.random.default_rng(np.random.SeedSequence([seed, imputation_group, replicate]))
+            counts[b] = rng.poisson(1.0, n)
+
+    # Refit the selected model with the replicate counts as sample weights.
+    model_gbl = get_candidate_model(model_name)
+    prop_score = np.empty_like(counts)
+    for b in range(len(block)):
+        model = clone(model_gbl)
+        if balance_stopping:
+            # Each replicate stops on the balance of its own counts, as ML_GBT does on the original fit.
+            monitor = BalanceMonitor(X, treatment, not_ordinal, sample_weight=counts[b])
+            model.fit(X, treatment, sample_weight=counts[b], monitor=monitor)
+            prop_score[b] = monitor.best_scores_
+        else:
+            model.fit(X, treatment, sample_weight=counts[b])
+            prop_score[b] = model.predict_proba(X)[:, -1]
+    prop_score = np.clip(prop_score, 1e-6, 1 - 1e-6)
+
+    # Stabilized ATE weights (as in 4_msm), times the replicate counts.
+    prob_treat = (counts @ treatment) / counts.sum(axis=1)
+    weights = counts * np.where(
+        treatment == 1,
+        prob_treat[:, np.newaxis] / prop_score,
+        (1 - prob_treat[:, np.newaxis]) / (1 - prop_score)
+    )
+
+    # Weighted outcome rates for every replicate and outcome at once.
+    w_treated, w_untreated = weights * treatment, weights * (1 - treatment)
+    prob_treated = (w_treated @ y_out) / w_treated.sum(axis=1)[:, np.newaxis]
+    prob_untreated = (w_untreated @ y_out) / w_untreated.sum(axis=1)[:, np.newaxis]
+
+    with np.errstate(divide='ignore'):
+        log_odds_ratio = (
+            np.log(prob_treated) - np.log1p(-prob_treated)
+            - np.log(prob_untreated) + np.log1p(-prob_untreated)
+        )
+
+    return np.stack(
+        [prob_untreated, prob_treated, prob_treated - prob_untreated, log_odds_ratio],
+        axis=-1
+    )
+
+
+def bootstrap_intervals(replicates, alpha=0.05):
+    """Summarize bootstrap replicates into percentile confidence intervals.
+
+    Intervals are computed within each imputation group and, for the pooled
+    rows (impute_id "pooled"), from the replicates of all imputation groups
+    stacked together; the pooled point estimate is the mean of the
+    per-imputation point estimates.
+
+    Input
+    -----
+    replicates -- [Pandas DataFrame]
+        Output of ps_bootstrap.
+
+    Output
+    ------
+    [Pandas DataFrame]
+        impute_id, outcome, contrast, estimate, lb, ub.
+    """
+    long = replicates.melt(
+        id_vars=['impute_id', 'replicate', 'outcome'],
+        value_vars=CONTRASTS, var_name='contrast', value_name='value'
+    )
+    point = long[long['replicate'] == 0]
+    boot = long[long['replicate'] > 0]
+
+    pooled_point = point.groupby(['outcome', 'contrast'])['value'].mean()
+    pooled_point = pooled_point.reset_index().assign(impute_id='pooled')
+    point = pd.concat([point.assign(impute_id=point['impute_id'].astype(str)), pooled_point], sort=False)
+    boot = pd.concat([boot.assign(impute_id=boot['impute_id'].astype(str)), boot.assign(impute_id='pooled')])
+
+    keys = ['impute_id', 'outcome', 'contrast']
+    bounds = boot.groupby(keys)['value'].quantile([alpha / 2, 1 - alpha / 2]).unstack()
+    bounds.columns = ['lb', 'ub']
+
+    summary = point.set_index(keys)[['value']].rename(columns={'value': 'estimate'})
+    return summary.join(bounds).reset_index()
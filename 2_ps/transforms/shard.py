@@ -0,0 +1,404 @@
+##################################################
+## Project: Real World Evidence to Accelerate COVID-19 Therapeutics
+## Contract No.: 75FCMC18D0047
+## Purpose: Functions to run the PS data preparation per health-system shard through a filesystem work queue
+## Date: May 2022
+## Developers: Alexander Wood
+## Copyright 2022, The MITRE Corporation
+## Approved for Public Release; Distribution Unlimited. Public Release Case Number 22-1741.
+##################################################
+
+import hashlib
+import json
+import os
+import re
+import socket
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+# States of a task in the work queue; each is a subdirectory of the queue.
+QUEUE_STATES = ['todo', 'running', 'done', 'failed']
+
+# Seconds between the heartbeats of a worker on its running task, which keep
+# the task from being requeued by requeue_stale while it is processed.
+HEARTBEAT_INTERVAL = 60
+
+# Shard name of the rows without a health system.
+NULL_SHARD = 'null'
+
+
+# ############################################################################# #
+# WORK QUEUE                                                                    #
+# ############################################################################# #
+def enqueue(queue_dir, tasks):
+    """Add tasks to a filesystem work queue.
+
+    Every task is a json file in <queue_dir>/todo. Workers on any process
+    or node that sees the same directory claim a task by renaming it to
+    running/, which is atomic on a local or network filesystem, so each
+    task is processed once.
+
+    Input
+    -----
+    queue_dir -- [str or Path]
+        Queue directory. Created if it does not exist.
+    tasks -- [dict]
+        Task name -> json-serializable payload.
+    """
+    queue_dir = Path(queue_dir)
+    for state in QUEUE_STATES:
+        (queue_dir / state).mkdir(parents=True, exist_ok=True)
+    for name, payload in tasks.items():
+        tmp = queue_dir / f'.{name}.json.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(payload, f)
+        os.replace(tmp, queue_dir / 'todo' / f'{name}.json')
+
+
+def claim_task(queue_dir):
+    """Claim the next task: (name, payload), or None when no task is left."""
+    queue_dir = Path(queue_dir)
+    for path in sorted((queue_dir / 'todo').glob('*.json')):
+        running = queue_dir / 'running' / path.name
+        try:
+            os.rename(path, running)
+        except FileNotFoundError:
+            # Claimed by another worker first.
+            continue
+        # Mark the claim time, for requeue_stale.
+        os.utime(running)
+        with open(running) as f:
+            return path.stem, json.load(f)
+    return None
+
+
+def complete_task(queue_dir, name, error=None):
+    """Move a claimed task to done/, or to failed/ with the error message.
+
+    A task requeued by requeue_stale while it was still being processed
+    is taken back from todo/. If another worker has claimed it again, that
+    worker completes it and this call leaves it alone.
+
+    Output
+    ------
+    [bool]
+        Whether this call moved the task.
+    """
+    queue_dir = Path(queue_dir)
+    state = 'done' if error is None else 'failed'
+    if error is not None:
+        with open(queue_dir / 'failed' / f'{name}.log', 'w') as f:
+            f.write(error)
+    for source in ['running', 'todo']:
+        try:
+            os.replace(queue_dir / source / f'{name}.json', queue_dir / state / f'{name}.json')
+            return True
+        except FileNotFoundError:
+            continue
+    return False
+
+
+@contextmanager
+def heartbeat(queue_dir, name, interval=HEARTBEAT_INTERVAL):
+    """Touch a running task every interval seconds while the block runs."""
+    running = Path(queue_dir) / 'running' / f'{name}.json'
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(interval):
+            try:
+                os.utime(running)
+            except FileNotFoundError:
+                # Requeued or completed elsewhere; complete_task handles it.
+                return
+
+    thread = threading.Thread(target=beat, name=f'heartbeat-{name}', daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def requeue_stale(queue_dir, max_age=3600):
+    """Return tasks without a heartbeat for max_age seconds (e.g. from a node that died) to todo/."""
+    queue_dir = Path(queue_dir)
+    stale = []
+    for path in (queue_dir / 'running').glob('*.json'):
+        if time.time() - path.stat().st_mtime > max_age:
+            os.replace(path, queue_dir / 'todo' / path.name)
+            stale.append(path.stem)
+    return stale
+
+
+def queue_status(queue_dir):
+    """Number of tasks in every state."""
+    queue_dir = Path(queue_dir)
+    return {state: len(list((queue_dir / state).glob('*.json'))) for state in QUEUE_STATES}
+
+
+# ############################################################################# #
+# SPLIT                                                                         #
+# ############################################################################# #
+def split_by_health_system(source, out_dir, configs, chunksize=100000):
+    """Stream an imputed csv into one csv per health system.
+
+    Only chunksize rows are in memory at a time. While streaming, the
+    non-null count and sum of every int/float config column is kept, so
+    that missing values can still be mean-imputed with the mean over all
+    health systems (as get_dataframe does on the full table).
+
+    Input
+    -----
+    source -- [str or Path]
+        Imputed csv, e.g. 1_imputation/data/mab_patient_effect_imputed.csv
+    out_dir -- [str or Path]
+        Directory for the shard csvs. Existing shards are overwritten.
+
+    Rows without a health system go to the shard NULL_SHARD. Shard names
+    are the health systems with non-word characters replaced by '_'; when
+    two health systems give the same name, a hash of the health system is
+    appended.
+    configs -- [Pandas DataFrame]
+        Output of get_configs.
+
+    Output
+    ------
+    shards -- [dict]
+        Health system -> shard csv path.
+    fill_values -- [dict]
+        Numeric column -> mean over the whole table.
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    numeric = configs.loc[configs['dtype'].isin(['int', 'float']), 'variable'].tolist()
+
+    shards, counts, sums = {}, pd.Series(0.0, index=numeric), pd.Series(0.0, index=numeric)
+    names = {}
+    for chunk in pd.read_csv(source, chunksize=chunksize):
+        present = [column for column in numeric if column in chunk.columns]
+        counts[present] += chunk[present].notna().sum()
+        sums[present] += chunk[present].sum()
+        for health_system, part in chunk.groupby('health_system', sort=False, dropna=False):
+            health_system = None if pd.isna(health_system) else str(health_system)
+            if health_system not in names:
+                names[health_system] = shard_name(health_system, set(names.values()))
+            name = names[health_system]
+            path = out_dir / f'shard_{name}.csv'
+            part.to_csv(path, mode='a' if name in shards else 'w', header=name not in shards, index=False)
+            shards[name] = str(path)
+
+    fill_values = (sums / counts.where(counts > 0)).dropna().to_dict()
+    return shards, fill_values
+
+
+def shard_name(health_system, taken=()):
+    """File-name-safe shard name of a health system (None for missing), distinct from the names taken."""
+    if health_system is None:
+        name = NULL_SHARD
+    else:
+        name = re.sub(r'\W', '_', health_system)
+    if name in taken:
+        digest = hashlib.md5(repr(health_system).encode()).hexdigest()[:8]
+        name = f'{name}_{digest}'
+    assert name not in taken, f"Shard name {name} of health system {health_system} is already taken."
+    return name
+
+
+# ############################################################################# #
+# SHARD SUMMARIES                                                               #
+# ############################################################################# #
+def shard_summary(df, covariates, INDEX_IMPUTATION_ID, TARGET_COLUMN):
+    """Mergeable moments of a formatted shard.
+
+    For every (imputation group, treatment group) the row count and, for
+    every covariate, the sum and sum of squares. Categorical covariates
+    enter as one indicator per level, <variable>__<level>. Sums of shard
+    summaries are the summary of the combined shards (merge_summaries),
+    from which means, standard deviations and standardized mean
+    differences follow (summary_statistics).
+
+    Input
+    -----
+    df -- [Pandas DataFrame]
+        Output of get_dataframe for one shard.
+    covariates -- [list of str]
+        The covariate columns.
+
+    Output
+    ------
+    [dict]
+        {'n_rows': int, 'moments': {'<impute_id>_<treatment>': {'n', 'sum', 'sumsq'}}}
+    """
+    blocks, names = [], []
+    for column in covariates:
+        series = df[column]
+        if pd.api.types.is_numeric_dtype(series) and not isinstance(series.dtype, pd.CategoricalDtype):
+            blocks.append(series.to_numpy(dtype=np.float64)[:, np.newaxis])
+            names.append(column)
+        else:
+            codes, levels = pd.factorize(series, sort=True)
+            block = np.zeros((df.shape[0], len(levels)))
+            rows = np.flatnonzero(codes >= 0)
+            block[rows, codes[rows]] = 1
+            blocks.append(block)
+            names += [f'{column}__{level}' for level in levels]
+    X = np.hstack(blocks) if len(blocks) else np.zeros((df.shape[0], 0))
+
+    keys = df[INDEX_IMPUTATION_ID].astype(str) + '_' + df[TARGET_COLUMN].astype(int).astype(str)
+    codes, groups = pd.factorize(keys)
+    n = np.bincount(codes, minlength=len(groups))
+    # Unbuffered row-wise sums into each row's group.
+    sums = np.zeros((len(groups), X.shape[1]))
+    sumsq = np.zeros((len(groups), X.shape[1]))
+    np.add.at(sums, codes, X)
+    np.add.at(sumsq, codes, X * X)
+
+    return {
+        'n_rows': int(df.shape[0]),
+        'moments': {
+            group: {
+                'n': int(n[g]),
+                'sum': dict(zip(names, sums[g].tolist())),
+                'sumsq': dict(zip(names, sumsq[g].tolist())),
+            }
+            for g, group in enumerate(groups)
+        }
+    }
+
+
+def merge_summaries(summaries):
+    """Sum shard summaries. Covariate levels absent from a shard count as zeros."""
+    merged = {'n_rows': 0, 'moments': {}}
+    for summary in summaries:
+        merged['n_rows'] += summary['n_rows']
+        for group, moments in summary['moments'].items():
+            target = merged['moments'].setdefault(group, {'n': 0, 'sum': {}, 'sumsq': {}})
+            target['n'] += moments['n']
+            for stat in ['sum', 'sumsq']:
+                for name, value in moments[stat].items():
+                    target[stat][name] = target[stat].get(name, 0.0) + value
+    return merged
+
+
+def summary_statistics(summary):
+    """Means, standard deviations and balance from a (merged) summary.
+
+    Output
+    ------
+    [Pandas DataFrame]
+        One row per (impute_id, variable): n, mean, std (ddof=1, as the
+        StratifiedScaler computes within health systems), std_pop (ddof=0,
+        as StandardScaler computes), the treated and untreated means and
+        the standardized mean difference
+        smd = (mean_treated - mean_untreated) / sqrt((var_treated + var_untreated) / 2).
+    """
+    rows = []
+    for group, moments in summary['moments'].items():
+        impute_id, treatment = group.rsplit('_', 1)
+        names = sorted(moments['sum'])
+        rows.append(pd.DataFrame({
+            'impute_id': impute_id,
+            'treatment': int(treatment),
+            'variable': names,
+            'n': moments['n'],
+            'sum': [moments['sum'][name] for name in names],
+            'sumsq': [moments['sumsq'][name] for name in names],
+        }))
+    long = pd.concat(rows, ignore_index=True)
+
+    def moments_of(frame):
+        n = frame['n']
+        mean = frame['sum'] / n
+        var_pop = (frame['sumsq'] / n - mean ** 2).clip(lower=0)
+        var = var_pop * n / (n - 1).where(n > 1)
+        return mean, var_pop, var
+
+    keys = ['impute_id', 'variable']
+    total = long.groupby(keys)[['n', 'sum', 'sumsq']].sum()
+    mean, var_pop, var = moments_of(total)
+    stats = pd.DataFrame({'n': total['n'], 'mean': mean, 'std': np.sqrt(var), 'std_pop': np.sqrt(var_pop)})
+
+    for treatment, label in [(1, 'treated'), (0, 'untreated')]:
+        by_group = long[long['treatment'] == treatment].set_index(keys)[['n', 'sum', 'sumsq']]
+        mean, _, var = moments_of(by_group)
+        stats[f'mean_{label}'] = mean
+        stats[f'var_{label}'] = var
+
+    stats['smd'] = (stats['mean_treated'] - stats['mean_untreated']) / \
+        np.sqrt((stats['var_treated'] + stats['var_untreated']) / 2)
+    return stats.drop(columns=['var_treated', 'var_untreated']).reset_index()
+
+
+# ############################################################################# #
+# WORKER                                                                        #
+# ############################################################################# #
+def process_shard(task, configs, INDEX_ID, INDEX_IMPUTATION_ID, INDEX_COLUMNS, TARGET_COLUMNS):
+    """Format one shard with get_dataframe and write it with its summary.
+
+    Input
+    -----
+    task -- [dict]
+        Queue payload: shard (name), path (shard csv), out_dir and
+        fill_values (from split_by_health_system).
+    configs -- [Pandas DataFrame]
+        Output of get_configs.
+    """
+    from transforms.get_dataframe import get_dataframe
+
+    out_dir = Path(task['out_dir'])
+    df = pd.read_csv(task['path'])
+    df = get_dataframe(df, configs, NUMERIC_FILL_VALUES=task['fill_values'])
+    # Written atomically, through a temporary file of this worker: a
+    # requeued shard may be processed by two workers at once.
+    worker = f'{socket.gethostname()}-{os.getpid()}'
+    tmp = out_dir / f".get_dataframe_{task['shard']}.{worker}.csv.tmp"
+    df.to_csv(tmp, index=False)
+    os.replace(tmp, out_dir / f"get_dataframe_{task['shard']}.csv")
+
+    covariates = [
+        column for column in df.columns
+        if column not in INDEX_COLUMNS + TARGET_COLUMNS
+    ]
+    summary = shard_summary(df, covariates, INDEX_IMPUTATION_ID, TARGET_COLUMNS[0])
+    summary['shard'] = task['shard']
+    tmp = out_dir / f".summary_{task['shard']}.{worker}.json.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(summary, f)
+    os.replace(tmp, out_dir / f"summary_{task['shard']}.json")
+    return summary
+
+
+def run_worker(queue_dir, configs, INDEX_ID, INDEX_IMPUTATION_ID, INDEX_COLUMNS, TARGET_COLUMNS):
+    """Process shard tasks from the queue until none is left.
+
+    Output
+    ------
+    [list of str]
+        Names of the tasks this worker completed.
+    """
+    worker = f'{socket.gethostname()}-{os.getpid()}'
+    completed = []
+    while True:
+        claimed = claim_task(queue_dir)
+        if claimed is None:
+            return completed
+        name, task = claimed
+        print(f"{worker}: processing shard {name}")
+        try:
+            with heartbeat(queue_dir, name):
+                process_shard(task, configs, INDEX_ID, INDEX_IMPUTATION_ID, INDEX_COLUMNS, TARGET_COLUMNS)
+        except Exception:
+            complete_task(queue_dir, name, error=traceback.format_exc())
+            print(f"{worker}: shard {name} failed")
+        else:
+            complete_task(queue_dir, name)
+            completed.append(name)
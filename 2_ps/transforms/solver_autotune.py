@@ -0,0 +1,213 @@
+##################################################
+## Project: Real World Evidence to Accelerate COVID-19 Therapeutics
+## Contract No.: 75FCMC18D0047
+## Purpose: Functions to select the fastest equivalent logistic regression solver on a subsample
+## Date: May 2022
+## Developers: Alexander Wood
+## Copyright 2022, The MITRE Corporation
+## Approved for Public Release; Distribution Unlimited. Public Release Case Number 22-1741.
+##################################################
+
+# No transforms imports here: 2_drs/transforms/model.py loads this file
+# directly, outside of the 2_ps transforms package.
+
+import hashlib
+import json
+import time
+import warnings
+from pathlib import Path
+
+import numpy as np
+from scipy import sparse
+from sklearn.base import clone
+from sklearn.exceptions import ConvergenceWarning
+from sklearn.linear_model import LogisticRegression
+from sklearn.utils.class_weight import compute_class_weight
+
+
+# Solvers that support each penalty, in order of preference on ties.
+SOLVERS_BY_PENALTY = {
+    'l2': ['lbfgs', 'newton-cg', 'liblinear', 'saga'],
+    'l1': ['liblinear', 'saga'],
+    'elasticnet': ['saga'],
+}
+
+# Each solver's time is the fastest of TIME_REPEATS fits, and solvers
+# within TIME_RTOL (relative) plus TIME_ATOL (seconds) of the fastest time
+# count as tied, so that timing noise does not change the choice from run
+# to run.
+TIME_REPEATS = 3
+TIME_RTOL = 0.25
+TIME_ATOL = 0.005
+
+# Choices made in this process, keyed by data fingerprint and parameters.
+_SOLVER_CACHE = {}
+
+
+def lr_objective(model, X, y, sample_weight=None):
+    """The penalized objective sklearn's LogisticRegression minimizes,
+
+        C * sum_i w_i * logloss_i + penalty(coef)
+
+    where w_i combines sample_weight and class_weight, and the
+    intercept is not penalized.
+    """
+    params = model.get_params()
+    y = np.asarray(y)
+    w = np.ones(y.shape[0]) if sample_weight is None else np.asarray(sample_weight, dtype=np.float64)
+
+    class_weight = params.get('class_weight')
+    if class_weight is not None:
+        classes = np.unique(y)
+        if class_weight == 'balanced':
+            class_weight = dict(zip(classes.tolist(), compute_class_weight('balanced', classes=classes, y=y)))
+        w = w * np.array([class_weight.get(label, 1.0) for label in y.tolist()])
+
+    z = X @ model.coef_.ravel() + model.intercept_[0]
+    sign = np.where(y == model.classes_[-1], 1.0, -1.0)
+    loss = np.logaddexp(0, -sign * z)
+
+    coef = model.coef_.ravel()
+    penalty = params.get('penalty', 'l2')
+    if penalty == 'l1':
+        reg = np.abs(coef).sum()
+    elif penalty == 'elasticnet':
+        l1_ratio = params['l1_ratio']
+        reg = l1_ratio * np.abs(coef).sum() + (1 - l1_ratio) * 0.5 * coef @ coef
+    else:
+        reg = 0.5 * coef @ coef
+    return params['C'] * (w @ loss) + reg
+
+
+def stratified_subsample(y, n_samples, seed=2022):
+    """Row indices of a subsample of (at most) n_samples rows with the class balance of y."""
+    y = np.asarray(y)
+    if y.shape[0] <= n_samples:
+        return np.arange(y.shape[0])
+    rng = np.random.default_rng(seed)
+    idx = []
+    for label in np.unique(y):
+        members = np.flatnonzero(y == label)
+        n_label = max(1, int(round(n_samples * members.shape[0] / y.shape[0])))
+        idx.append(rng.choice(members, n_label, replace=False))
+    return np.sort(np.concatenate(idx))
+
+
+def autotune_solver(params, X, y, sample_weight=None, n_samples=2000, rtol=1e-3, cache_path=None, seed=2022,
+                    fingerprint=None):
+    """Select the fastest solver reaching the same objective.
+
+    Every solver that supports params['penalty'] is fitted TIME_REPEATS
+    times on a stratified subsample of X, y (and sample_weight) with the
+    other params unchanged, and timed by its fastest fit.
+    Solvers that raise, fail to converge, or end more than rtol
+    (relative) above the best objective found are rejected; liblinear,
+    for instance, also penalizes the intercept. Of the remaining
+    solvers within TIME_RTOL and TIME_ATOL of the fastest time, the
+    first in SOLVERS_BY_PENALTY order is returned.
+
+    The choice is cached by a fingerprint of X, y and sample_weight and
+    by the
+    parameters that affect the fits (penalty, C, l1_ratio, class_weight,
+    max_iter, tol, fit_intercept) and the subsample (n_samples, rtol,
+    seed), in memory and, with cache_path, in a json file shared across
+    runs.
+
+    Input
+    -----
+    params -- [dict]
+        LogisticRegression parameters of one candidate model.
+    X, y -- [numpy arrays]
+        The full training data.
+    sample_weight -- [numpy array or None]
+        Weights of the training rows, used in the subsample fits and
+        objectives as in the fits of the model.
+    fingerprint -- [str or None]
+        data_fingerprint(X, y, sample_weight), computed once by the
+        caller when several candidates are tuned on the same data.
+        Without it, it is computed here.
+
+    Output
+    ------
+    [dict]
+        params with the selected solver.
+    """
+    penalty = params.get('penalty', 'l2')
+    solvers = SOLVERS_BY_PENALTY.get(penalty, [params.get('solver', 'lbfgs')])
+    if fingerprint is None:
+        fingerprint = data_fingerprint(X, y, sample_weight)
+    key = json.dumps([
+        fingerprint, penalty, params.get('C', 1.0), params.get('l1_ratio'), str(params.get('class_weight')),
+        params.get('max_iter', 100), params.get('tol', 1e-4), params.get('fit_intercept', True),
+        n_samples, rtol, seed
+    ])
+
+    cache = _SOLVER_CACHE
+    if cache_path is not None and Path(cache_path).exists():
+        with open(cache_path) as f:
+            cache.update(json.load(f))
+
+    if key not in cache:
+        idx = stratified_subsample(y, n_samples, seed)
+        X_sub, y_sub = X[idx], np.asarray(y)[idx]
+        w_sub = None if sample_weight is None else np.asarray(sample_weight, dtype=np.float64)[idx]
+
+        results = {}
+        for solver in solvers:
+            model = LogisticRegression(random_state=2022).set_params(**{**params, 'solver': solver})
+            with warnings.catch_warnings(record=True) as w:
+                warnings.simplefilter('always')
+                try:
+                    elapsed = []
+                    for _ in range(TIME_REPEATS):
+                        start = time.perf_counter()
+                        model.fit(X_sub, y_sub, sample_weight=w_sub)
+                        elapsed.append(time.perf_counter() - start)
+                except ValueError:
+                    continue
+                elapsed = min(elapsed)
+            if any(issubclass(warning.category, ConvergenceWarning) for warning in w):
+                continue
+            results[solver] = (elapsed, lr_objective(model, X_sub, y_sub, w_sub))
+
+        if results:
+            best_objective = min(objective for _, objective in results.values())
+            valid = [
+                solver for solver, (_, objective) in results.items()
+                if objective - best_objective <= rtol * max(abs(best_objective), 1e-12)
+            ]
+            fastest = min(results[solver][0] for solver in valid)
+            cache[key] = next(
+                solver for solver in solvers
+                if solver in valid and results[solver][0] <= (1 + TIME_RTOL) * fastest + TIME_ATOL
+            )
+        else:
+            cache[key] = params.get('solver', 'lbfgs')
+        print(f"\tSolver for {penalty}, C={params.get('C')}: {cache[key]} " +
+              ", ".join(f"{s}={t:.3f}s" for s, (t, _) in results.items()))
+
+        if cache_path is not None:
+            with open(cache_path, 'w') as f:
+                json.dump(cache, f, indent=2)
+
+    return {**params, 'solver': cache[key]}
+
+
+def data_fingerprint(X, y, sample_weight=None):
+    """Shape and a hash of the values of X (dense or sparse), y and
+    sample_weight, so that cached solver choices are only reused on the
+    same data.
+    """
+    digest = hashlib.sha1(str(X.shape).encode())
+    if sparse.issparse(X):
+        X = X.tocsr()
+        arrays = [X.data, X.indices, X.indptr, y]
+    else:
+        arrays = [X, y]
+    if sample_weight is not None:
+        digest.update(b'sample_weight')
+        arrays.append(sample_weight)
+    for values in arrays:
+        values = np.ascontiguousarray(values, dtype=np.float64)
+        digest.update(values.view(np.uint8).ravel())
+    return digest.hexdigest()
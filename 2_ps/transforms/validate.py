@@ -0,0 +1,212 @@
+##################################################
+## Project: Real World Evidence to Accelerate COVID-19 Therapeutics
+## Contract No.: 75FCMC18D0047
+## Purpose: Functions to validate formatted data and model outputs against typed column rules
+## Date: May 2022
+## Developers: Alexander Wood
+## Copyright 2022, The MITRE Corporation
+## Approved for Public Release; Distribution Unlimited. Public Release Case Number 22-1741.
+##################################################
+
+import warnings
+
+import numpy as np
+import pandas as pd
+
+
+# Columns of the validation report.
+REPORT_COLUMNS = [
+    'variable', 'kind', 'n_rows', 'n_null', 'n_unique', 'min', 'max',
+    'n_out_of_domain', 'passed', 'errors', 'warnings'
+]
+
+
+# ############################################################################# #
+# RULES                                                                         #
+# ############################################################################# #
+def compile_rules(configs):
+    """Compile configs.csv into one typed rule per column.
+
+    Every column must have no null values. In addition,
+        bool    -- numeric, values in {0, 1}, at most two distinct values
+        numeric -- (int, float) numeric dtype
+        category -- (object) labels outside object_range, when given, are
+                    reported as warnings; the range is formatted as
+                    get_dataframe formats labels, and includes map_null
+
+    Input
+    -----
+    configs -- [Pandas DataFrame]
+        The configurations, as returned by get_configs.
+
+    Output
+    ------
+    [Pandas DataFrame]
+        One row per variable: variable, kind, domain, max_unique, min, max.
+    """
+    from transforms.get_dataframe import normalize_categories
+
+    kinds = {'bool': 'bool', 'int': 'numeric', 'float': 'numeric', 'object': 'category'}
+    configs = configs[configs['dtype'].isin(kinds.keys())]
+
+    rules = []
+    for variable, dtype, object_range, map_null in configs[['variable', 'dtype', 'object_range', 'map_null']].values:
+        rule = {'variable': variable, 'kind': kinds[dtype], 'domain': None, 'max_unique': None, 'min': None, 'max': None}
+        if dtype == 'bool':
+            rule.update({'domain': [0, 1], 'max_unique': 2})
+        elif dtype == 'object' and isinstance(object_range, str):
+            labels = [label.strip() for label in object_range.split(',')]
+            if isinstance(map_null, str):
+                labels.append(map_null.strip())
+            rule['domain'] = normalize_categories(pd.Series(labels)).cat.categories.tolist()
+        rules.append(rule)
+
+    return pd.DataFrame(rules, columns=['variable', 'kind', 'domain', 'max_unique', 'min', 'max'])
+
+
+def probability_rules(columns):
+    """Rules for model output columns: numeric, no nulls, within [0, 1]."""
+    return pd.DataFrame([
+        {'variable': column, 'kind': 'numeric', 'domain': None, 'max_unique': None, 'min': 0.0, 'max': 1.0}
+        for column in columns
+    ])
+
+
+# ############################################################################# #
+# VALIDATION                                                                    #
+# ############################################################################# #
+def validate(df, rules, sample=None, seed=2022):
+    """Evaluate all rules in one vectorized pass.
+
+    Bool and numeric columns are read once into a single float matrix.
+    Null counts, minima, maxima and the {0, 1} domain are then evaluated
+    for all columns at once. Distinct values are counted only where a
+    rule limits them. Categorical columns are checked on their codes,
+    and only their distinct labels are compared to the domain.
+
+    Input
+    -----
+    df -- [Pandas DataFrame]
+        The data to validate.
+    rules -- [Pandas DataFrame]
+        From compile_rules or probability_rules.
+    sample -- [int or None]
+        Validate a random sample of this many rows instead of every row
+        (a cheap check for production runs). None checks every row.
+
+    Output
+    ------
+    [Pandas DataFrame]
+        The report: one row per rule with the statistics in REPORT_COLUMNS,
+        passed (no errors) and the error and warning messages.
+    """
+    if sample is not None and df.shape[0] > sample:
+        rng = np.random.default_rng(seed)
+        df = df.iloc[np.sort(rng.choice(df.shape[0], sample, replace=False))]
+
+    report = pd.DataFrame({
+        'variable': rules['variable'].values,
+        'kind': rules['kind'].values,
+        'n_rows': df.shape[0],
+        'n_null': 0,
+        'n_unique': np.nan,
+        'min': np.nan,
+        'max': np.nan,
+        'n_out_of_domain': 0,
+    })
+    errors = [[] for _ in range(rules.shape[0])]
+    warns = [[] for _ in range(rules.shape[0])]
+
+    missing = ~rules['variable'].isin(df.columns).values
+    for i in np.flatnonzero(missing):
+        errors[i].append('column missing')
+
+    # ############################################### #
+    # BOOL AND NUMERIC COLUMNS                        #
+    # ############################################### #
+    numeric = np.flatnonzero(rules['kind'].isin(['bool', 'numeric']).values & ~missing)
+    is_numeric = np.array([
+        pd.api.types.is_numeric_dtype(df[variable]) for variable in rules['variable'].values[numeric]
+    ], dtype=bool)
+    for i in numeric[~is_numeric]:
+        errors[i].append(f'dtype {df[rules["variable"].values[i]].dtype} is not numeric')
+    numeric = numeric[is_numeric]
+
+    if len(numeric):
+        X = df[rules['variable'].values[numeric].tolist()].to_numpy(dtype=np.float64)
+        null = np.isnan(X)
+        n_null = null.sum(axis=0)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            report.loc[numeric, 'min'] = np.nanmin(X, axis=0) if X.shape[0] else np.nan
+            report.loc[numeric, 'max'] = np.nanmax(X, axis=0) if X.shape[0] else np.nan
+        report.loc[numeric, 'n_null'] = n_null
+
+        # Bool domain and cardinality.
+        is_bool = (rules['kind'].values[numeric] == 'bool')
+        if is_bool.any():
+            B = X[:, is_bool]
+            out = ~null[:, is_bool] & (B != 0) & (B != 1)
+            B = np.sort(B, axis=0)
+            valid = ~np.isnan(B)
+            n_unique = valid[:1].sum(axis=0) + ((B[1:] != B[:-1]) & valid[1:]).sum(axis=0)
+            report.loc[numeric[is_bool], 'n_out_of_domain'] = out.sum(axis=0)
+            report.loc[numeric[is_bool], 'n_unique'] = n_unique
+
+        # Ranges.
+        for bound, compare in [('min', np.less), ('max', np.greater)]:
+            limits = rules[bound].values[numeric].astype(np.float64)
+            limited = ~np.isnan(limits)
+            if limited.any():
+                out = compare(X[:, limited], limits[limited]) & ~null[:, limited]
+                report.loc[numeric[limited], 'n_out_of_domain'] += out.sum(axis=0)
+
+    # ############################################### #
+    # CATEGORY COLUMNS                                #
+    # ############################################### #
+    for i in np.flatnonzero((rules['kind'].values == 'category') & ~missing):
+        series = df[rules['variable'].values[i]]
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            codes, categories = series.cat.codes.to_numpy(), series.cat.categories
+        else:
+            codes, categories = pd.factorize(series)
+        counts = np.bincount(codes[codes >= 0], minlength=len(categories))
+        report.loc[i, 'n_null'] = (codes < 0).sum()
+        report.loc[i, 'n_unique'] = (counts > 0).sum()
+
+        domain = rules['domain'].values[i]
+        if domain is not None:
+            outside = ~pd.Index(categories).isin(domain) & (counts > 0)
+            report.loc[i, 'n_out_of_domain'] = counts[outside].sum()
+            if outside.any():
+                warns[i].append(f'labels outside object_range: {list(categories[outside])}')
+
+    # ############################################### #
+    # MESSAGES                                        #
+    # ############################################### #
+    for i in range(rules.shape[0]):
+        if report.at[i, 'n_null'] > 0:
+            errors[i].append(f"{report.at[i, 'n_null']} null values")
+        if report.at[i, 'n_out_of_domain'] > 0 and rules['kind'].values[i] != 'category':
+            errors[i].append(f"{report.at[i, 'n_out_of_domain']} values out of range")
+        max_unique = rules['max_unique'].values[i]
+        if pd.notna(max_unique) and report.at[i, 'n_unique'] > max_unique:
+            errors[i].append(f"{int(report.at[i, 'n_unique'])} distinct values")
+
+    report['passed'] = [len(e) == 0 for e in errors]
+    report['errors'] = ['; '.join(e) for e in errors]
+    report['warnings'] = ['; '.join(w) for w in warns]
+    return report[REPORT_COLUMNS]
+
+
+def assert_valid(report, name='Dataframe'):
+    """Print warnings and failures from a validation report, and fail on errors."""
+    rows = f" ({report['n_rows'].iloc[0]} rows)" if report.shape[0] else ''
+    for variable, message in report.loc[report['warnings'] != '', ['variable', 'warnings']].values:
+        warnings.warn(f"{variable}: {message}")
+
+    failed = report[~report['passed']]
+    print(f"{name} validation{rows}: {report.shape[0] - failed.shape[0]} of {report.shape[0]} columns passed.")
+    assert failed.shape[0] == 0, \
+        "Failed check: " + "; ".join(f"{v} ({e})" for v, e in failed[['variable', 'errors']].values)
+    return 1
@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+
+##################################################
+## Project: Real World Evidence to Accelerate COVID-19 Therapeutics
+## Contract No.: 75FCMC18D0047
+## Purpose: This script executes the Python fast path for the marginal structural models defined in 4_msm/transforms/msm_fast.py
+## Date: May 2022
+## Developers: Lauren D'Arinzo
+## Copyright 2022, The MITRE Corporation
+## Approved for Public Release; Distribution Unlimited. Public Release Case Number 22-1741.
+##################################################
+
+import pandas as pd
+from pathlib import Path
+
+from transforms.msm_fast import msm_input, msm_effect_wgraph_vals, msm_effect_wgraph_vals_pooled, msm_prob_results
+
+current = Path.cwd()
+
+# read in relevant inputs
+impute_pmm = pd.read_csv('1_imputation/data/mab_patient_effect_imputed.csv')
+best_model_pscores = pd.read_csv('3_ps-covariate-balance/data/best_model_pscores.csv')
+
+# ATE and effect modifier results
+msm_input_df = msm_input(best_model_pscores, impute_pmm)
+msm_effect_wgraph_vals_df = msm_effect_wgraph_vals(msm_input_df)
+msm_effect_wgraph_vals_pooled_df = msm_effect_wgraph_vals_pooled(msm_effect_wgraph_vals_df)
+msm_prob_results_df = msm_prob_results(msm_effect_wgraph_vals_pooled_df)
+
+# write out results
+msm_prob_results_df.to_csv(current / '4_msm' / 'data' / 'msm_prob_results_fast.csv', index=False)
@@ -1,80 +1,141 @@
 # Use this script if you need to produce grouping vectors for additional effect modifiers
 
-def common_member(a, b):
-    a_set = set(a)
-    b_set = set(b)
-    if (a_set & b_set):
-        return True 
-    else:
-        return False
-
-def get_group_vectors(factor_levels):
+from collections import namedtuple
+from functools import lru_cache
+from itertools import combinations, product
+
+import numpy as np
+
+# Adjusted effect estimates returned by apply_contrast_matrix. Each field is an
+# array of shape (n_impute, n_groups), with groups ordered as the contrast columns.
+GroupEstimates = namedtuple(
+    'GroupEstimates',
+    ['log_odds', 'sandwich_std_error', 'prob', 'prob_std_error']
+)
+
+
+def get_contrast_matrix(factor_levels, crossed_levels=None):
+    '''
+    INPUT: factor_levels: list of strings, where the first element is the baseline factor level.
+    crossed_levels: optional list of strings for a second effect modifier to cross with the first, again with the
+    baseline level first.
+    OUTPUT: (contrast, row_names, column_names) where contrast is a numeric array of shape (len(row_names), len(column_names)).
+    Rows are the logistic regression terms in the order R's glm returns them for the formula
+    outcome ~ treatment_group*modifier (or outcome ~ treatment_group*modifier*crossed_modifier), and columns are the
+    untreated/treated subgroups in the order untreated-levelA, treated-levelA, untreated-levelB, ...
+
+    A term contributes to a subgroup when every component of the term (treatment and non-baseline factor levels)
+    is present in that subgroup, so the intercept is 1 everywhere, 'treated_dummy' is 1 for treated columns, and so on.
+    Results are cached by level set; the returned arrays are read-only.
+
+    Example usage for pandemic_phase: get_contrast_matrix(['predelta', 'delta', 'deltaomicron', 'omicron'])
+    Example usage for pandemic_phase by vaccination: get_contrast_matrix(['predelta', 'delta'], ['no', 'partial', 'full'])
+
+    Crossed interactions vary the levels of the first modifier fastest, as in R's model.matrix(~ t*a*b)
+    (python -m doctest create_group_vectors.py checks this example):
+    >>> get_contrast_matrix(['a1', 'a2', 'a3'], ['b1', 'b2', 'b3'])[1][10:]
+    ('a2_b2_dummy', 'a3_b2_dummy', 'a2_b3_dummy', 'a3_b3_dummy', 'treated_a2_b2_interaction', 'treated_a3_b2_interaction', 'treated_a2_b3_interaction', 'treated_a3_b3_interaction')
+    '''
+    crossed_levels = tuple(crossed_levels) if crossed_levels is not None else None
+    return _contrast_matrix(tuple(factor_levels), crossed_levels)
+
+
+@lru_cache(maxsize=None)
+def _contrast_matrix(factor_levels, crossed_levels):
+    # Each factor is a list of its non-baseline components. A component is
+    # a (factor index, level) pair so that identical level names in two
+    # modifiers do not collide.
+    factors = [[(0, 'treated')], [(1, x) for x in factor_levels[1:]]]
+    if crossed_levels is not None:
+        factors.append([(2, x) for x in crossed_levels[1:]])
+
+    # Terms ordered the way R orders them: intercept, main effects, then
+    # interactions of increasing order, in order of factor appearance.
+    # Within an interaction R varies the levels of the first factor fastest
+    # (a2:b2, a3:b2, a2:b3, ...), the reverse of itertools.product.
+    terms = [()]
+    for order in range(1, len(factors) + 1):
+        for factor_subset in combinations(factors, order):
+            terms += [term[::-1] for term in product(*factor_subset[::-1])]
+
+    # Subgroups: every combination of effect modifier level(s), each with
+    # untreated then treated.
+    modifier_levels = [[(1, x) for x in factor_levels]]
+    if crossed_levels is not None:
+        modifier_levels.append([(2, x) for x in crossed_levels])
+    groups, column_names = [], []
+    for levels in product(*modifier_levels):
+        for status in ['untreated', 'treated']:
+            components = set(levels)
+            if status == 'treated':
+                components.add((0, 'treated'))
+            groups.append(components)
+            column_names.append('_'.join([x for _, x in levels] + [status]))
+
+    contrast = np.array(
+        [[int(set(term) <= group) for group in groups] for term in terms],
+        dtype=np.float64
+    )
+    contrast.setflags(write=False)
+
+    row_names = []
+    for term in terms:
+        labels = [x for _, x in term]
+        if len(term) == 0:
+            row_names.append('intercept')
+        elif term[0][0] == 0:
+            row_names.append('_'.join(labels + ['dummy' if len(term) == 1 else 'interaction']))
+        else:
+            row_names.append('_'.join(labels + ['dummy']))
+
+    return contrast, tuple(row_names), tuple(column_names)
+
+
+def apply_contrast_matrix(coefficients, vcov, contrast):
+    '''
+    INPUT: coefficients: array of shape (n_impute, n_terms) holding the MSM coefficients for each imputation,
+    vcov: array of shape (n_impute, n_terms, n_terms) holding the matching (sandwich) variance/covariance matrices,
+    contrast: array of shape (n_terms, n_groups), e.g. the first output of get_contrast_matrix.
+    OUTPUT: GroupEstimates with the predicted log odds and their standard errors for every subgroup and imputation,
+    plus the adjusted probabilities and their delta-method standard errors.
+
+    This is the batched equivalent of the est %*% subgroup_col and subgroup_col %*% varcovar_mat %*% subgroup_col
+    loop in msm_effect_wgraph_vals.R, done for all imputations and subgroups at once.
+    '''
+    coefficients = np.asarray(coefficients, dtype=np.float64)
+    vcov = np.asarray(vcov, dtype=np.float64)
+    contrast = np.asarray(contrast, dtype=np.float64)
+    if coefficients.ndim == 1:
+        coefficients, vcov = coefficients[np.newaxis, :], vcov[np.newaxis, :, :]
+
+    log_odds = coefficients @ contrast
+    # diag(C' V C) for every imputation without forming the full product.
+    variance = np.einsum('mpg,pg->mg', vcov @ contrast, contrast)
+    std_error = np.sqrt(np.clip(variance, 0, None))
+
+    prob = 1 / (1 + np.exp(-log_odds))
+    prob_std_error = prob * (1 - prob) * std_error
+
+    return GroupEstimates(log_odds, std_error, prob, prob_std_error)
+
+
+def get_group_vectors(factor_levels, crossed_levels=None):
     '''
     INPUT: factor_levels: list of strings, where the first element is the baseline factor level. Each string should contain only alphanumeric characters
+    crossed_levels: optional list of strings for a second effect modifier crossed with the first (see get_contrast_matrix)
     OUTPUT: strings that can be used to create additional group_vector configuration files if a user wants to analyze additional effect modifiers,
-    and be able to directly compare treated and untreated population. Grouping vectors provide a structure for combining the raw coefficient output from the 
+    and be able to directly compare treated and untreated population. Grouping vectors provide a structure for combining the raw coefficient output from the
     marginal strucutral logistic regression model terms into adjusted effect estimates between treated and untreated patients.
+    The numeric (contrast, row_names, column_names) from get_contrast_matrix are also returned for use from Python.
 
     See any file in 4_msm/transforms/group_vectors for a template for a grouping vectors file
 
     Example usage for pandemic_phase: get_group_vectors(['predelta', 'delta', 'deltaomicron', 'omicron'])
     '''
-    
-    dummy_terms = [x+'_dummy' for x in factor_levels[1:]]
-    interaction_terms = ['treated_'+x+'_interaction' for x in factor_levels[1:]]
-    row_names = ['intercept', 'treated_dummy'] + dummy_terms + interaction_terms
-    column_names=[]
-    for i in factor_levels:
-        for j in ['untreated', 'treated']:
-            column_names.append(i+'_'+j)
-    
-
-    for col in column_names:
-        vector = []
-        for term_idx, row in enumerate(row_names):
-            # vector will be len(row_names)
-            
-            # intercept terms are 1 for all columns
-            if term_idx == 0:
-                vector.append(1)
-                
-            # treatment group terms are 1 for all treated columns
-            # needed to use 'not untreated' because 'treated' is contained in the string 'untreated'
-            if term_idx == 1:
-                if not 'untreated' in col:
-                    vector.append(1)
-                else:
-                    vector.append(0)
-                    
-            # for all the other terms
-            if term_idx > 1:
-                # split the names into list so we can compare elements
-                col_list = col.split('_')
-                row_list = row.split('_')
-                
-                # for dummy columns, value is 1 when there is a common element between row and column
-                # i.e. 'delta_dummy' and 'delta_untreated'
-                if 'dummy' in row: 
-                    if common_member(col_list, row_list):
-                        vector.append(1)
-                    else:
-                        vector.append(0)
-                        
-                # for interaction terms, value is only 1 if we are looking at a treated column
-                # that shares a common element other than 'treated'
-                # for example 'treat_delta_interaction' and 'delta_treated'
-                elif 'interaction' in row:
-                    if 'untreated' in col:
-                        vector.append(0)
-                    else: 
-                        row_list = row_list[1:]
-                        if common_member(col_list, row_list):
-                            vector.append(1)
-                        else:
-                            vector.append(0)
-
-        vector_output = str(col) + ' <- c'+ str(vector)
-        print(vector_output.replace("[", "(").replace("]", ")"))
-    print('\n','data.frame('+ str(column_names).replace("'", "").replace("[", "").replace("]", "") + ")")
-    print('\n', 'c('+ str(row_names).replace("'", '"').replace("[", "").replace("]", "") + ")")
-    return
\ No newline at end of file
+    contrast, row_names, column_names = get_contrast_matrix(factor_levels, crossed_levels)
+
+    for col, vector in zip(column_names, contrast.T.astype(int).tolist()):
+        print(col + ' <- c(' + ', '.join(str(x) for x in vector) + ')')
+    print('\n', 'data.frame(' + ', '.join(column_names) + ')')
+    print('\n', 'c(' + ', '.join('"' + x + '"' for x in row_names) + ')')
+    return contrast, row_names, column_names
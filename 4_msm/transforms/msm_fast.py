@@ -0,0 +1,278 @@
+##################################################
+## Project: Real World Evidence to Accelerate COVID-19 Therapeutics
+## Contract No.: 75FCMC18D0047
+## Purpose: Python fast path for fitting the marginal structural models batched over imputations and outcomes
+## Date: May 2022
+## Developers: Lauren D'Arinzo, Max Olivier
+## Copyright 2022, The MITRE Corporation
+## Approved for Public Release; Distribution Unlimited. Public Release Case Number 22-1741.
+##################################################
+
+# This module mirrors msm_input.R, msm_effect_wgraph_vals.R, msm_effect_wgraph_vals_pooled.R and
+# msm_prob_results.R for the ATE and the categorical effect modifiers.
+#
+# The MSM for an effect modifier is outcome ~ treatment_group + treatment_group*modifier, which is saturated
+# in the (treatment, modifier level) subgroups. Every patient's design row is therefore one of the columns of
+# the grouping-vector contrast matrix, and the weighted likelihood, its derivatives and the sandwich meat only
+# depend on a handful of weighted sums per subgroup. Those sums are computed for all outcomes in one bincount
+# pass, and IRLS is then run on the tiny grouped problem for all imputations and outcomes at once, sharing the
+# same design matrix.
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from transforms.group_vectors.create_group_vectors import get_contrast_matrix, apply_contrast_matrix
+
+
+# Global variables config (see 4_msm/transforms/config.R)
+outcome_vars = ['ed_14d', 'inpt_14d', 'death_14d', 'death_inpt_14day', 'ed_30d', 'inpt_30d', 'death_30d', 'death_inpt_30day']
+whole_population_em = ['pandemic_phase']
+immunization_subpop_em = ['immunized_sarscov2_status']
+effect_modifiers = whole_population_em + immunization_subpop_em
+effect_modifier_order = ['none'] + whole_population_em + immunization_subpop_em
+
+# Ordinal factor levels that correspond to group vectors; the first level is the baseline.
+effect_modifier_levels = {
+    'pandemic_phase': ['pre_delta', 'delta', 'delta_omicron', 'omicron'],
+    'immunized_sarscov2_status': ['no', 'partial', 'full', 'full_boosted'],
+}
+
+model_order = {'ed': 'ED', 'inpt': 'Inpatient', 'death': 'Death', 'death_inpt': 'Death or Inpatient'}
+
+
+def msm_input(best_model_pscores, impute_pmm):
+    """Merge the propensity scores onto the imputed data set (port of msm_input.R)."""
+    best_model_pscores = best_model_pscores[['person_id', 'impute_id', 'prop_score']].copy()
+    impute_pmm = impute_pmm.copy()
+
+    # Make sure the person ID's can join across imputed and propensity data by giving them the same format.
+    best_model_pscores['person_id'] = best_model_pscores['person_id'].str.lower()
+    impute_pmm['person_id'] = impute_pmm['person_id'].str.lower()
+
+    df = impute_pmm.merge(best_model_pscores, on=['person_id', 'impute_id'], how='inner')
+
+    # Label January 2022 as Omicron and Label Dec 2021 as mixed Delta/Omicron
+    epoch = df['diagnosis_epoch'].astype(str)
+    df['pandemic_phase'] = np.where(epoch == '202201', 'omicron',
+                                    np.where(epoch == '202112', 'delta_omicron', df['pandemic_phase']))
+    return df
+
+
+# ############################################################################# #
+# BATCHED IRLS                                                                  #
+# ############################################################################# #
+def batched_irls(X, s0, s1, max_iter=25, epsilon=1e-8):
+    """Fit weighted logistic regressions on grouped data.
+
+    Input
+    -----
+    X -- [array, shape (n_groups, n_terms)]
+        Design row of each subgroup, shared by every fit.
+    s0, s1 -- [array, shape (..., n_groups)]
+        Sum of prior weights and of weighted outcomes in each subgroup;
+        leading dimensions index the independent fits (e.g. imputation, outcome).
+
+    Output
+    ------
+    beta -- [array, shape (..., n_terms)]
+    mu -- [array, shape (..., n_groups)]
+        Fitted probabilities.
+    bread -- [array, shape (..., n_terms, n_terms)]
+        Inverse of the weighted information matrix X' W X at the solution.
+
+    Convergence follows glm.fit: stop when the relative change in deviance
+    is below epsilon or after max_iter iterations.
+    """
+    beta = np.zeros(s0.shape[:-1] + (X.shape[1],))
+    deviance_old = np.inf
+    for _ in range(max_iter):
+        mu = 1 / (1 + np.exp(-(beta @ X.T)))
+        mu = np.clip(mu, 1e-10, 1 - 1e-10)
+
+        # Newton step (= IRLS for the canonical link), solved for every fit at once.
+        gradient = (s1 - s0 * mu) @ X
+        information = np.einsum('gp,...g,gq->...pq', X, s0 * mu * (1 - mu), X)
+        beta = beta + np.linalg.solve(information, gradient[..., np.newaxis])[..., 0]
+
+        mu = np.clip(1 / (1 + np.exp(-(beta @ X.T))), 1e-10, 1 - 1e-10)
+        deviance = -2 * (s1 * np.log(mu) + (s0 - s1) * np.log1p(-mu)).sum(axis=-1)
+        if np.all(np.abs(deviance - deviance_old) / (np.abs(deviance) + 0.1) < epsilon):
+            break
+        deviance_old = deviance
+
+    information = np.einsum('gp,...g,gq->...pq', X, s0 * mu * (1 - mu), X)
+    return beta, mu, np.linalg.inv(information)
+
+
+def sandwich_vcov(X, mu, bread, q0, q1):
+    """HC0 sandwich variance (sandwich::sandwich for glm) from grouped sums.
+
+    q0 and q1 are the per-subgroup sums of squared prior weights and of
+    squared weights times the (binary) outcome, so that the estimating
+    function cross-product sum_i w_i^2 (y_i - mu_g)^2 reduces to
+    (1 - 2 mu_g) q1 + mu_g^2 q0.
+    """
+    meat_weights = (1 - 2 * mu) * q1 + mu ** 2 * q0
+    meat = np.einsum('gp,...g,gq->...pq', X, meat_weights, X)
+    return bread @ meat @ bread
+
+
+# ############################################################################# #
+# EFFECT ESTIMATES FOR EACH IMPUTE GROUP, OUTCOME, EFFECT MODIFIER COMBO        #
+# ############################################################################# #
+def msm_effect_wgraph_vals(msm_input, outcome_vars=outcome_vars, effect_modifiers=effect_modifiers):
+    """Batched equivalent of msm_effect_wgraph_vals.R.
+
+    Output
+    ------
+    [Pandas DataFrame]
+        Same columns as the R graph_values output: outcome, effect_modifier,
+        treatment_status, effect_modifier_value, log_odds, sandwich_std_error,
+        n, total_in_group, outcomes_in_group, impute_id.
+    """
+    # Immunization analyses exclude patients who received non-US authorized vaccines.
+    immunized_subpop = msm_input[~((msm_input['immunized_sarscov2_status'] == 'no') & (msm_input['other_count'] > 0))]
+
+    impute_ids = sorted(msm_input['impute_id'].unique().tolist())
+    outcome_vars = list(outcome_vars)
+    n_outcomes = len(outcome_vars)
+
+    graph_values = []
+    for j in ['none'] + list(effect_modifiers):
+        effect_dat = immunized_subpop if j in immunization_subpop_em else msm_input
+
+        # A single 'none' level gives the ATE grouping vectors (intercept, treated_dummy).
+        if j == 'none':
+            levels = ['none']
+        else:
+            observed = set(effect_dat[j].unique().tolist())
+            levels = [x for x in effect_modifier_levels.get(j, sorted(observed)) if x in observed]
+        contrast, _, _ = get_contrast_matrix(levels)
+        n_groups = 2 * len(levels)
+        X = np.asarray(contrast).T
+
+        # Grouped sufficient statistics for every imputation, stacked.
+        s0, s1, q0, q1 = [np.zeros((len(impute_ids), n_outcomes, n_groups)) for _ in range(4)]
+        counts = np.zeros((len(impute_ids), n_groups))
+        outcome_counts = np.zeros((len(impute_ids), n_outcomes, n_groups))
+        n_rows = np.zeros(len(impute_ids))
+        for m, i in enumerate(impute_ids):
+            dat = effect_dat[effect_dat['impute_id'] == i]
+            treatment = dat['treatment_group'].to_numpy(dtype=np.int64)
+            prop_score = dat['prop_score'].to_numpy(dtype=np.float64)
+            if j == 'none':
+                level_codes = np.zeros(len(dat), dtype=np.int64)
+            else:
+                level_codes = pd.Categorical(dat[j], categories=levels).codes.astype(np.int64)
+            groups = 2 * level_codes + treatment
+
+            # Stabilized weights using the empirical probability of treatment within modifier level.
+            level_n = np.bincount(level_codes, minlength=len(levels))
+            prob_a1_q = (np.bincount(level_codes, treatment, minlength=len(levels)) / level_n)[level_codes]
+            weights = np.where(treatment == 1, prob_a1_q / prop_score, (1 - prob_a1_q) / (1 - prop_score))
+
+            # One bincount over (outcome, group) keys for all outcomes.
+            Y = dat[outcome_vars].to_numpy(dtype=np.float64)
+            keys = (groups[:, np.newaxis] + n_groups * np.arange(n_outcomes)).ravel()
+            size = n_groups * n_outcomes
+            s0[m] = np.bincount(groups, weights, minlength=n_groups)
+            q0[m] = np.bincount(groups, weights ** 2, minlength=n_groups)
+            s1[m] = np.bincount(keys, (weights[:, np.newaxis] * Y).ravel(), minlength=size).reshape(n_outcomes, n_groups)
+            q1[m] = np.bincount(keys, (weights[:, np.newaxis] ** 2 * Y).ravel(), minlength=size).reshape(n_outcomes, n_groups)
+            counts[m] = np.bincount(groups, minlength=n_groups)
+            outcome_counts[m] = np.bincount(keys, Y.ravel(), minlength=size).reshape(n_outcomes, n_groups)
+            n_rows[m] = len(dat)
+
+        beta, mu, bread = batched_irls(X, s0, s1)
+        vcov = sandwich_vcov(X, mu, bread, q0, q1)
+
+        for k, outcome in enumerate(outcome_vars):
+            estimates = apply_contrast_matrix(beta[:, k], vcov[:, k], contrast)
+            for m, i in enumerate(impute_ids):
+                graph_values.append(pd.DataFrame({
+                    'outcome': outcome,
+                    'effect_modifier': j,
+                    'treatment_status': ['untreated', 'treated'] * len(levels),
+                    'effect_modifier_value': np.repeat(levels, 2),
+                    'log_odds': estimates.log_odds[m],
+                    'sandwich_std_error': estimates.sandwich_std_error[m],
+                    'n': n_rows[m],
+                    'total_in_group': counts[m],
+                    'outcomes_in_group': outcome_counts[m, k],
+                    'impute_id': i,
+                }))
+
+    return pd.concat(graph_values, ignore_index=True)
+
+
+# ############################################################################# #
+# POOLING AND FORMATTING                                                        #
+# ############################################################################# #
+def msm_effect_wgraph_vals_pooled(graph_values):
+    """Pool effect estimates across imputation groups following Rubin's Rules (port of the R function)."""
+    n_impute = graph_values['impute_id'].nunique()
+    keys = ['outcome', 'effect_modifier', 'treatment_status', 'effect_modifier_value']
+
+    df = graph_values.assign(variance=graph_values['sandwich_std_error'] ** 2)
+    k = df.groupby(['outcome', 'effect_modifier'])[['treatment_status', 'effect_modifier_value']]\
+          .apply(lambda x: len(x.drop_duplicates())).rename('k')
+    grouped = df.groupby(keys)
+    pooled = pd.DataFrame({
+        'log_odds_pooled': grouped['log_odds'].mean(),                   # (9.1)
+        'Vw': grouped['variance'].mean(),                                # (9.2)
+        'Vb': grouped['log_odds'].var(ddof=1),                           # (9.3)
+        'n': grouped['n'].mean(),
+        'total_in_group': np.floor(grouped['total_in_group'].mean()),
+        'outcomes_in_group': np.floor(grouped['outcomes_in_group'].mean()),
+    }).reset_index().merge(k.reset_index(), on=['outcome', 'effect_modifier'])
+
+    pooled['Vt'] = pooled['Vw'] + pooled['Vb'] + pooled['Vb'] / n_impute           # (9.4)
+    pooled['lambda'] = (pooled['Vb'] + pooled['Vb'] / n_impute) / pooled['Vt']     # (10.1)
+    pooled['sandwich_se_pooled'] = np.sqrt(pooled['Vt'])
+    pooled['wald_pooled'] = np.abs(pooled['log_odds_pooled']) / pooled['sandwich_se_pooled']  # (9.5)
+    with np.errstate(divide='ignore'):
+        df_old = (n_impute - 1) / pooled['lambda'] ** 2                           # (9.8)
+    n_k = pooled['n'] - pooled['k']
+    df_obs = ((n_k + 1) / (n_k + 3)) * n_k * (1 - pooled['lambda'])                # (9.10)
+    # (9.9); with no between-imputation variance df_old is infinite and df_adj reduces to df_obs.
+    pooled['df_adj'] = np.where(np.isinf(df_old), df_obs, df_old * df_obs / (df_old + df_obs))
+    pooled['sandwich_p_val'] = 2 * stats.t.cdf(-pooled['wald_pooled'], pooled['df_adj'] - 1)  # (9.6)
+    t_crit = stats.t.ppf(0.975, pooled['df_adj'] - 1)
+    pooled['lb_pooled'] = pooled['log_odds_pooled'] - t_crit * pooled['sandwich_se_pooled']  # (9.11)
+    pooled['ub_pooled'] = pooled['log_odds_pooled'] + t_crit * pooled['sandwich_se_pooled']
+
+    pooled['sandwich_OR'] = np.exp(pooled['log_odds_pooled'])
+    pooled['prob_from_OR'] = pooled['sandwich_OR'] / (1 + pooled['sandwich_OR'])
+    pooled['lb_prob'] = 1 / (1 + np.exp(-pooled['lb_pooled']))
+    pooled['ub_prob'] = 1 / (1 + np.exp(-pooled['ub_pooled']))
+    return pooled
+
+
+def msm_prob_results(pooled):
+    """Format pooled results with the schema and ordering of 4_msm/data/msm_prob_results.csv."""
+    df = pooled.copy()
+    df['outcome'] = df['outcome'].str.replace('_14day', '_14d').str.replace('_30day', '_30d')
+    df['outcome_time'] = np.where(df['outcome'].str.contains('14d'), '14d', '30d')
+    df['model'] = df['outcome'].str.replace('_14d|_30d', '', regex=True)
+    df['prob_ci'] = [
+        ('%.1f%% (%.1f%% - %.1f%%)' % (p * 100, lb * 100, ub * 100)).replace('nan', 'NaN')
+        for p, lb, ub in zip(df['prob_from_OR'], df['lb_prob'], df['ub_prob'])
+    ]
+
+    # pivot to include both non-treated and treated estimates in same row
+    index = ['effect_modifier', 'model', 'outcome_time', 'effect_modifier_value']
+    wide = df.pivot_table(index=index, columns='treatment_status', values='prob_ci', aggfunc='first').reset_index()
+    wide = wide.rename(columns={'untreated': 'prob_ci_Non-treated', 'treated': 'prob_ci_Treated'})
+
+    # Order according to the config ordering.
+    wide['_em'] = wide['effect_modifier'].map({x: i for i, x in enumerate(effect_modifier_order)})
+    wide['_model'] = wide['model'].map({x: i for i, x in enumerate(model_order)})
+    value_order = {
+        (em, value): i for em, values in effect_modifier_levels.items() for i, value in enumerate(values)
+    }
+    wide['_value'] = [value_order.get(key, 0) for key in zip(wide['effect_modifier'], wide['effect_modifier_value'])]
+    wide = wide.sort_values(['_em', '_model', 'outcome_time', '_value'])
+    wide['model'] = wide['model'].map(model_order)
+
+    return wide[index + ['prob_ci_Non-treated', 'prob_ci_Treated']].reset_index(drop=True)
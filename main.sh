@@ -18,6 +18,9 @@ src=$(pwd)
 echo "Imputing missing data"
 Rscript 1_imputation/main_imputation.R $src
 
+echo "Encoding feature stores"
+python 2_ps/main_feature_store.py $src
+
 echo "Estimating disease risk scores"
 python 2_drs/main_drs.py $src
 